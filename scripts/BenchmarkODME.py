@@ -0,0 +1,84 @@
+#----------------------------------------------------------------------------------------------------------------------------------------------------------------------#
+# Name:        BenchmarkODME
+# Purpose:     Times the headless ODME engine (ODME.EstimateFromFiles and each EstimateMatrix solver) on the bundled test_data/least_squares case: Link_Counts.att and
+#              Seed_OD.mtx. The repository has no path flow proportion file for that case, so a synthetic one with a fixed random seed
+#              is written next to the outputs (every count location gets flows from a random share of the OD pairs).
+#              usage: python BenchmarkODME.py [test data folder] [iterations]
+#
+# Author:      python-tdm contributors
+# Dependencies:numpy [http://www.numpy.org], scipy [https://www.scipy.org/], ODME, MatrixIO
+# Created:     10/18/2026
+#
+# Copyright:   (c) python-tdm contributors 2026
+# Licence:     Permission is hereby granted, free of charge, to any person obtaining a copy
+#              of this software and associated documentation files (the "Software"), to deal
+#              in the Software without restriction, including without limitation the rights
+#              to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#              copies of the Software, and to permit persons to whom the Software is
+#              furnished to do so, subject to the following conditions:
+#
+#              The above copyright notice and this permission notice shall be included in all
+#              copies or substantial portions of the Software.
+#
+#              THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#              IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#              FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#              AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#              LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#              OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#              SOFTWARE.
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------#
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+import ODME
+
+def WriteSyntheticFlowMat(filename, nODs, nLinks, share = 0.05, seed = 0):
+    '''Writes a path flow proportion file in the readFlowMat layout (12 header lines, then CountIndex \t ODIndex \t proportion)'''
+    rng = np.random.RandomState(seed)
+    f = open(filename, 'wb')
+    f.write(''.join(['* synthetic flow proportions for BenchmarkODME\n']*12).encode('utf-8'))
+    for link in range(1, nLinks + 1):
+        ods = np.flatnonzero(rng.random_sample(nODs) < share) + 1
+        np.savetxt(f, np.column_stack([np.repeat(link, len(ods)), ods, rng.random_sample(len(ods))]), fmt='%d\t%d\t%.6f')
+    f.close()
+
+def RunBenchmark(testdir, iter = 25, log = None):
+    '''Runs the estimation on the test case and returns a dictionary of timings (secs), final result totals and a comparison of the solvers'''
+    countfile = os.path.join(testdir, 'Link_Counts.att')
+    seedfile = os.path.join(testdir, 'Seed_OD.mtx')
+    workdir = tempfile.mkdtemp()
+    try:
+        flowmatfile = os.path.join(workdir, 'FlowMatrix.mtx')
+        Ca, Wt = ODME.ReadLinkCounts(countfile)
+        AssignedOD, Sparse_OD, zoneIDs = ODME.ReadSeed(seedfile)
+        WriteSyntheticFlowMat(flowmatfile, len(Sparse_OD), len(Ca))
+
+        Timings = {}
+        t1 = time.time()
+        Result, zoneIDs = ODME.EstimateFromFiles(countfile, seedfile, flowmatfile, iter=iter, log=log)
+        Timings['estimate (parse flow mat)'] = time.time() - t1
+        t1 = time.time()
+        Result, zoneIDs = ODME.EstimateFromFiles(countfile, seedfile, flowmatfile, iter=iter, log=log)
+        Timings['estimate (cached flow mat)'] = time.time() - t1
+        Timings['seed total'] = Sparse_OD.sum()
+        Timings['result total'] = Result.sum()
+
+        CaExt, WtExt = ODME.ExtendCounts(Ca, Wt, Sparse_OD)
+        FlowProp, FlowPropT = ODME.loadFlowMat(len(Sparse_OD), len(Ca), flowmatfile, log=log)
+        for method in ['gradient', 'cg', 'lbfgsb']:
+            OD, Diag = ODME.EstimateMatrix(FlowProp, FlowPropT, Sparse_OD, CaExt, WtExt, iter, log, method, getDiagnostics=1)
+            Timings[method + ' (secs, iterations, flow mat products, final Z)'] = (Diag['elapsed'][-1], Diag['iterations'], Diag['products'], Diag['Z'][-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)  #synthetic flow matrix and its .cache sidecar
+    return Timings
+
+if __name__ == '__main__':
+    testdir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'least_squares')
+    iter = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    Timings = RunBenchmark(testdir, iter, log=lambda msg: None)
+    for key in sorted(Timings.keys()):
+        print(key + ': ' + str(Timings[key]))
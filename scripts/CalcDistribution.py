@@ -2,13 +2,17 @@
 # Name:        CalcDistribution
 # Purpose:     Utilities for various calculations of different types of trip distribution models.
 #               a) CalcFratar : Calculates a Fratar/IPF on a seed matrix given row and column (P and A) totals
+#                  BalanceFratar : Convergence driven IPF engine behind CalcFratar, scales in place or into an out= buffer
 #               b) CalcSinglyConstrained : Calculates a singly constrained trip distribution for given P/A vectors and a
 #                  friction factor matrix
 #               c) CalcDoublyConstrained : Calculates a doubly constrained trip distribution for given P/A vectors and a
 #                  friction factor matrix (P and A should be balanced before usage, if not then A is scaled to P)
 #               d) CalcMultiFratar : Applies fratar model to given set of trip matrices with multiple target production vectors and one attraction vector
 #               e) CalcMultiDistribute : Applies gravity model to a given set of frication matrices with multiple production vectors and one target attraction vector
+#                  CalcMultiDistributeBatch : Vectorized engine behind CalcMultiDistribute, all segments in one pass with optional chunking and tolerance
 #               f) CalcGravityShadow : Implements attraction balancing by scaling attractions instead of furnessing flows, this method is more 'correct'
+#               g) CalcGravityBlocked : Out-of-core doubly constrained gravity model, streams a memory-mapped friction matrix by row blocks
+#               h) CalcModeDestinationBlocked : Fused mode and destination choice, mode choice log sums -> friction -> gravity model -> trips by mode per row block
 #
 #              **All input vectors are expected to be numpy arrays
 #
@@ -36,13 +40,214 @@
 #              SOFTWARE.
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------------#
 import numpy as np
+import CalcLogitChoice
+import multiprocessing
+import mmap
+import multiprocessing.pool
+import os
+import tempfile
+import time
 
-def CalcFratar(ProdA, AttrA, Trips1, maxIter = 10):
+_ROW_BLOCK = 256  #origin rows per work unit for the row partitioned models, fixed so results do not depend on numWorkers
+
+class _AndersonMixer(object):
+    '''Anderson acceleration of a balancing factor update x <- G(x), mixed on log factors so they stay positive
+       Falls back to the plain step and restarts the history whenever the residual grows
+    '''
+    def __init__(self, depth):
+        self.depth = depth
+        self.fallbacks = 0
+        self._Reset()
+
+    def _Reset(self):
+        self.use = None
+        self.G = []
+        self.R = []
+
+    def Step(self, x, gx):
+        '''x = current factors, gx = plain balancing update G(x), returns the factors for the next iteration'''
+        if self.depth <= 0:
+            return gx
+        use = (x > 0) & (gx > 0)  #zero factors (zero targets) always take the plain step
+        g = np.log(gx[use])
+        r = g - np.log(x[use])
+        if self.R and (not np.array_equal(use, self.use) or r.dot(r) > self.R[-1].dot(self.R[-1])):
+            self._Reset()
+            self.fallbacks+=1
+        self.use = use
+        self.G.append(g)
+        self.R.append(r)
+        if len(self.R) > self.depth + 1:
+            del self.G[0], self.R[0]
+        if len(self.R) == 1:
+            return gx
+        dR = np.column_stack([self.R[k + 1] - self.R[k] for k in range(len(self.R) - 1)])
+        dG = np.column_stack([self.G[k + 1] - self.G[k] for k in range(len(self.G) - 1)])
+        y = g - dG.dot(np.linalg.lstsq(dR, r, rcond=None)[0])
+        if not np.isfinite(y).all() or np.absolute(y - g).max() > 10.0*np.absolute(r).max() + 1.0:  #reject wild extrapolations
+            self._Reset()
+            self.fallbacks+=1
+            return gx
+        xnew = gx.copy()
+        xnew[use] = np.exp(y)
+        return xnew
+
+def _MaxRelError(Computed, Target):
+    '''Maximum relative error of computed marginals against target marginals, zero targets use absolute error'''
+    return (np.absolute(Computed - Target)/np.where(Target > 0, Target, 1.0)).max()
+
+def _GravityRowBlock(ProdA, AttrA, F, r0, r1, out = None):
+    '''Rows r0:r1 of the row constrained model T[i,j] = P[i]*A[j]*F[i,j]/sum_j(A[j]*F[i,j])
+       Returns the row factors, computed productions and computed attractions of the block, trip rows are written to out if given
+    '''
+    Fb = F[r0:r1]
+    SumAjFij = Fb.dot(AttrA)
+    RowFac = ProdA[r0:r1]/np.maximum(SumAjFij, 0.000001)
+    if out is not None:
+        np.multiply(Fb, AttrA, out=out[r0:r1])
+        out[r0:r1]*=RowFac[:, np.newaxis]
+    return RowFac, RowFac*SumAjFij, RowFac.dot(Fb)*AttrA
+
+_WorkerMaps = {}
+
+def _OpenMap(spec):
+    '''Attaches a worker process to a shared numpy.memmap given as (filename, dtype, shape, offset, mode)'''
+    if spec is None:
+        return None
+    if spec not in _WorkerMaps:
+        _WorkerMaps[spec] = np.memmap(spec[0], dtype=spec[1], shape=spec[2], offset=spec[3], mode=spec[4])
+    return _WorkerMaps[spec]
+
+def _FileOffset(mm):
+    '''Byte offset of a numpy.memmap (or a view of one, e.g. F3[2] of a stacked file) in its file, None if it is not a memmap
+       or its rows are not one contiguous run of the file, or it is copy on write (changes are not in the file). A view keeps the
+       offset of the memmap it came from, so the offset is taken from the data address relative to that memmap
+    '''
+    if not isinstance(mm, np.memmap) or mm.filename is None or mm.mode == 'c' or not mm.flags['C_CONTIGUOUS']:
+        return None
+    root = mm
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if not isinstance(root, np.memmap) or not isinstance(root.base, mmap.mmap):
+        return None
+    return mm.ctypes.data - root.ctypes.data + root.offset
+
+def _MapSpec(mm, mode):
+    '''Picklable description of a numpy.memmap so worker processes can map the same file instead of copying the data'''
+    if mm is None:
+        return None
+    return (mm.filename, mm.dtype.str, mm.shape, _FileOffset(mm), mode)
+
+def _SharedGravityRowBlock(args):
+    ProdA, AttrA, Fspec, r0, r1, OutSpec = args
+    return _GravityRowBlock(ProdA, AttrA, _OpenMap(Fspec), r0, r1, _OpenMap(OutSpec))
+
+def _SharedMap(shape, src = None, shm = True):
+    '''numpy.memmap on a temporary file (in /dev/shm where available, unless shm is False) that worker processes can attach to'''
+    fd, fn = tempfile.mkstemp(suffix='.np', dir='/dev/shm' if shm and os.path.isdir('/dev/shm') else None)
+    os.close(fd)
+    mm = np.memmap(fn, dtype='d', mode='w+', shape=shape)
+    if src is not None:
+        mm[:] = src
+    return mm
+
+def _ReleaseMap(mm):
+    fn = mm.filename
+    del mm
+    try:
+        os.remove(fn)
+    except OSError:
+        pass  #still mapped on some platforms, left to the temp folder cleanup
+
+def _RowPool(numWorkers, useProcesses):
+    '''Worker pool for row partitioned distribution, None runs the blocks in the calling thread'''
+    if numWorkers <= 1:
+        return None
+    if useProcesses:
+        return multiprocessing.Pool(numWorkers)
+    return multiprocessing.pool.ThreadPool(numWorkers)
+
+def _ClosePool(pool):
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def _MapRowBlocks(ProdA, AttrA, F, Blocks, out = None, pool = None):
+    '''Runs _GravityRowBlock over all row blocks, serially or on a thread/process pool
+       Blocks are fixed by the caller and column sums are always accumulated in block order, so the
+       result does not depend on the number of workers. A process pool needs F and out as numpy.memmap
+       Returns row factors, computed productions and computed attractions for the full matrix
+    '''
+    if pool is None:
+        Results = [_GravityRowBlock(ProdA, AttrA, F, r0, r1, out) for r0, r1 in Blocks]
+    elif isinstance(pool, multiprocessing.pool.ThreadPool):
+        Results = pool.map(lambda b: _GravityRowBlock(ProdA, AttrA, F, b[0], b[1], out), Blocks)
+    else:
+        Fspec = _MapSpec(F, 'r')
+        OutSpec = _MapSpec(out, 'r+')
+        Results = pool.map(_SharedGravityRowBlock, [(ProdA, AttrA, Fspec, r0, r1, OutSpec) for r0, r1 in Blocks])
+    RowFac = np.zeros(len(ProdA))
+    ComputedProductions = np.zeros(len(ProdA))
+    ComputedAttractions = np.zeros(len(AttrA))
+    for (r0, r1), (BlockFac, BlockProductions, BlockAttractions) in zip(Blocks, Results):
+        RowFac[r0:r1] = BlockFac
+        ComputedProductions[r0:r1] = BlockProductions
+        ComputedAttractions+=BlockAttractions
+    return RowFac, ComputedProductions, ComputedAttractions
+
+def _RowBlocks(numZn, blockSize):
+    return [(r, min(r + blockSize, numZn)) for r in range(0, numZn, blockSize)]
+
+def BalanceFratar(ProdA, AttrA, Seed, maxIter = 100, tol = 0.0001, out = None, accel = 0):
+    '''Convergence driven Fratar/IPF balancing engine, works on row and column factor vectors and scales the seed only once
+       ProdA = Production target as array
+       AttrA = Attraction target as array (should be balanced to ProdA)
+       Seed = Seed trip table (float array), scaled in place when out is not given
+       maxIter (optional) = maximum iterations, default is 100
+       tol (optional) = stop when max relative row/column error falls below tol, default is 0.0001
+       out (optional) = preallocated array receiving the balanced table, Seed is then left untouched
+       accel (optional) = history depth of Anderson acceleration on the column factors, 0 = plain balancing (default)
+       Returns balanced trip table and diagnostics dict --> {'iterations':n, 'maxError':[...], 'elapsed':[...], 'fallbacks':n}
+    '''
+    start = time.time()
+    Diag = {'iterations':0, 'maxError':[], 'elapsed':[]}
+    Mixer = _AndersonMixer(accel)
+    OrigFac = np.ones(len(ProdA))
+    DestFac = np.ones(len(AttrA))
+    #Run 2D balancing on the factors, each pass is two matrix-vector products --->
+    for balIter in range(0, maxIter):
+        ComputedProductions = Seed.dot(DestFac)
+        RowError = _MaxRelError(OrigFac*ComputedProductions, ProdA)
+        ComputedProductions[ComputedProductions==0]=1
+        OrigFac = ProdA/ComputedProductions
+
+        ComputedAttractions = OrigFac.dot(Seed)
+        ColError = _MaxRelError(DestFac*ComputedAttractions, AttrA)
+        ComputedAttractions[ComputedAttractions==0]=1
+
+        Diag['iterations'] = balIter + 1
+        Diag['maxError'].append(max(RowError, ColError))
+        Diag['elapsed'].append(time.time() - start)
+        if max(RowError, ColError) < tol or balIter == maxIter - 1:
+            DestFac = AttrA/ComputedAttractions  #plain last step so the columns match exactly
+            break
+        DestFac = Mixer.Step(DestFac, AttrA/ComputedAttractions)
+    Diag['fallbacks'] = Mixer.fallbacks
+
+    if out is None:
+        out = Seed
+    np.multiply(Seed, OrigFac[:, np.newaxis], out=out)
+    out*=DestFac
+    return out, Diag
+
+def CalcFratar(ProdA, AttrA, Trips1, maxIter = 10, tol = 0.0, accel = 0):
     '''Calculates fratar trip distribution
        ProdA = Production target as array
        AttrA = Attraction target as array
        Trips1 = Seed trip table for fratar
        maxIter (optional) = maximum iterations, default is 10
+       tol (optional) = relative marginal error to stop at before maxIter, default is 0 (run all iterations)
+       accel (optional) = history depth of Anderson acceleration, 0 = plain balancing (default)
        Returns fratared trip table
     '''
     print 'Checking production, attraction balancing:'
@@ -55,17 +260,7 @@ def CalcFratar(ProdA, AttrA, Trips1, maxIter = 10):
         AttrA = AttrA*(sumP/sumA)
     else:
         print 'Production, attraction balancing OK.'
-    #Run 2D balancing --->
-    for balIter in range(0, maxIter):
-        ComputedProductions = Trips1.sum(1)
-        ComputedProductions[ComputedProductions==0]=1
-        OrigFac = (ProdA/ComputedProductions)
-        Trips1 = Trips1*OrigFac[:, np.newaxis]
-
-        ComputedAttractions = Trips1.sum(0)
-        ComputedAttractions[ComputedAttractions==0]=1
-        DestFac = (AttrA/ComputedAttractions)
-        Trips1 = Trips1*DestFac
+    Trips1, Diag = BalanceFratar(ProdA, AttrA, Trips1, maxIter, tol, np.empty(Trips1.shape), accel)
     return Trips1
 
 def CalcSinglyConstrained(ProdA, AttrA, F):
@@ -79,15 +274,20 @@ def CalcSinglyConstrained(ProdA, AttrA, F):
     SumAjFij[SumAjFij==0]=0.0001
     return ProdA*(AttrA*F).transpose()/SumAjFij
 
-def CalcDoublyConstrained(ProdA, AttrA, F, maxIter = 10):
+def CalcDoublyConstrained(ProdA, AttrA, F, maxIter = 10, numWorkers = 1, useProcesses = False, accel = 0, tol = 0.0, getDiagnostics = 0):
     '''Calculates doubly constrained trip distribution for a given friction factor matrix
     ProdA = Production array
     AttrA = Attraction array
     F = Friction factor matrix
     maxIter (optional) = maximum iterations, default is 10
+    numWorkers (optional) = number of threads/processes the origin rows are split across, default is 1
+    useProcesses (optional) = use a process pool sharing F through a memory-mapped file instead of threads, default is False
+    accel (optional) = history depth of Anderson acceleration on the attraction factors, 0 = plain balancing (default)
+    tol (optional) = stop when max relative error of the computed attractions falls below tol, default is 0 (run all iterations)
+    getDiagnostics (optional) 0=no, <>0=yes --> also return dict {'iterations':n, 'maxError':[...], 'elapsed':[...], 'fallbacks':n}
     Returns trip table
     '''
-    Trips1 = np.zeros((len(ProdA),len(ProdA)))
+    start = time.time()
     print 'Checking production, attraction balancing:'
     sumP = ProdA.sum()
     sumA = AttrA.sum()
@@ -103,66 +303,308 @@ def CalcDoublyConstrained(ProdA, AttrA, F, maxIter = 10):
         AttrT = AttrA.copy()
         ProdT = ProdA.copy()
 
+    Blocks = _RowBlocks(len(ProdA), _ROW_BLOCK)
+    pool = _RowPool(numWorkers, useProcesses)
+    SharedF = None
+    if useProcesses and pool is not None:
+        if _FileOffset(F) is None:  #arrays and memmap views that can not be mapped by offset are copied
+            F = SharedF = _SharedMap(F.shape, F)
+        Trips1 = _SharedMap((len(ProdA),len(ProdA)))
+    else:
+        Trips1 = np.zeros((len(ProdA),len(ProdA)))
+
+    Diag = {'iterations':0, 'maxError':[], 'elapsed':[]}
+    Mixer = _AndersonMixer(accel)
     for balIter in range(0, maxIter):
-        for i in range(0, len(ProdA)):
-            Trips1[i,:] = ProdA[i]*AttrA*F[i,:]/max(0.000001, np.sum(AttrA * F[i,:]))
+        #Rows are independent, only the marginals are needed for balancing --->
+        RowFac, ComputedProductions, ComputedAttractions = _MapRowBlocks(ProdA, AttrA, F, Blocks, pool=pool)
+        Diag['maxError'].append(_MaxRelError(ComputedAttractions, AttrT))
+        Diag['elapsed'].append(time.time() - start)
+        if Diag['maxError'][-1] < tol:
+            break
+        Diag['iterations'] = balIter + 1
 
         #Run 2D balancing --->
-        ComputedAttractions = Trips1.sum(0)
         ComputedAttractions[ComputedAttractions==0]=1
-        AttrA = AttrA*(AttrT/ComputedAttractions)
+        AttrA = Mixer.Step(AttrA, AttrA*(AttrT/ComputedAttractions))
 
-        ComputedProductions = Trips1.sum(1)
         ComputedProductions[ComputedProductions==0]=1
         ProdA = ProdA*(ProdT/ComputedProductions)
 
-    for i in range(0,len(ProdA)):
-            Trips1[i,:] = ProdA[i]*AttrA*F[i,:]/max(0.000001, sum(AttrA * F[i,:]))
-
-    return Trips1
+    _MapRowBlocks(ProdA, AttrA, F, Blocks, Trips1, pool)
+    _ClosePool(pool)
+    if SharedF is not None:
+        _ReleaseMap(SharedF)
+    if isinstance(Trips1, np.memmap):
+        SharedTrips = Trips1
+        Trips1 = np.array(SharedTrips)
+        _ReleaseMap(SharedTrips)
+    Diag['fallbacks'] = Mixer.fallbacks
+    if getDiagnostics == 0:
+        return Trips1
+    else:
+        return Trips1, Diag
 
-def CalcGravityShadow(ProdA, AttrA, F, maxIter = 10):
+def CalcGravityShadow(ProdA, AttrA, F, maxIter = 10, numWorkers = 1, useProcesses = False, accel = 0, tol = 0.0, getDiagnostics = 0):
     '''Calculates doubly constrained trip distribution for a given friction factor matrix,
     uses shadow pricing at attraction end
     ProdA = Production array
     AttrA = Attraction array (Target attractions)
     F = Friction factor matrix
     maxIter (optional) = maximum iterations, default is 10
+    numWorkers (optional) = number of threads/processes the origin rows are split across, default is 1
+    useProcesses (optional) = use a process pool sharing F through a memory-mapped file instead of threads, default is False
+    accel (optional) = history depth of Anderson acceleration on the shadow prices, 0 = plain balancing (default)
+    tol (optional) = stop when max relative error of the computed attractions falls below tol, default is 0 (run all iterations)
+    getDiagnostics (optional) 0=no, <>0=yes --> also return dict {'iterations':n, 'maxError':[...], 'elapsed':[...], 'fallbacks':n}
     Returns trip table
     '''
-    T = np.zeros(F.shape)
+    start = time.time()
     AttrA = AttrA*ProdA.sum() / AttrA.sum()  #in case P and A totals don't match - balance A to P
     AttrA[AttrA<0.000001] = 0.0001 #avoid divide by zero
     Attr = AttrA.copy()
     F[F<0.000001] = 0.0001
 
-    for k in range(maxIter):
-        if k > 0:
-            A_calc = T.sum(0)
-            print('A_calc:' + str(A_calc))
-            Attr = Attr * AttrA / A_calc
+    Blocks = _RowBlocks(ProdA.shape[0], _ROW_BLOCK)
+    pool = _RowPool(numWorkers, useProcesses)
+    SharedF = None
+    if useProcesses and pool is not None:
+        if _FileOffset(F) is None:  #arrays and memmap views that can not be mapped by offset are copied
+            F = SharedF = _SharedMap(F.shape, F)
+        T = _SharedMap(F.shape)
+    else:
+        T = np.zeros(F.shape)
 
-        for i in range(ProdA.shape[0]):
-            T[i,:] = ProdA[i] * Attr * F[i, :] / (Attr * F[i, :]).sum()
+    Diag = {'iterations':0, 'maxError':[], 'elapsed':[]}
+    Mixer = _AndersonMixer(accel)
+    for k in range(1, maxIter):
+        RowFac, P_calc, A_calc = _MapRowBlocks(ProdA, Attr, F, Blocks, pool=pool)
+        print('A_calc:' + str(A_calc))
+        Diag['maxError'].append(_MaxRelError(A_calc, AttrA))
+        Diag['elapsed'].append(time.time() - start)
+        if Diag['maxError'][-1] < tol:
+            break
+        Diag['iterations'] = k
+        Attr = Mixer.Step(Attr, Attr * AttrA / A_calc)
 
-    return T
+    if maxIter > 0:
+        _MapRowBlocks(ProdA, Attr, F, Blocks, T, pool)
+    _ClosePool(pool)
+    if SharedF is not None:
+        _ReleaseMap(SharedF)
+    if isinstance(T, np.memmap):
+        SharedT = T
+        T = np.array(SharedT)
+        _ReleaseMap(SharedT)
+    Diag['fallbacks'] = Mixer.fallbacks
+    if getDiagnostics == 0:
+        return T
+    else:
+        return T, Diag
 
-def CalcGravity(P, A, F, maxIter=10):
+def CalcGravity(P, A, F, maxIter=10, accel = 0, tol = 0.0, getDiagnostics = 0):
     '''A more vectorized verion of doubly constrinaed gravity model
     P = Array of zone Productions
     A = Array of zone Attractions | also Target attractions
     F = Friction factor or transformed utility matrix
+    accel (optional) = history depth of Anderson acceleration on the attraction factors, 0 = plain balancing (default)
+    tol (optional) = stop when max relative error of the computed attractions falls below tol, default is 0 (run all iterations)
+    getDiagnostics (optional) 0=no, <>0=yes --> also return dict {'iterations':n, 'maxError':[...], 'elapsed':[...], 'fallbacks':n}
     '''
+    start = time.time()
+    Diag = {'iterations':0, 'maxError':[], 'elapsed':[]}
+    Mixer = _AndersonMixer(accel)
+    W = np.ones(len(A))  #accumulated attraction factors, same as scaling the columns of F
     T = A*F*P[:, np.newaxis]/np.maximum(np.sum(A*F, axis=1), 0.00001)[:, np.newaxis]
     for i in range(maxIter):
         cA = T.sum(0) #sum of calculated attractions
+        Diag['maxError'].append(_MaxRelError(cA, A))
+        Diag['elapsed'].append(time.time() - start)
+        if Diag['maxError'][-1] < tol:
+            break
+        Diag['iterations'] = i + 1
         factor = np.where(A > 0, A/cA, 0)
-        F = factor*F
-        T = A*F*P[:, np.newaxis]/np.maximum(np.sum(A*F, axis=1), 0.00001)[:, np.newaxis]
+        W = Mixer.Step(W, factor*W)
+        AW = A*W
+        T = AW*F*P[:, np.newaxis]/np.maximum(F.dot(AW), 0.00001)[:, np.newaxis]
     cA = T.sum(0)
     diff = np.absolute(A - cA).max()  #maximum absolute difference between target and calculated
     print ('final max abs diff: {}'.format(diff))
-    return T
+    Diag['fallbacks'] = Mixer.fallbacks
+    if getDiagnostics == 0:
+        return T
+    else:
+        return T, Diag
+
+def CalcGravityBlocked(ProdA, AttrA, F, maxIter = 10, blockSize = 1000, tol = 0.0, out = None, numWorkers = 1, useProcesses = False, accel = 0):
+    '''Out-of-core doubly constrained gravity model, streams F by blocks of origin rows and writes the trip table block by block
+    ProdA = Production array
+    AttrA = Attraction array (target attractions, scaled to productions if they do not balance)
+    F = Friction factor matrix, numpy.memmap or array, or file name of a raw float64 matrix (see CalcLogitChoice.PushMatrix)
+    maxIter (optional) = maximum balancing iterations, default is 10
+    blockSize (optional) = number of origin rows held in memory at once, default is 1000
+    tol (optional) = stop when max relative error of the computed attractions falls below tol, default is 0 (run all iterations)
+    out (optional) = array/numpy.memmap or file name the trip table is written to, default is a new in memory array
+    numWorkers (optional) = number of threads/processes the row blocks are split across, default is 1
+    useProcesses (optional) = use a process pool attached to the memory-mapped F instead of threads, default is False
+    accel (optional) = history depth of Anderson acceleration on the attraction factors, 0 = plain balancing (default)
+    Returns trip table and diagnostics dict --> {'iterations':n, 'maxError':[...], 'elapsed':[...], 'fallbacks':n}
+    '''
+    start = time.time()
+    Diag = {'iterations':0, 'maxError':[], 'elapsed':[]}
+    Mixer = _AndersonMixer(accel)
+    numZn = len(ProdA)
+    if isinstance(F, str):
+        F = np.memmap(F, dtype='d', mode='r', shape=(numZn, numZn))
+    if isinstance(out, str):
+        out = np.memmap(out, dtype='d', mode='w+', shape=(numZn, numZn))
+    elif out is None:
+        out = np.zeros((numZn, numZn))
+    Blocks = _RowBlocks(numZn, blockSize)
+    pool = _RowPool(numWorkers, useProcesses)
+    Shared = []
+    if useProcesses and pool is not None:
+        if _FileOffset(F) is None:  #arrays and memmap views that can not be mapped by offset are copied
+            F = _SharedMap(F.shape, F)
+            Shared.append(F)
+        if _FileOffset(out) is None:
+            Shared.append(_SharedMap(out.shape))
+
+    ProdT = ProdA.copy()
+    AttrT = AttrA*(ProdA.sum()/AttrA.sum())  #in case P and A totals don't match - balance A to P
+    ProdOp = ProdT.copy()
+    AttrOp = AttrT.copy()
+    #Balancing only needs the factors and marginals, one pass over F per iteration --->
+    for balIter in range(0, maxIter):
+        RowFac, ComputedProductions, ComputedAttractions = _MapRowBlocks(ProdOp, AttrOp, F, Blocks, pool=pool)
+        Diag['maxError'].append(_MaxRelError(ComputedAttractions, AttrT))
+        Diag['elapsed'].append(time.time() - start)
+        if Diag['maxError'][-1] < tol:
+            break
+        ComputedAttractions[ComputedAttractions==0]=1
+        AttrOp = Mixer.Step(AttrOp, AttrOp*(AttrT/ComputedAttractions))
+        ComputedProductions[ComputedProductions==0]=1
+        ProdOp = ProdOp*(ProdT/ComputedProductions)
+        Diag['iterations'] = balIter + 1
+    Diag['fallbacks'] = Mixer.fallbacks
+
+    #Final pass writes the trip table block by block --->
+    if useProcesses and pool is not None and _FileOffset(out) is None:
+        _MapRowBlocks(ProdOp, AttrOp, F, Blocks, Shared[-1], pool)
+        out[:] = Shared[-1]
+    else:
+        _MapRowBlocks(ProdOp, AttrOp, F, Blocks, out, pool)
+    _ClosePool(pool)
+    for mm in Shared:
+        _ReleaseMap(mm)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out, Diag
+
+def _SquareMatrix(ref, numZn, mode = 'r'):
+    '''(numZn, numZn) matrix for row block access: a file name is memory mapped as a raw float64 matrix (mode 'w+' creates it),
+    None is a new in memory array, arrays and numpy.memmap are used as is
+    '''
+    if isinstance(ref, str):
+        return np.memmap(ref, dtype='d', mode=mode, shape=(numZn, numZn))
+    elif ref is None:
+        return np.zeros((numZn, numZn))
+    return ref
+
+def _IterModeDestBlocks(TreeDefn, MatRefs, numZn, blockSize, coef, DestU, Fric, cached):
+    '''Yields (r0, r1, F, ProbMats) for every block of origin rows, F = exp(coef*lnSum + DestU) from the mode choice log sum
+    Fric (optional) = friction matrix, written while the mode choice is evaluated, read back instead if cached (ProbMats is then None)
+    '''
+    if cached:
+        for r0, r1 in _RowBlocks(numZn, blockSize):
+            yield r0, r1, Fric[r0:r1], None
+        return
+    for r0, r1, ProbMats, lnSum in CalcLogitChoice.IterNestedChoice(TreeDefn, MatRefs, numZn, blockSize, 1):
+        lnSum *= coef #---> log sum is a new array for every block, turned into the friction in place
+        if DestU is not None:
+            lnSum += DestU[r0:r1]
+        np.exp(lnSum, out=lnSum)
+        if Fric is not None:
+            Fric[r0:r1] = lnSum
+        yield r0, r1, lnSum, ProbMats
+
+def CalcModeDestinationBlocked(ProdA, AttrA, TreeDefn, MatRefs, coef = 1.0, DestU = None, maxIter = 10, blockSize = 500, tol = 0.0,
+                               out = None, frictionOut = None, accel = 0, recompute = 0):
+    '''Fused mode and destination choice over blocks of origin rows: the nested mode choice log sum of a block is turned into the
+    destination friction F = exp(coef*lnSum + DestU), the doubly constrained gravity model is balanced on it and the final pass
+    splits the trips of the block by mode with its mode probabilities, no full (numZn, numZn) intermediate is held in memory
+    ProdA = Production array
+    AttrA = Attraction array (target attractions, scaled to productions if they do not balance)
+    TreeDefn = mode choice tree definition, see CalcLogitChoice.CalcNestedChoice
+    MatRefs = mode utilities, see CalcLogitChoice.IterNestedChoice (arrays, numpy.memmap or raw matrix file names)
+    coef (optional) = coefficient of the mode choice log sum in the destination utility, default is 1.0
+    DestU (optional) = other destination utility terms as (numZn, numZn) array, numpy.memmap or raw matrix file name
+    maxIter, blockSize, tol, accel (optional) = see CalcGravityBlocked
+    out (optional) = dictionary of alternative code -> array, numpy.memmap or file name the trips of that mode are written to,
+                     default is a new in memory array for every alternative of the tree
+    frictionOut (optional) = array, numpy.memmap or file name to keep the friction in, later balancing passes stream it instead of
+                     evaluating the mode choice again, default is a temporary file that is removed on return
+    recompute (optional, evaluate the mode choice on every balancing pass instead of keeping the friction) 0=no, <>0=yes
+    Returns dictionary of trip tables by mode and diagnostics dict --> {'iterations':n, 'maxError':[...], 'elapsed':[...],
+    'fallbacks':n, 'choicePasses':n}
+    '''
+    start = time.time()
+    Diag = {'iterations':0, 'maxError':[], 'elapsed':[], 'choicePasses':0}
+    Mixer = _AndersonMixer(accel)
+    numZn = len(ProdA)
+    if out is None:
+        NestCodes = set(key[1] for key in TreeDefn.keys())
+        out = dict((code, None) for key in TreeDefn.keys() for code in TreeDefn[key][1] if code not in NestCodes)
+    Trips = dict((code, _SquareMatrix(out[code], numZn, 'w+')) for code in out.keys())
+    TempFric = None
+    if frictionOut is not None:
+        Fric = _SquareMatrix(frictionOut, numZn, 'w+')
+    elif recompute == 0 and maxIter > 1:
+        Fric = TempFric = _SharedMap((numZn, numZn), shm=False)  #on disk, it is as big as a trip table
+    else:
+        Fric = None
+    if isinstance(DestU, str):
+        DestU = _SquareMatrix(DestU, numZn)
+    try:
+        ProdT = ProdA.copy()
+        AttrT = AttrA*(ProdA.sum()/AttrA.sum())  #in case P and A totals don't match - balance A to P
+        ProdOp = ProdT.copy()
+        AttrOp = AttrT.copy()
+        #Balancing only needs the factors and marginals, one pass over the blocks per iteration --->
+        for balIter in range(0, maxIter):
+            cached = Fric is not None and recompute == 0 and balIter > 0
+            ComputedProductions = np.zeros(numZn)
+            ComputedAttractions = np.zeros(numZn)
+            for r0, r1, F, ProbMats in _IterModeDestBlocks(TreeDefn, MatRefs, numZn, blockSize, coef, DestU, Fric, cached):
+                RowFac, ComputedProductions[r0:r1], cA = _GravityRowBlock(ProdOp[r0:r1], AttrOp, F, 0, r1 - r0)
+                ComputedAttractions += cA
+            Diag['choicePasses'] += 0 if cached else 1
+            Diag['maxError'].append(_MaxRelError(ComputedAttractions, AttrT))
+            Diag['elapsed'].append(time.time() - start)
+            if Diag['maxError'][-1] < tol:
+                break
+            ComputedAttractions[ComputedAttractions==0]=1
+            AttrOp = Mixer.Step(AttrOp, AttrOp*(AttrT/ComputedAttractions))
+            ComputedProductions[ComputedProductions==0]=1
+            ProdOp = ProdOp*(ProdT/ComputedProductions)
+            Diag['iterations'] = balIter + 1
+        Diag['fallbacks'] = Mixer.fallbacks
+
+        #Final pass needs the mode probabilities, so the mode choice is evaluated once more and the trips are split block by block --->
+        TBlock = np.empty((min(blockSize, numZn), numZn))
+        for r0, r1, F, ProbMats in _IterModeDestBlocks(TreeDefn, MatRefs, numZn, blockSize, coef, DestU, None, False):
+            _GravityRowBlock(ProdOp[r0:r1], AttrOp, F, 0, r1 - r0, TBlock)
+            for code in Trips.keys():
+                np.multiply(TBlock[:r1-r0], ProbMats[code], out=Trips[code][r0:r1])
+        Diag['choicePasses'] += 1
+        for mat in list(Trips.values()) + [Fric if TempFric is None else None]:
+            if isinstance(mat, np.memmap):
+                mat.flush()
+    finally:
+        if TempFric is not None:
+            Fric = None
+            _ReleaseMap(TempFric)
+    return Trips, Diag
 
 def CalcMultiFratar(Prods, Attr, TripMatrices, maxIter=10):
     '''Applies fratar model to given set of trip matrices with target productions and one attraction vector
@@ -195,34 +637,66 @@ def CalcMultiFratar(Prods, Attr, TripMatrices, maxIter=10):
 
     return TripMatrices
 
-def CalcMultiDistribute(Prods, Attr, FricMatrices, maxIter = 10):
-    '''Prods = List of Production Attributes
-       Attr  = Attraction Attribute
-       FricMatrices = N-Dim array of friction matrices corresponding to ProdAtts --> (numFrictionMats, numZones, numZones)
+def _MultiRowFactors(ProdOp, AttrOp, FricMatrices, Chunks):
+    '''Row factors P[k,i]/sum_j(A[j]*F[k,i,j]) for all segments and the attractions they produce, one chunk of segments at a time'''
+    numFricMats, numZones = ProdOp.shape
+    RowFac = np.zeros((numFricMats, numZones))
+    ComputedAttractions = np.zeros(numZones)
+    for k0, k1 in Chunks:
+        Fc = FricMatrices[k0:k1].reshape(-1, numZones)  #stack segment rows so each pass is one matrix-vector product
+        Denom = Fc.dot(AttrOp).reshape(k1 - k0, numZones)
+        RowFac[k0:k1] = ProdOp[k0:k1]/np.maximum(Denom, 0.000001)
+        ComputedAttractions+=RowFac[k0:k1].ravel().dot(Fc)
+    return RowFac, ComputedAttractions*AttrOp
+
+def CalcMultiDistributeBatch(Prods, Attr, FricMatrices, maxIter = 10, tol = 0.0, chunkSize = None, out = None):
+    '''Batched gravity model that distributes all production segments at once over the (segments, zones, zones) stack
+       Prods = Array of Productions --> (numZones, numFrictionMats)
+       Attr  = Target attraction array (one attraction segment)
+       FricMatrices = N-Dim array of friction matrices corresponding to Prods --> (numFrictionMats, numZones, numZones), can be a numpy.memmap
        maxIter (optional) = Maximum number of balancing iterations, default is 10
-       Returns N-Dim array of trip matrices corresponding to each production segment
+       tol (optional) = stop when max relative error of the computed attractions falls below tol, default is 0 (run all iterations)
+       chunkSize (optional) = number of segments handled per vectorized pass to bound memory, default is all segments
+       out (optional) = preallocated (numFrictionMats, numZones, numZones) array receiving the trip matrices
+       Returns N-Dim array of trip matrices and diagnostics dict --> {'iterations':n, 'maxError':[...], 'elapsed':[...]}
     '''
-    numZones = len(Attr)
-    TripMatrices = np.zeros(FricMatrices.shape)
+    start = time.time()
+    Diag = {'iterations':0, 'maxError':[], 'elapsed':[]}
     numFricMats = len(FricMatrices)
+    if chunkSize is None:
+        chunkSize = numFricMats
+    Chunks = [(k, min(k + chunkSize, numFricMats)) for k in range(0, numFricMats, chunkSize)]
 
-    ProdOp = Prods.copy()
+    ProdOp = np.where(Prods > 0, Prods, 0).transpose()  #(segments, zones), zones without productions get no trips
     AttrOp = Attr.copy()
-    #Initial trip distribution --->
-    for k in range(0, numFricMats):
-        for i in range(0, numZones):
-            if ProdOp[i, k] > 0:
-                TripMatrices[k, i, :] = ProdOp[i, k] * AttrOp * FricMatrices[k, i, :] / max(0.000001, np.sum(AttrOp * FricMatrices[k, i, :]))
+    #Initial trip distribution, trips are only materialized once at the end --->
+    RowFac, ComputedAttractions = _MultiRowFactors(ProdOp, AttrOp, FricMatrices, Chunks)
 
     for Iter in range(0, maxIter):
+        Diag['maxError'].append(_MaxRelError(ComputedAttractions, Attr))
+        Diag['elapsed'].append(time.time() - start)
+        if Diag['maxError'][-1] < tol:
+            break
         #Balancing --->
-        ComputedAttractions = TripMatrices.sum(1).sum(0)
         ComputedAttractions[ComputedAttractions==0]=1
         AttrOp = AttrOp*(Attr/ComputedAttractions)
         #Distribution --->
-        for k in range(0, numFricMats):
-            for i in range(0, numZones):
-                if ProdOp[i, k] > 0:
-                    TripMatrices[k, i, :] = ProdOp[i, k] * AttrOp * FricMatrices[k, i, :] / max(0.000001, np.sum(AttrOp * FricMatrices[k, i, :]))
+        RowFac, ComputedAttractions = _MultiRowFactors(ProdOp, AttrOp, FricMatrices, Chunks)
+        Diag['iterations'] = Iter + 1
+
+    if out is None:
+        out = np.zeros(FricMatrices.shape)
+    for k0, k1 in Chunks:
+        np.multiply(FricMatrices[k0:k1], AttrOp, out=out[k0:k1])
+        out[k0:k1]*=RowFac[k0:k1, :, np.newaxis]
+    return out, Diag
 
+def CalcMultiDistribute(Prods, Attr, FricMatrices, maxIter = 10):
+    '''Prods = List of Production Attributes
+       Attr  = Attraction Attribute
+       FricMatrices = N-Dim array of friction matrices corresponding to ProdAtts --> (numFrictionMats, numZones, numZones)
+       maxIter (optional) = Maximum number of balancing iterations, default is 10
+       Returns N-Dim array of trip matrices corresponding to each production segment
+    '''
+    TripMatrices, Diag = CalcMultiDistributeBatch(Prods, Attr, FricMatrices, maxIter)
     return TripMatrices
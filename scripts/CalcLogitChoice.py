@@ -2,13 +2,19 @@
 # Name:        CalcLogitChoice
 # Purpose:     Utilities for various calculations of different types of choice models.
 #               a) CalcMultinomialChoice : Calculates a multinomial choice model probability given a dictionary of mode utilities 
+#                  CalcMultinomialChoiceBatch : multinomial choice for stacked (segments, modes, ...) utilities, thread parallel over segments
 #               b) CalcPivotPoint : Calculates pivot point choice probability given base utilities, current utilities and base proabilities
+#                  PivotBase / CalcPivotPointSparse : pivot point for sparse utility deltas with cached base probabilities
 #               c) CalcNestedChoice : Calculates n-level nested mode choice probabilities given dictionary with tree definition, matrix references and number of zones
 #               d) CalcNestedChoiceFlat : Calculate nested choice on flat array so it can be used for stuff like microsim ABM etc... e) can in general be easily modified for this 
+#                  CompileTree / CalcNestedChoice2D : tree compiled once to an array plan, evaluated on (records, alternatives) arrays
+#               e) IterNestedChoice / CalcNestedChoiceBlocked : nested choice over blocks of origin rows, utilities and results can be memory mapped
+#               f) CalcMultinomialChoiceBlocked : multinomial choice over blocks of origin rows, as a one nest tree
+#               g) SimulateChoice : Monte Carlo choice of one alternative per record, reproducible per chunk random streams
 #              **All input vectors are expected to be numpy arrays  
 #               
 # Author:      Chetan Joshi, Portland OR
-# Dependencies:numpy [www.numpy.org], math, time 
+# Dependencies:numpy [www.numpy.org], math, time, copy, multiprocessing 
 # Created:     5/14/2015
 #              
 # Copyright:   (c) Chetan Joshi 2015
@@ -31,8 +37,10 @@
 #              SOFTWARE.
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------------#
 import numpy
+import copy
 import time
 import math
+import multiprocessing.pool
 #from memory_profiler import profile
 
 
@@ -61,6 +69,63 @@ def CalcMultinomialChoice(Utils, getLogSumAccess = 0):
     else:
         return Probs, lnSumAccess
 
+def _MultinomialSegment(args):
+    U, P, lnSum = args
+    maxU = numpy.maximum.reduce(U, axis=0)
+    info = numpy.finfo(P.dtype)
+    lo, hi = math.log(info.tiny) + 1, math.log(info.max) - math.log(len(U)) - 1
+    if maxU.size and lo < maxU.min() and maxU.max() < hi: #exp and the sum can not overflow or underflow for a whole cell, no shift needed
+        numpy.exp(U, out=P)
+        maxU = None
+    else:
+        numpy.subtract(U, maxU, out=P)
+        numpy.exp(P, out=P)
+    Dead = None
+    if maxU is not None and maxU.size and maxU.min() < _EXP_UNDERFLOW: #exp(U) is 0 for every mode, probabilities are 0 as in CalcMultinomialChoice
+        Dead = maxU < _EXP_UNDERFLOW
+        P[:, Dead] = 0 #U - maxU is nan where every mode is -inf
+    eU_total = numpy.add.reduce(P, axis=0)
+    if Dead is not None:
+        eU_total[Dead] = 1
+    if lnSum is not None:
+        numpy.log(eU_total, out=lnSum)
+        if maxU is not None:
+            lnSum += maxU
+        if Dead is not None:
+            lnSum[Dead] = -numpy.inf
+    numpy.divide(1.0, eU_total, out=eU_total)
+    P *= eU_total
+
+def CalcMultinomialChoiceBatch(U, getLogSumAccess = 0, numWorkers = 1, out = None):
+    '''Multinomial choice for many market segments with the same modes in one call
+    U = utilities (segments, modes, ...) e.g. (segments, modes, numZn, numZn) or (segments, modes, n)
+    getLogSumAccess (optional, accessibility log sum) 0=no, <>0=yes --> also return log sums (segments, ...)
+    numWorkers (optional) = number of threads, segments are calculated in parallel if > 1
+    out (optional) = preallocated probability array shaped like U (e.g. numpy.memmap), default is a new array
+    Utilities are shifted by their max where exp could overflow or underflow (stable log sum), the only work arrays are two
+    per segment in the works
+    Returns probabilities (segments, modes, ...) and the log sums if asked for
+    '''
+    U = numpy.asarray(U)
+    dtype = numpy.result_type(numpy.float32, U)
+    P = out if out is not None else numpy.empty(U.shape, dtype)
+    lnSum = numpy.empty(U.shape[:1] + U.shape[2:], dtype) if getLogSumAccess != 0 else None
+    Segments = [(U[i], P[i], lnSum[i] if lnSum is not None else None) for i in range(U.shape[0])]
+    if numWorkers > 1 and len(Segments) > 1:
+        pool = multiprocessing.pool.ThreadPool(numWorkers)
+        try:
+            pool.map(_MultinomialSegment, Segments)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in Segments:
+            _MultinomialSegment(args)
+    if getLogSumAccess == 0:
+        return P
+    else:
+        return P, lnSum
+
 def CalcPivotPoint(Utils, Po):
     '''
        Utils = Updated delta utility matrices in a dictionary i.e delta of Uk (k = mode)
@@ -83,8 +148,155 @@ def CalcPivotPoint(Utils, Po):
     del PeU, PeU_total, Utils
     return Probs
 
+_LNSUM_DEAD = -999.0 #logsum of a nest with no available alternative
+_EXP_UNDERFLOW = math.log(numpy.finfo(numpy.float64).tiny*numpy.finfo(numpy.float64).eps) #exp() of anything below is 0.0 in float64
+
+def _TreeOrder(TreeDefn):
+    '''Returns nests bottom up (as CalcNestedChoice walks the tree) and the parent code of every node'''
+    Parent = {}
+    for key in TreeDefn.keys():
+        for code in TreeDefn[key][1]:
+            Parent[code] = key[1]
+    return sorted(TreeDefn.keys(), reverse= True), Parent
+
+def _ResultType(TreeDefn, MatRefs, Parent):
+    '''float32 if all utilities are float32, else float64'''
+    NestCodes = set(key[1] for key in TreeDefn.keys())
+    return numpy.result_type(numpy.float32, *[MatRefs[code] for code in Parent.keys() if code not in NestCodes])
+
+def _NestedChoice(TreeDefn, MatRefs, shape, getLogSumAccess = 0, dtype = None, out = None):
+    '''Nested choice engine for CalcNestedChoice and CalcNestedChoiceFlat, MatRefs are not changed
+    Every utility is exponentiated once (shifted by the max of its nest, so the log sum is stable) straight into its output
+    array; a nest's log sum is kept in its own output array until its parent uses it, so the only other arrays are two work
+    arrays (and the log sum if asked for)
+    shape = shape of the utility arrays
+    dtype (optional) = float type of the results, default float32 if all utilities are float32, else float64
+    out (optional) = dictionary of preallocated probability arrays by alternative/nest code, e.g. memory mapped files
+    '''
+    Nests, Parent = _TreeOrder(TreeDefn)
+    NestCodes = set(key[1] for key in Nests)
+    if dtype is None:
+        dtype = _ResultType(TreeDefn, MatRefs, Parent)
+    out = out or {}
+    ProbMats = dict(zip(MatRefs.keys(), numpy.zeros(len(MatRefs.keys()))))
+    ProbMats['ROOT'] = 1.0
+    for code in Parent.keys():
+        ProbMats[code] = out[code] if code in out else numpy.empty(shape, dtype)
+    maxU = numpy.empty(shape, dtype)
+    sumExp = numpy.empty(shape, dtype)
+    lnSumAccess = None
+
+    #Utility calculator going up...
+    for key in Nests:
+        theta = TreeDefn[key][0]
+        sublevelmat_codes = TreeDefn[key][1]
+        Utils = [ProbMats[code] if code in NestCodes else MatRefs[code] for code in sublevelmat_codes] #nests hold their log sum
+        maxU[...] = Utils[0]
+        for U in Utils[1:]:
+            numpy.maximum(maxU, U, out=maxU)
+        maxU /= theta #---> scale the utility, max(U)/theta = max(U/theta) as theta > 0
+        sumExp.fill(0)
+        for code, U in zip(sublevelmat_codes, Utils):
+            eU = ProbMats[code]
+            numpy.divide(U, theta, out=eU)
+            eU -= maxU
+            numpy.exp(eU, out=eU)
+            sumExp += eU
+        Dead = maxU < _EXP_UNDERFLOW #no available alternative, i.e. exp(U) is 0 for all of them
+        if Dead.any():
+            for code in sublevelmat_codes:
+                ProbMats[code][Dead] = 0
+            sumExp[Dead] = 1
+        else:
+            Dead = None
+
+        if key[1] != 'ROOT' or getLogSumAccess != 0:
+            lnSum = ProbMats[key[1]] if key[1] != 'ROOT' else numpy.empty(shape, dtype)
+            numpy.log(sumExp, out=lnSum)
+            lnSum += maxU
+            if Dead is not None:
+                lnSum[Dead] = _LNSUM_DEAD
+            lnSum *= theta #---> Get ln sum of sublevel
+            if key[1] == 'ROOT':
+                lnSumAccess = lnSum
+
+        #conditional probabilities, the last alternative gets the rest...
+        maxU.fill(0)
+        for code in sublevelmat_codes[:-1]:
+            ProbMats[code] /= sumExp
+            maxU += ProbMats[code]
+        numpy.subtract(1.0, maxU, out=ProbMats[sublevelmat_codes[-1]])
+
+    #Probability going down...
+    for key in reversed(Nests):
+        if key[1] != 'ROOT':
+            for code in TreeDefn[key][1]:
+                ProbMats[code] *= ProbMats[key[1]]
+
+    if getLogSumAccess == 0:
+        return ProbMats
+    else:
+        return ProbMats, lnSumAccess
+
+def PivotBase(Po):
+    '''Caches base probabilities for CalcPivotPointSparse, can be reused for any number of scenarios
+    Po = Base probabilities in a dictionary, see CalcPivotPoint
+    Returns base dictionary with the normalized flat base probabilities
+    '''
+    keys = sorted(Po.keys())
+    shape = numpy.shape(Po[keys[0]])
+    Flat = dict((key, numpy.asarray(Po[key], dtype='d').ravel()) for key in keys)
+    total = numpy.zeros(Flat[keys[0]].shape)
+    for key in keys:
+        total += Flat[key]
+    total[total == 0] = 0.0001
+    P = dict((key, Flat[key]/total) for key in keys)
+    return {'keys':keys, 'shape':shape, 'P':P, 'work':None, 'lastCells':numpy.zeros(0, dtype=numpy.intp)}
+
+def _DeltaCells(delta, shape):
+    '''flat cell indices and values of a sparse delta: scipy.sparse matrix or (flat index, value) pair'''
+    if hasattr(delta, 'tocoo'):
+        delta = delta.tocoo()
+        return numpy.ravel_multi_index((delta.row, delta.col), shape), delta.data
+    return numpy.asarray(delta[0], dtype=numpy.intp), numpy.asarray(delta[1], dtype='d')
+
+def CalcPivotPointSparse(Base, Deltas, getFull = 0):
+    '''Pivot point choice (see CalcPivotPoint) for scenarios that change utilities of a few OD cells only, the work is
+    proportional to the number of changed cells
+    Base = cached base probabilities, see PivotBase
+    Deltas = dictionary of sparse delta utilities by mode, scipy.sparse matrices or (flat cell index, value) pairs;
+             modes not in Deltas have no change
+    getFull (optional) 0=no, <>0=yes --> also return full probability matrices; these are work arrays in Base that are
+             updated only at the cells of the previous and this scenario, copy them to keep them
+    Returns changed flat cells, dictionary of probabilities at those cells by mode (and the full matrices)
+    '''
+    keys, shape = Base['keys'], Base['shape']
+    Pairs = dict((key, _DeltaCells(Deltas[key], shape)) for key in Deltas.keys())
+    Cells = numpy.unique(numpy.concatenate([numpy.zeros(0, dtype=numpy.intp)] + [cells for cells, values in Pairs.values()]))
+    PeU = {}
+    PeU_total = numpy.zeros(len(Cells))
+    for key in keys:
+        PeU[key] = Base['P'][key][Cells]
+        if key in Pairs:
+            cells, values = Pairs[key]
+            PeU[key] *= numpy.exp(numpy.bincount(numpy.searchsorted(Cells, cells), values, minlength=len(Cells)))
+        PeU_total += PeU[key]
+    PeU_total[PeU_total == 0] = 0.0001
+    Probs = dict((key, PeU[key]/PeU_total) for key in keys)
+    if getFull == 0:
+        return Cells, Probs
+
+    if Base['work'] is None:
+        Base['work'] = dict((key, Base['P'][key].copy()) for key in keys)
+    for key in keys:
+        Work = Base['work'][key]
+        Work[Base['lastCells']] = Base['P'][key][Base['lastCells']] #back to base where the last scenario changed
+        Work[Cells] = Probs[key]
+    Base['lastCells'] = Cells
+    return Cells, Probs, dict((key, Base['work'][key].reshape(shape)) for key in keys)
+
 #@profile
-def CalcNestedChoice(TreeDefn, MatRefs, numZn, getLogSumAccess = 0):
+def CalcNestedChoice(TreeDefn, MatRefs, numZn, getLogSumAccess = 0, dtype = None, out = None):
     '''
     #TreeDefn = {(0,'ROOT'):[1.0,['AU', 'TR', 'AC']],
     #            (1,'AU'):[0.992,['CD', 'CP']],
@@ -109,59 +321,109 @@ def CalcNestedChoice(TreeDefn, MatRefs, numZn, getLogSumAccess = 0):
     #numZn = number of zones
     #
     #getLogSumAccess (optional, accessibility log sum) 0=no, <>0=yes
+    #
+    #dtype (optional) = float type of the results, numpy.float32 halves the memory, default float32 if all utilities are float32, else float64
+    #out (optional) = dictionary of preallocated (numZn, numZn) probability arrays by alternative/nest code
+    #MatRefs is not changed, each utility is exponentiated once and the log sums are computed stable (max subtracted)
     ''' 
     #ProbMats = {'ROOT': 1.0, 'AU':0, 'TR':0, 'AC':0, 'CD':0, 'CP':0, 'TB':0, 'TP':0, 'BK':0, 'WK':0}   #Stores probabilities at each level
     #TripMat = GetMatrixRaw(Visum, tripmatno) #--> Input trip distribution matrix
     #numZn = Visum.Net.Zones.Count
-    ProbMats = dict(zip(MatRefs.keys(), numpy.zeros(len(MatRefs.keys()))))
-    ProbMats['ROOT'] = 1.0
-    #Utility calculator going up...
-    #print 'Getting logsums and utilities...'
-    for key in sorted(TreeDefn.keys(), reverse= True):
-        #print key, TreeDefn[key]
-        sumExp = numpy.zeros((numZn,numZn))   
-        sublevelmat_codes = TreeDefn[key][1]  #produces --> ex. ['WB', 'WX', 'DX']
-
-        for code in sublevelmat_codes:
-            #print ([code, TreeDefn[key][0]])
-            MatRefs[code] = MatRefs[code]/TreeDefn[key][0]  #---> scale the utility
-            sumExp+=numpy.exp(MatRefs[code])
-        lnSum = sumExp.copy() #Maybe there is a better way of doing the next 4 steps in 1 shot
-        lnSum[sumExp == 0] = 0.000000001 
-        lnSum = numpy.log(lnSum)
-        lnSum[sumExp == 0] = -999
-        MatRefs[key[1]] = TreeDefn[key][0]*lnSum #---> Get ln sum of sublevel
+    return _NestedChoice(TreeDefn, MatRefs, (numZn, numZn), getLogSumAccess, dtype, out)
 
-    #Probability going down...
-    #print 'Getting probabilities...'
-    for key in sorted(TreeDefn.keys()):
-        #print key, TreeDefn[key]
-        eU_total = numpy.zeros((numZn,numZn))
-        sublevelmat_codes = TreeDefn[key][1] #1st set--> ROOT : AU, TR
-        for code in sublevelmat_codes:
-            #print ([code, TreeDefn[key][0]])
-            eU_total+=numpy.exp(MatRefs[code])
-            
-        eU_total[eU_total == 0] = 0.0001  #Avoid divide by 0 error
-##        for code in sublevelmat_codes:
-##            ProbMats[code] = ProbMats[key[1]]*numpy.exp(MatRefs[code])/eU_total
-        nSublevels = len(sublevelmat_codes)
-        cumProb = 0 
-        for i in xrange(nSublevels - 1):
-            code = sublevelmat_codes[i]
-            temp = numpy.exp(MatRefs[code])/eU_total
-            ProbMats[code] = ProbMats[key[1]]*temp
-            cumProb+=temp
-        code = sublevelmat_codes[i+1]
-        ProbMats[code] = ProbMats[key[1]]*(1.0-cumProb) 
-        
+
+_TreePlans = {} #compiled plans by tree definition, see CompileTree
+_LastTree = (None, None, None) #id, copy and plan of the last tree, a dict compare is cheaper than building the cache key, replaced as a
+                               #whole so threads always see a matching id, copy and plan
+
+def CompileTree(TreeDefn):
+    '''Compiles a tree definition (see CalcNestedChoice) into an array indexed plan for CalcNestedChoice2D, plans are cached
+    so calling it again with the same tree is cheap. Nodes (alternatives and nests below ROOT) are numbered level by level
+    so that the children of every nest are consecutive rows
+    Returns plan dictionary: 'nodes' = node codes in row order, 'alternatives' = alternative codes in the column order of
+    CalcNestedChoice2D, 'leafRows' = rows of the alternatives, 'nests' = (first row, last row + 1, scale, row of the nest
+    or -1 for ROOT) of every nest, deepest level first
+    '''
+    global _LastTree
+    lastTree = _LastTree
+    if lastTree[0] == id(TreeDefn) and lastTree[1] == TreeDefn: #same tree as the last call and not changed in place
+        return lastTree[2]
+    treeKey = tuple(sorted((key, TreeDefn[key][0], tuple(TreeDefn[key][1])) for key in TreeDefn.keys()))
+    plan = _TreePlans.get(treeKey)
+    if plan is None:
+        plan = _TreePlans.setdefault(treeKey, _CompilePlan(TreeDefn))
+    _LastTree = (id(TreeDefn), copy.deepcopy(TreeDefn), plan)
+    return plan
+
+def _CompilePlan(TreeDefn):
+    '''Array plan of a tree definition, see CompileTree'''
+    Row = {}
+    nodes = []
+    Nests = []
+    for key in sorted(TreeDefn.keys()): #parents come before their children
+        a = len(nodes)
+        for code in TreeDefn[key][1]:
+            Row[code] = len(nodes)
+            nodes.append(code)
+        Nests.append((a, len(nodes), TreeDefn[key][0], Row.get(key[1], -1)))
+    NestCodes = set(key[1] for key in TreeDefn.keys())
+    alternatives = [code for code in nodes if code not in NestCodes]
+    return {'nodes':nodes, 'alternatives':alternatives, 'leafRows':numpy.array([Row[code] for code in alternatives]),
+            'nests':Nests[::-1]}
+
+def _EvalPlan(Plan, V, getLogSumAccess = 0):
+    '''Evaluates a compiled tree on V (nodes, records) with the alternative utilities in the leaf rows, V is overwritten
+    Returns probabilities (nodes, records) and the log sum (records) or None
+    '''
+    lnSumAccess = None
+    for a, b, theta, nestRow in Plan['nests']: #utility calculator going up...
+        eU = V[a:b]
+        if theta != 1.0: #few calls per nest matter for short vectors (microsimulation), so skip the no-op scaling
+            eU /= theta #---> scale the utility
+        maxU = numpy.maximum.reduce(eU, axis=0)
+        eU -= maxU
+        numpy.exp(eU, out=eU)
+        sumExp = numpy.add.reduce(eU, axis=0)
+        Dead = None
+        if numpy.minimum.reduce(maxU, axis=None) < _EXP_UNDERFLOW: #no available alternative in the nest for some records
+            Dead = maxU < _EXP_UNDERFLOW
+            eU[:, Dead] = 0
+            sumExp[Dead] = 1
+        if nestRow >= 0 or getLogSumAccess != 0:
+            lnSum = V[nestRow] if nestRow >= 0 else numpy.empty_like(maxU)
+            numpy.log(sumExp, out=lnSum)
+            lnSum += maxU
+            if Dead is not None:
+                lnSum[Dead] = _LNSUM_DEAD
+            if theta != 1.0:
+                lnSum *= theta #---> Get ln sum of sublevel
+            if nestRow < 0:
+                lnSumAccess = lnSum
+        eU /= sumExp
+        numpy.subtract(1.0, numpy.add.reduce(eU[:-1], axis=0), out=eU[-1]) #the last alternative gets the rest...
+    for a, b, theta, nestRow in Plan['nests'][::-1]: #probability going down...
+        if nestRow >= 0:
+            V[a:b] *= V[nestRow]
+    return V, lnSumAccess
+
+def CalcNestedChoice2D(TreeDefn, U, getLogSumAccess = 0):
+    '''Nested choice for many records at once, e.g. for microsimulation
+    TreeDefn = tree definition (see CalcNestedChoice) or a plan from CompileTree
+    U = utilities (records, alternatives) with the columns in CompileTree(TreeDefn)['alternatives'] order
+    getLogSumAccess (optional, accessibility log sum) 0=no, <>0=yes
+    Returns probabilities (records, alternatives) and the log sum per record if asked for
+    '''
+    Plan = TreeDefn if 'nests' in TreeDefn else CompileTree(TreeDefn)
+    U = numpy.asarray(U)
+    V = numpy.empty((len(Plan['nodes']), U.shape[0]), numpy.result_type(numpy.float32, U))
+    V[Plan['leafRows']] = U.T
+    V, lnSum = _EvalPlan(Plan, V, getLogSumAccess)
     if getLogSumAccess == 0:
-        return ProbMats
+        return V[Plan['leafRows']].T
     else:
-        return ProbMats, MatRefs['ROOT']
-
+        return V[Plan['leafRows']].T, lnSum
 
-def CalcNestedChoiceFlat(TreeDefn, MatRefs, vecLen, getLogSumAccess = 0):
+def CalcNestedChoiceFlat(TreeDefn, MatRefs, vecLen, getLogSumAccess = 0, dtype = None, out = None):
     '''
     #TreeDefn = {(0,'ROOT'):[1.0,['AU', 'TR', 'AC']],
     #            (1,'AU'):[0.992,['CD', 'CP']],
@@ -186,58 +448,154 @@ def CalcNestedChoiceFlat(TreeDefn, MatRefs, vecLen, getLogSumAccess = 0):
     #vecLen = number of od pairs being evaluated 
     #
     #getLogSumAccess (optional, accessibility log sum) 0=no, <>0=yes
+    #
+    #dtype, out (optional) = see CalcNestedChoice
+    #The tree is compiled (CompileTree, cached) and evaluated level by level on all vectors at once. For many calls on
+    #short vectors (microsimulation) pass the plan instead of the tree, Plan = CompileTree(TreeDefn), so the tree is not
+    #looked up in the plan cache on every call
     ''' 
     #ProbMats = {'ROOT': 1.0, 'AU':0, 'TR':0, 'AC':0, 'CD':0, 'CP':0, 'TB':0, 'TP':0, 'BK':0, 'WK':0}   #Stores probabilities at each level
     #TripMat = GetMatrixRaw(Visum, tripmatno) #--> Input trip distribution matrix
     #numZn = Visum.Net.Zones.Count
+    Plan = TreeDefn if 'nests' in TreeDefn else CompileTree(TreeDefn)
+    if dtype is None:
+        dtype = numpy.result_type(numpy.float32, *[MatRefs[code] for code in Plan['alternatives']])
+    V = numpy.empty((len(Plan['nodes']), vecLen), dtype)
+    for row, code in zip(Plan['leafRows'], Plan['alternatives']):
+        V[row] = MatRefs[code]
+    V, lnSum = _EvalPlan(Plan, V, getLogSumAccess)
     ProbMats = dict(zip(MatRefs.keys(), numpy.zeros(len(MatRefs.keys()))))
     ProbMats['ROOT'] = 1.0
-    #Utility calculator going up...
-    #print 'Getting logsums and utilities...'
-    for key in sorted(TreeDefn.keys(), reverse= True):
-        #print key, TreeDefn[key]
-        sumExp = numpy.zeros(vecLen)   
-        sublevelmat_codes = TreeDefn[key][1]  #produces --> ex. ['WB', 'WX', 'DX']
-
-        for code in sublevelmat_codes:
-            #print ([code, TreeDefn[key][0]])
-            MatRefs[code] = MatRefs[code]/TreeDefn[key][0]  #---> scale the utility
-            sumExp+=numpy.exp(MatRefs[code])
-        lnSum = sumExp.copy() #Maybe there is a better way of doing the next 4 steps in 1 shot
-        lnSum[sumExp == 0] = 0.000000001 
-        lnSum = numpy.log(lnSum)
-        lnSum[sumExp == 0] = -999
-        MatRefs[key[1]] = TreeDefn[key][0]*lnSum #---> Get ln sum of sublevel
-
-    #Probability going down...
-    #print 'Getting probabilities...'
-    for key in sorted(TreeDefn.keys()):
-        #print key, TreeDefn[key]
-        eU_total = numpy.zeros(vecLen)
-        sublevelmat_codes = TreeDefn[key][1] #1st set--> ROOT : AU, TR
-        for code in sublevelmat_codes:
-            #print ([code, TreeDefn[key][0]])
-            eU_total+=numpy.exp(MatRefs[code])
-            
-        eU_total[eU_total == 0] = 0.0001  #Avoid divide by 0 error
-##        for code in sublevelmat_codes:
-##            ProbMats[code] = ProbMats[key[1]]*numpy.exp(MatRefs[code])/eU_total
-        nSublevels = len(sublevelmat_codes)
-        cumProb = 0 
-        for i in xrange(nSublevels - 1):
-            code = sublevelmat_codes[i]
-            temp = numpy.exp(MatRefs[code])/eU_total
-            ProbMats[code] = ProbMats[key[1]]*temp
-            cumProb+=temp
-        code = sublevelmat_codes[i+1]
-        ProbMats[code] = ProbMats[key[1]]*(1.0-cumProb) 
-        
+    for row, code in enumerate(Plan['nodes']):
+        if out and code in out:
+            out[code][...] = V[row]
+        ProbMats[code] = out[code] if out and code in out else V[row]
     if getLogSumAccess == 0:
         return ProbMats
     else:
-        return ProbMats, MatRefs['ROOT']
+        return ProbMats, lnSum
+
+def _SimulateChunk(args):
+    P, isUtility, TreeDefn, seed, chunk, r0, r1, out = args
+    P = numpy.asarray(P[r0:r1])
+    if isUtility != 0:
+        if TreeDefn is not None:
+            P = CalcNestedChoice2D(TreeDefn, P)
+        else:
+            P = numpy.exp(P - P.max(axis=1)[:, numpy.newaxis]) #multinomial, rows are normalized by the draw below
+    cumP = numpy.cumsum(P, axis=1)
+    total = cumP[:, -1].copy()
+    draw = numpy.random.RandomState([seed, chunk]).random_sample(r1 - r0) * total #own stream for every chunk
+    choice = (cumP <= draw[:, numpy.newaxis]).sum(axis=1)
+    numpy.minimum(choice, P.shape[1] - 1, out=choice)
+    choice[~(total > 0)] = -1
+    out[r0:r1] = choice
+
+def SimulateChoice(P, seed = 0, isUtility = 0, TreeDefn = None, chunkSize = 100000, numWorkers = 1):
+    '''Monte Carlo choice simulation, draws one alternative per record with a cumulative sum and search
+    P = choice probabilities (records, alternatives), rows need not be normalized
+    seed (optional) = random seed, every chunk of records uses its own stream RandomState([seed, chunk number]) so results do
+                      not depend on numWorkers; they do depend on chunkSize
+    isUtility (optional) 0=no, <>0=yes --> P holds utilities, multinomial probabilities or nested with TreeDefn
+    TreeDefn (optional) = tree definition or plan (see CompileTree) for nested choice utilities in CompileTree alternatives order
+    chunkSize (optional) = records per chunk, default 100000
+    numWorkers (optional) = number of threads, chunks are simulated in parallel if > 1
+    Returns index of the chosen alternative (column of P) for every record, -1 if no alternative has a probability
+    '''
+    numRec = len(P)
+    Choice = numpy.empty(numRec, dtype=numpy.intp)
+    Chunks = [(P, isUtility, TreeDefn, seed, i, r0, min(r0 + chunkSize, numRec), Choice)
+              for i, r0 in enumerate(range(0, numRec, chunkSize))]
+    if numWorkers > 1 and len(Chunks) > 1:
+        pool = multiprocessing.pool.ThreadPool(numWorkers)
+        try:
+            pool.map(_SimulateChunk, Chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in Chunks:
+            _SimulateChunk(args)
+    return Choice
+
+def _OpenRows(ref, numZn, dtype = 'd', mode = 'r'):
+    '''Matrix for row block access: arrays (also numpy.memmap) as is, a file name is memory mapped as a raw (numZn, numZn)
+    matrix like PushMatrix writes; mode 'w+' creates the file
+    '''
+    if isinstance(ref, str):
+        return numpy.memmap(ref, dtype=dtype, mode=mode, shape=(numZn, numZn))
+    return ref
+
+def IterNestedChoice(TreeDefn, MatRefs, numZn, blockSize = 500, getLogSumAccess = 0, dtype = None):
+    '''Evaluates CalcNestedChoice over blocks of origin rows, only the rows of the block are read from the utilities
+    TreeDefn = tree definition, see CalcNestedChoice
+    MatRefs = utilities as in CalcNestedChoice, matrices can be numpy.memmap (see MatrixIO.ReadMatrix) or raw matrix file names
+    blockSize (optional) = origin rows per block, default 500
+    getLogSumAccess (optional, accessibility log sum) 0=no, <>0=yes
+    dtype (optional) = float type of the results, see CalcNestedChoice
+    Yields (r0, r1, ProbMats, lnSum) for rows r0:r1, lnSum is None if not asked for. ProbMats arrays are reused for
+    the next block, copy them to keep them
+    '''
+    Rows = dict((code, _OpenRows(MatRefs[code], numZn)) for code in MatRefs.keys())
+    Nests, Parent = _TreeOrder(TreeDefn)
+    if dtype is None:
+        dtype = _ResultType(TreeDefn, Rows, Parent)
+    blockSize = min(blockSize, numZn)
+    Buffers = dict((code, numpy.empty((blockSize, numZn), dtype)) for code in Parent.keys()) #reused for every block
+    for r0 in range(0, numZn, blockSize):
+        r1 = min(r0 + blockSize, numZn)
+        BlockRefs = dict((code, Rows[code][r0:r1] if numpy.ndim(Rows[code]) > 0 else Rows[code]) for code in Rows.keys())
+        Out = dict((code, Buffers[code][:r1-r0]) for code in Buffers.keys())
+        Result = _NestedChoice(TreeDefn, BlockRefs, (r1 - r0, numZn), getLogSumAccess, dtype, Out)
+        if getLogSumAccess == 0:
+            yield r0, r1, Result, None
+        else:
+            yield r0, r1, Result[0], Result[1]
+
+def CalcNestedChoiceBlocked(TreeDefn, MatRefs, numZn, blockSize = 500, getLogSumAccess = 0, dtype = None, out = None,
+                            lnSumOut = None, callback = None):
+    '''Nested choice for large zone systems, evaluated over blocks of origin rows (see IterNestedChoice) so only a block of
+    every utility and probability matrix is in memory
+    out (optional) = dictionary of alternative/nest code -> (numZn, numZn) array, numpy.memmap or raw matrix file name to write
+                     the probabilities of those codes to
+    lnSumOut (optional) = array, numpy.memmap or file name for the log sum (getLogSumAccess is set if given)
+    callback (optional) = function(r0, r1, ProbMats, lnSum) called with every block, e.g. to apply probabilities to trip tables
+    other arguments, see IterNestedChoice
+    Returns out (dictionary of code -> output matrices) and the log sum output if lnSumOut is given
+    '''
+    out = dict(out or {})
+    if lnSumOut is not None:
+        getLogSumAccess = 1
+    for r0, r1, ProbMats, lnSum in IterNestedChoice(TreeDefn, MatRefs, numZn, blockSize, getLogSumAccess, dtype):
+        for code in out.keys():
+            out[code] = _OpenRows(out[code], numZn, ProbMats[code].dtype, 'w+')
+            out[code][r0:r1] = ProbMats[code]
+        if lnSumOut is not None:
+            lnSumOut = _OpenRows(lnSumOut, numZn, lnSum.dtype, 'w+')
+            lnSumOut[r0:r1] = lnSum
+        if callback is not None:
+            callback(r0, r1, ProbMats, lnSum)
+    for mat in list(out.values()) + [lnSumOut]:
+        if isinstance(mat, numpy.memmap):
+            mat.flush()
+    if lnSumOut is None:
+        return out
+    else:
+        return out, lnSumOut
+
+def CalcMultinomialChoiceBlocked(Utils, numZn, blockSize = 500, getLogSumAccess = 0, dtype = None, out = None, lnSumOut = None,
+                                 callback = None):
+    '''Multinomial choice over blocks of origin rows, evaluated as a nested choice tree with one nest (ROOT) and the scale of 1.0
+    Utils = dictionary of utility matrices (arrays, numpy.memmap or raw matrix file names) for each mode, see CalcMultinomialChoice
+    other arguments, see CalcNestedChoiceBlocked
+    '''
+    TreeDefn = {(0,'ROOT'):[1.0, sorted(Utils.keys())]}
+    MatRefs = dict(Utils)
+    MatRefs['ROOT'] = 1.0
+    return CalcNestedChoiceBlocked(TreeDefn, MatRefs, numZn, blockSize, getLogSumAccess, dtype, out, lnSumOut, callback)
 
 #some generic utilities for reading and writing numpy arrays to disk..
+#raw files carry no shape/dtype/zones, see MatrixIO for a self-describing multi-matrix container with memory-mapped reads
 
 def GetMatrix(fn, numZn):
     return numpy.fromfile(fn).reshape((numZn, numZn))
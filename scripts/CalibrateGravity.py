@@ -2,6 +2,11 @@
 # Name:        Calibrate gravity model
 # Purpose:     Calibrates the coefficient for the gravity model with -ve exp friction factor
 #              given an average trip length, skim and P/A vectors
+#              a) CalibrateSinglyConstrained : fixed point update of the coefficient
+#              b) CalibrateSinglyConstrainedNewton : safeguarded Newton search on the coefficient, vectorized trips
+#              c) CalibrateDoublyConstrained : safeguarded secant search with balancing factors warm started between iterates
+#              d) BuildSkimBins / CalcTLFD : skim bin index built once per skim, turns any trip matrix into a trip length frequency with one bincount
+#              e) FitFrictionCurve / FitFrictionCurves : fits gamma, exponential or lookup table friction curves to observed trip length frequencies
 # Author:      Chetan Joshi, Portland OR
 #
 # Created:     5/6/2015
@@ -48,3 +53,244 @@ def CalibrateSinglyConstrained(P, A, avg_trip_len, skim, c = -0.1, alpha = 2, ma
     print ('final average trip length (model): ', model_trip_len)
     print ('final logit scaling factor: ', c)
     return trips   #returns final trip matrix corresponding to calibrated coefficient
+
+def _ModelTripLength(P, W, skim, fric):
+    '''Mean trip length and its derivative with respect to the coefficient for T[i,j] = P[i]*W[j]*fric[i,j]/sum_j(W[j]*fric[i,j])
+    The derivative is the production weighted variance of trip length within each origin (exact when W does not depend on the coefficient)
+    '''
+    SumWjFij = fric.dot(W)
+    SumWF = np.maximum(SumWjFij, 0.000001)
+    RowTrips = P*(SumWjFij/SumWF)
+    S1 = np.einsum('ij,ij,j->i', fric, skim, W)/SumWF  #mean trip length by origin, no full size temporaries
+    S2 = np.einsum('ij,ij,ij,j->i', fric, skim, skim, W)/SumWF
+    model_trip_len = RowTrips.dot(S1)/RowTrips.sum()
+    slope = RowTrips.dot(S2 - S1*S1)/RowTrips.sum()
+    return model_trip_len, slope
+
+def _FrictionMatrix(c, skim, fric):
+    np.multiply(skim, c, out=fric)
+    np.exp(fric, out=fric)
+    return fric
+
+def _SolveCoefficient(TripLength, avg_trip_len, c, tol, max_iter, secant):
+    '''Safeguarded Newton/secant search for the coefficient c where the model average trip length matches the target
+    TripLength(c) returns (model average trip length, slope), trip length increases with c so a bracket is kept
+    and steps leaving it fall back to bisection
+    '''
+    lo, hi = None, None
+    prev = None
+    for Iter in range(0, max_iter):
+        model_trip_len, slope = TripLength(c)
+        print ('iteration: ', Iter, ' coefficient: ', c, ' average trip length (model): ', model_trip_len)
+        err = model_trip_len - avg_trip_len
+        if abs(err) < tol*avg_trip_len:
+            break
+        if err < 0:
+            lo = c
+        else:
+            hi = c
+        if secant and prev is not None and prev[1] != model_trip_len:
+            slope = (model_trip_len - prev[1])/(c - prev[0])
+        prev = (c, model_trip_len)
+        max_step = max(abs(c), 0.001)  #limit the step size until the target is bracketed
+        step = -err/slope if slope > 0 else -np.sign(err)*max_step
+        step = np.clip(step, -max_step, max_step)
+        c_new = c + step
+        if lo is not None and hi is not None and not (min(lo, hi) < c_new < max(lo, hi)):
+            c_new = 0.5*(lo + hi)
+        c = c_new
+    else:
+        #not converged (or max_iter = 0), c has not been evaluated yet - evaluate it so the caller's friction/balancing state matches c
+        model_trip_len, slope = TripLength(c)
+        print ('coefficient: ', c, ' average trip length (model): ', model_trip_len, ' (not converged)')
+    return c, model_trip_len
+
+def CalibrateSinglyConstrainedNewton(P, A, avg_trip_len, skim, c = -0.1, tol = 0.001, max_iter = 20):
+    '''Calibrates the -ve exp friction coefficient of a singly constrained gravity model to an average trip length
+    with a safeguarded Newton search, trips are never built row by row and exp(c*skim) reuses one buffer
+    P = Production array
+    A = Attraction array
+    avg_trip_len = target (observed) average trip length
+    skim = skim matrix (distance/time)
+    c (optional) = starting coefficient, default is -0.1
+    tol (optional) = relative tolerance on the average trip length, default is 0.001
+    max_iter (optional) = maximum number of iterations, default is 20
+    Returns trip matrix corresponding to the calibrated coefficient and the coefficient
+    '''
+    fric = np.empty(skim.shape)
+    c, model_trip_len = _SolveCoefficient(lambda c: _ModelTripLength(P, A, skim, _FrictionMatrix(c, skim, fric)),
+                                          avg_trip_len, c, tol, max_iter, False)
+    print ('target average trip length (observed): ', avg_trip_len)
+    print ('final average trip length (model): ', model_trip_len)
+    print ('final logit scaling factor: ', c)
+    #Trips for the final coefficient, fric already holds exp(c*skim) --->
+    trips = fric
+    trips*=A
+    trips*=(P/np.maximum(trips.sum(1), 0.000001))[:, np.newaxis]
+    return trips, c
+
+def CalibrateDoublyConstrained(P, A, avg_trip_len, skim, c = -0.1, tol = 0.001, max_iter = 20, bal_tol = 0.001, bal_iter = 50):
+    '''Calibrates the -ve exp friction coefficient of a doubly constrained gravity model to an average trip length
+    with a safeguarded secant search, the attraction balancing factors of each iterate start from the previous ones
+    P = Production array
+    A = Attraction array (scaled to productions if they do not balance)
+    avg_trip_len = target (observed) average trip length
+    skim = skim matrix (distance/time)
+    c (optional) = starting coefficient, default is -0.1
+    tol (optional) = relative tolerance on the average trip length, default is 0.001
+    max_iter (optional) = maximum number of coefficient iterations, default is 20
+    bal_tol (optional) = relative attraction error to stop balancing at, default is 0.001
+    bal_iter (optional) = maximum balancing iterations per coefficient, default is 50
+    Returns trip matrix corresponding to the calibrated coefficient, the coefficient and the number of balancing passes over the matrix
+    '''
+    AttrT = A*(P.sum()/A.sum())  #in case P and A totals don't match - balance A to P
+    fric = np.empty(skim.shape)
+    state = {'W':AttrT.copy(), 'passes':0}
+
+    def TripLength(c):
+        _FrictionMatrix(c, skim, fric)
+        W = state['W']
+        for balIter in range(0, bal_iter):
+            RowFac = P/np.maximum(fric.dot(W), 0.000001)
+            cA = RowFac.dot(fric)*W
+            state['passes']+=1
+            if (np.absolute(cA - AttrT)/np.where(AttrT > 0, AttrT, 1.0)).max() < bal_tol:
+                break
+            cA[cA==0]=1
+            W = W*(AttrT/cA)
+        state['W'] = W
+        return _ModelTripLength(P, W, skim, fric)
+
+    c, model_trip_len = _SolveCoefficient(TripLength, avg_trip_len, c, tol, max_iter, True)
+    print ('target average trip length (observed): ', avg_trip_len)
+    print ('final average trip length (model): ', model_trip_len)
+    print ('final logit scaling factor: ', c)
+    print ('balancing passes: ', state['passes'])
+    trips = fric
+    trips*=state['W']
+    trips*=(P/np.maximum(trips.sum(1), 0.000001))[:, np.newaxis]
+    return trips, c, state['passes']
+
+def BuildSkimBins(skim, bin_width = 1.0, max_bin = None):
+    '''Precomputes the trip length bin of every skim cell, build once per skim and reuse for any trip matrix/purpose
+    skim = skim matrix (distance/time)
+    bin_width (optional) = width of the trip length bins, default is 1.0
+    max_bin (optional) = upper edge of the last bin, longer trips are counted in the last bin, default is the skim maximum
+    Returns skim bin index --> {'bins':flat bin number per cell, 'num_bins':n, 'edges':bin edges, 'centers':bin centers, 'skim':skim}
+    '''
+    if max_bin is None:
+        max_bin = skim.max()
+    num_bins = max(int(np.ceil(max_bin/float(bin_width))), 1)
+    bins = np.floor(skim.ravel()/float(bin_width)).astype(np.intp)  #intp so bincount does not convert on every call
+    np.clip(bins, 0, num_bins - 1, out=bins)
+    edges = np.arange(num_bins + 1)*float(bin_width)
+    return {'bins':bins, 'num_bins':num_bins, 'edges':edges, 'centers':edges[:-1] + 0.5*bin_width, 'skim':skim}
+
+def CalcTLFD(trips, skim_bins, normalize = True):
+    '''Trip length frequency distribution of a trip matrix from a skim bin index (see BuildSkimBins)
+    trips = trip matrix with the same shape as the skim the index was built from
+    normalize (optional) = return shares instead of trips per bin, default is True
+    Returns array of trips (or shares) by trip length bin
+    '''
+    tlfd = np.bincount(skim_bins['bins'], weights=trips.ravel(), minlength=skim_bins['num_bins'])
+    if normalize:
+        tlfd/=max(tlfd.sum(), 0.000001)
+    return tlfd
+
+def _CoincidenceRatio(obs, model):
+    return np.minimum(obs, model).sum()/max(np.maximum(obs, model).sum(), 0.000001)
+
+def _CurveParams(form, centers, values, weights):
+    '''Weighted log-linear least squares fit of ln F = ln a + b ln t + c t (gamma) or ln F = ln a + c t (exponential) over the bins'''
+    use = (values > 0) & (weights > 0)
+    if form == 'gamma':
+        X = np.column_stack([np.ones(use.sum()), np.log(np.maximum(centers[use], 0.000001)), centers[use]])
+    else:
+        X = np.column_stack([np.ones(use.sum()), centers[use]])
+    w = np.sqrt(weights[use])
+    coef = np.linalg.lstsq(X*w[:, np.newaxis], np.log(values[use])*w, rcond=None)[0]
+    if form == 'gamma':
+        return {'form':form, 'a':np.exp(coef[0]), 'b':coef[1], 'c':coef[2]}
+    return {'form':form, 'a':np.exp(coef[0]), 'b':0.0, 'c':coef[1]}
+
+def _CurveFriction(params, skim_bins, fric, work):
+    '''Evaluates the friction curve on every skim cell into fric, lookup tables are a gather through the bin index'''
+    flat = fric.reshape(-1)
+    if params['form'] == 'lookup':
+        np.take(params['table'], skim_bins['bins'], out=flat)
+        return fric
+    skim = skim_bins['skim']
+    np.multiply(skim, params['c'], out=fric)
+    if params['b'] != 0:
+        if 'log_skim' not in skim_bins:
+            skim_bins['log_skim'] = np.log(np.maximum(skim, 0.000001))  #computed once per skim, only for gamma curves
+        np.multiply(skim_bins['log_skim'], params['b'], out=work)
+        fric+=work
+    fric+=np.log(params['a'])
+    np.exp(fric, out=fric)
+    return fric
+
+def _CurveTable(params, skim_bins):
+    if params['form'] == 'lookup':
+        return params['table']
+    t = np.maximum(skim_bins['centers'], 0.000001)
+    return params['a']*t**params['b']*np.exp(params['c']*t)
+
+def _FitFriction(P, A, obs_tlfd, skim_bins, form, params, max_iter, tol, fric, trips):
+    obs = obs_tlfd/max(obs_tlfd.sum(), 0.000001)
+    if params is None:
+        if form == 'lookup':
+            params = {'form':form, 'table':np.where(obs > 0, 1.0, 0.0)}
+        else:
+            params = {'form':form, 'a':1.0, 'b':0.0, 'c':-0.1}
+    Diag = {'iterations':0, 'coincidence':[]}
+    best = (-1.0, params)
+    for Iter in range(0, max_iter):
+        #Singly constrained trips for the current curve, both work matrices are reused --->
+        _CurveFriction(params, skim_bins, fric, trips)
+        np.multiply(fric, A, out=trips)
+        trips*=(P/np.maximum(trips.sum(1), 0.000001))[:, np.newaxis]
+        model = CalcTLFD(trips, skim_bins)
+        Diag['coincidence'].append(_CoincidenceRatio(obs, model))
+        Diag['iterations'] = Iter + 1
+        if Diag['coincidence'][-1] > best[0]:
+            best = (Diag['coincidence'][-1], params)
+        if 1.0 - Diag['coincidence'][-1] < tol:
+            break
+        #Scale the friction of each bin by observed/model and refit the curve --->
+        table = _CurveTable(params, skim_bins)*np.where(model > 0, obs/np.maximum(model, 0.000001), 1.0)
+        if form == 'lookup':
+            params = {'form':form, 'table':table}
+        else:
+            params = _CurveParams(form, skim_bins['centers'], table, obs)
+    return best[1], Diag  #a curve form that cannot reproduce the TLFD may oscillate, keep the best iterate
+
+def FitFrictionCurve(P, A, obs_tlfd, skim_bins, form = 'gamma', params = None, max_iter = 20, tol = 0.01):
+    '''Fits a friction curve so the singly constrained gravity model reproduces an observed trip length frequency distribution
+    P = Production array
+    A = Attraction array
+    obs_tlfd = observed trips (or shares) by trip length bin of skim_bins
+    skim_bins = skim bin index from BuildSkimBins, reused across iterations
+    form (optional) = 'gamma' --> F = a*t^b*exp(c*t), 'exponential' --> F = a*exp(c*t) or 'lookup' --> one factor per bin, default is 'gamma'
+    params (optional) = starting curve as returned by this function, default is a flat curve
+    max_iter (optional) = maximum number of iterations, default is 20
+    tol (optional) = stop when 1 - coincidence ratio of model and observed TLFD falls below tol, default is 0.01
+    Returns best fitting curve parameters --> {'form', 'a', 'b', 'c'} or {'form', 'table'} and diagnostics dict --> {'iterations':n, 'coincidence':[...]}
+    '''
+    shape = skim_bins['skim'].shape
+    return _FitFriction(P, A, obs_tlfd, skim_bins, form, params, max_iter, tol, np.empty(shape), np.empty(shape))
+
+def FitFrictionCurves(Purposes, skim_bins, form = 'gamma', max_iter = 20, tol = 0.01):
+    '''Fits friction curves for several purposes over the same skim, the bin index and work matrices are shared
+    Purposes = dictionary of purpose --> (P, A, obs_tlfd), see FitFrictionCurve
+    Returns dictionary of purpose --> (curve parameters, diagnostics dict)
+    '''
+    shape = skim_bins['skim'].shape
+    fric = np.empty(shape)
+    trips = np.empty(shape)
+    Curves = {}
+    for purpose in Purposes.keys():
+        P, A, obs_tlfd = Purposes[purpose]
+        Curves[purpose] = _FitFriction(P, A, obs_tlfd, skim_bins, form, None, max_iter, tol, fric, trips)
+        print ('purpose: ', purpose, ' iterations: ', Curves[purpose][1]['iterations'], ' coincidence ratio: ', Curves[purpose][1]['coincidence'][-1])
+    return Curves
@@ -2,8 +2,14 @@
 # Name:        LoadDaySimTrips
 # Purpose:     Loads key info: otaz, dtaz, deptm, arrtm, mode, half, etrps to a sqlite database for running queries 
 #              This function is useful for checking information coming out of DaySim.   
+#               a) GetDaySimTripsDB1 / GetDaySimTripsDB2 : row by row and executemany loads into an in memory sqlite db
+#               b) ReadDaySimTrips : bulk parses the trip file into typed columns, cached in a memory-mapped MatrixIO container
+#               c) GetDaySimTripsDB3 : chunked executemany load into an indexed sqlite db file, reopened as is while the trip file is unchanged
+#               d) ReadDaySimTripFiles : several trip files (list or glob) parsed in a process pool and merged into one columnar store
+#               e) AggregateDaySimTrips : streams trip files straight into OD matrices by mode and time period, written with MatrixIO
 # Author:      Chetan Joshi, Portland OR
-# Dependencies:csv, sqlite3, time 
+# Dependencies:csv, sqlite3, time, os, glob, multiprocessing, numpy [http://www.numpy.org], MatrixIO,
+#              scipy [https://www.scipy.org/] (optional, sparse matrices)
 # Created:     1/7/2016
 #              
 # Copyright:   (c) Chetan Joshi 2016
@@ -26,8 +32,15 @@
 #              SOFTWARE.
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------------#
 import csv
+import glob
+import multiprocessing
+import os
 import sqlite3
 import time
+import numpy as np
+import MatrixIO
+
+TRIP_FIELDS = [('otaz', 'i4'), ('dtaz', 'i4'), ('deptm', 'i4'), ('arrtm', 'i4'), ('mode', 'i4'), ('half', 'i4'), ('trexpfac', 'f8')]
 
 def GetDaySimTripsDB1(daysimtripfilepath):
     '''usage: -> put the script in python site packages and then use as below
@@ -113,16 +126,283 @@ def GetDaySimTripsDB2(daysimtripfilepath):
     print 'Finished pushing trips to sqlite db in ', time.time()-start, 'secs' 
     return conn, trip_data
 
+def _IterTripChunks(daysimtripfilepath, fields = TRIP_FIELDS, chunkBytes = 16*1024*1024):
+    '''Bulk parses a tab delimited daysim trips file (one header row, all values numeric) one chunk of text at a time
+       fields (optional) = list of (column name, numpy dtype) to keep, default is TRIP_FIELDS
+       chunkBytes (optional) = bytes of text parsed per chunk, default is 16 MB
+       Yields dictionary of column name --> typed array for the rows of every chunk
+    '''
+    tripsfile = open(daysimtripfilepath, 'rb')
+    columns = tripsfile.readline().decode('utf-8').split()
+    index = [columns.index(name) for name, dtype in fields]
+    for rows in MatrixIO.IterNumericRows(tripsfile, len(columns), chunkBytes, comment=None, stop=None):
+        yield dict((name, rows[:, i].astype(dtype)) for (name, dtype), i in zip(fields, index))
+    tripsfile.close()
+
+def ReadDaySimTrips(daysimtripfilepath, cache = True, fields = TRIP_FIELDS):
+    '''usage: -> columnar alternative to the sqlite dbs, e.g. trips['trexpfac'][(trips['mode'] == 3) & (trips['otaz'] == 100)].sum()
+       import LoadDaySimTrips
+       trips = LoadDaySimTrips.ReadDaySimTrips(daysimtripfilepath)
+
+       daysimtripfilepath = full path and file name for the daysim trips file
+       cache (optional) = keep the columns in a binary sidecar (daysimtripfilepath + '.cache') keyed on the file size and mtime,
+                          later sessions memory-map it instead of reading the text, default is True
+       fields (optional) = list of (column name, numpy dtype) to load, default is TRIP_FIELDS
+       trips = dictionary of column name --> array (numpy.memmap when read from the cache), one entry per trip
+    '''
+    start = time.time()
+    cachefn = daysimtripfilepath + '.cache'
+    header = MatrixIO.ReadCacheHeader(cachefn, daysimtripfilepath) if cache else None
+    if header is not None and header['attrs'].get('fields') == [list(field) for field in fields]:
+        trips = MatrixIO.ReadMatrices(cachefn)
+        print('Mapped daysim trips from cache in ' + str(time.time()-start) + ' secs')
+        return trips
+
+    Chunks = dict((name, []) for name, dtype in fields)
+    for chunk in _IterTripChunks(daysimtripfilepath, fields):
+        for name in chunk.keys():
+            Chunks[name].append(chunk[name])
+    trips = {}
+    for name, dtype in fields:
+        trips[name] = np.concatenate(Chunks[name]) if Chunks[name] else np.zeros(0, dtype)
+        del Chunks[name]
+    if cache:
+        MatrixIO.WriteMatrices(cachefn, [(name, trips[name]) for name, dtype in fields],
+                               attrs={'source':MatrixIO.SourceStamp(daysimtripfilepath), 'fields':[list(field) for field in fields]})
+    print('Finished reading ' + str(len(trips[fields[0][0]])) + ' daysim trips in ' + str(time.time()-start) + ' secs')
+    return trips
+
+def _CacheTripFile(args):
+    '''Pool worker, builds (or checks) the column cache of one trip file and returns the cache file name'''
+    daysimtripfilepath, fields = args
+    ReadDaySimTrips(daysimtripfilepath, True, fields)
+    return daysimtripfilepath + '.cache'
+
+def ReadDaySimTripFiles(daysimtripfiles, cachefn = None, numWorkers = None, sourceColumn = False, fields = TRIP_FIELDS):
+    '''usage: -> one columnar store for the trip files of several household partitions/iterations
+       import LoadDaySimTrips
+       trips = LoadDaySimTrips.ReadDaySimTripFiles(r'C:\Projects\DaySim\outputs\_trip_*.dat', cachefn)
+       *on Windows call it under if __name__ == '__main__': as the files are parsed in worker processes
+
+       daysimtripfiles = list of trip file paths or a glob pattern (files are taken in sorted order)
+       cachefn (optional) = MatrixIO container for the merged columns, reopened as is while no trip file changed, default is no merged cache
+       numWorkers (optional) = number of worker processes, default is the number of cores, 1 parses in this process
+       sourceColumn (optional) = add a 'source' column with the index of the trip file of every trip (in the sorted/given order), default is False
+       fields (optional) = list of (column name, numpy dtype) to load, default is TRIP_FIELDS
+       trips = dictionary of column name --> array, see ReadDaySimTrips
+       *every trip file keeps its own column cache (trip file + '.cache'), so unchanged files are not parsed again
+    '''
+    start = time.time()
+    if isinstance(daysimtripfiles, str):
+        daysimtripfiles = sorted(glob.glob(daysimtripfiles))
+    attrs = {'sources':[[fn, MatrixIO.SourceStamp(fn)] for fn in daysimtripfiles], 'fields':[list(field) for field in fields],
+             'sourceColumn':bool(sourceColumn)}
+    if cachefn is not None and os.path.exists(cachefn):
+        try:
+            header = MatrixIO.ReadHeader(cachefn)
+        except ValueError:
+            header = None
+        if header is not None and header['attrs'] == attrs:
+            trips = MatrixIO.ReadMatrices(cachefn)
+            print('Mapped ' + str(len(daysimtripfiles)) + ' daysim trip files from cache in ' + str(time.time()-start) + ' secs')
+            return trips
+
+    Jobs = [(fn, fields) for fn in daysimtripfiles]
+    numWorkers = numWorkers or multiprocessing.cpu_count()
+    if numWorkers > 1 and len(Jobs) > 1:
+        pool = multiprocessing.Pool(min(numWorkers, len(Jobs)))
+        CacheFiles = pool.map(_CacheTripFile, Jobs, 1)
+        pool.close()
+        pool.join()
+    else:
+        CacheFiles = [_CacheTripFile(job) for job in Jobs]
+
+    Parts = [MatrixIO.ReadMatrices(fn) for fn in CacheFiles]  #memory mapped, copied once into the merged columns
+    trips = {}
+    for name, dtype in fields:
+        trips[name] = np.concatenate([part[name] for part in Parts]) if Parts else np.zeros(0, dtype)
+    if sourceColumn:
+        trips['source'] = np.repeat(np.arange(len(Parts), dtype='i2'), [len(part[fields[0][0]]) for part in Parts])
+    del Parts
+    if cachefn is not None:
+        names = [name for name, dtype in fields] + (['source'] if sourceColumn else [])
+        MatrixIO.WriteMatrices(cachefn, [(name, trips[name]) for name in names], attrs=attrs)
+    print('Finished reading ' + str(len(trips[fields[0][0]])) + ' daysim trips from ' + str(len(daysimtripfiles)) + ' files in ' +
+          str(time.time()-start) + ' secs')
+    return trips
+
+def _DBStamp(conn):
+    '''Source stamp the db was built from, None if the db is new or the load did not finish'''
+    try:
+        row = conn.execute("SELECT size, mtime FROM source").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return None if row is None else {'size':row[0], 'mtime':row[1]}
+
+def GetDaySimTripsDB3(daysimtripfilepath, dbfile = None, chunkBytes = 16*1024*1024):
+    '''usage: -> same as GetDaySimTripsDB2 but the db is a file that later sessions open without loading again
+       import LoadDaySimTrips
+       conn, trip_data = LoadDaySimTrips.GetDaySimTripsDB3(daysimtripfilepath)
+
+       daysimtripfilepath = full path and file name for the daysim trips file
+       dbfile (optional) = sqlite db file, default is daysimtripfilepath + '.db'
+       chunkBytes (optional) = bytes of trip file text parsed and inserted per chunk, memory use does not grow with the file size
+       conn = connection to db
+       trip_data = db table, same columns as GetDaySimTripsDB1/DB2 with indexes on otaz, dtaz, mode and deptm
+       *the db is rebuilt when the trip file size or modification time changes
+    '''
+    start = time.time()
+    if dbfile is None:
+        dbfile = daysimtripfilepath + '.db'
+    stamp = MatrixIO.SourceStamp(daysimtripfilepath)
+    if os.path.exists(dbfile):
+        conn = sqlite3.connect(dbfile)
+        if _DBStamp(conn) == stamp:
+            print('Opened daysim trips db in ' + str(time.time()-start) + ' secs')
+            return conn, conn.cursor()
+        conn.close()
+        os.remove(dbfile)
+
+    print('Start reading daysim trips...')
+    conn = sqlite3.connect(dbfile)
+    for pragma in ["journal_mode=OFF", "synchronous=OFF", "locking_mode=EXCLUSIVE", "temp_store=MEMORY", "cache_size=-262144"]:
+        conn.execute("PRAGMA " + pragma)  #bulk load settings, a failed load leaves no source stamp so it is rebuilt
+    conn.execute("CREATE TABLE trips(otaz INT, dtaz INT, deptm INT, arrtm INT, mode INT, half INT, etrps DOUBLE)")
+    names = [name for name, dtype in TRIP_FIELDS]
+    for chunk in _IterTripChunks(daysimtripfilepath, TRIP_FIELDS, chunkBytes):
+        conn.executemany("insert into trips values (?,?,?,?,?,?,?)", zip(*[chunk[name].tolist() for name in names]))
+    for column in ['otaz', 'dtaz', 'mode', 'deptm']:
+        conn.execute("CREATE INDEX trips_" + column + " ON trips(" + column + ")")
+    conn.execute("ANALYZE")  #index statistics, so the planner picks the most selective index
+    conn.execute("CREATE TABLE source(size INT, mtime DOUBLE)")
+    conn.execute("insert into source values (?,?)", (stamp['size'], stamp['mtime']))
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(dbfile)
+    print('Finished pushing trips to sqlite db in ' + str(time.time()-start) + ' secs')
+    return conn, conn.cursor()
+
+def _IterTripColumns(daysimtripfilepath, fields, chunkBytes):
+    '''Chunks of typed trip columns, from the column cache of ReadDaySimTrips if it is current, else parsed from the text'''
+    cachefn = daysimtripfilepath + '.cache'
+    header = MatrixIO.ReadCacheHeader(cachefn, daysimtripfilepath)
+    cached = [] if header is None else [entry['name'] for entry in header['matrices']]
+    if all(name in cached for name, dtype in fields):
+        Cols = MatrixIO.ReadMatrices(cachefn, [name for name, dtype in fields])
+        numTrips = len(Cols[fields[0][0]])
+        step = max(chunkBytes//64, 1)  #about the number of trips in chunkBytes of text
+        for r0 in range(0, numTrips, step):
+            yield dict((name, np.asarray(Cols[name][r0:r0+step], dtype)) for name, dtype in fields)
+    else:
+        for chunk in _IterTripChunks(daysimtripfilepath, fields, chunkBytes):
+            yield chunk
+
+def _PeriodIndex(periods):
+    '''Sorted period start/end times and the period (name) number of each, names can repeat (e.g. a night period around midnight)'''
+    Names = []
+    for name, t0, t1 in periods:
+        if name not in Names:
+            Names.append(name)
+    Ranges = sorted(periods, key=lambda period: period[1])
+    Starts = np.array([period[1] for period in Ranges])
+    Ends = np.array([period[2] for period in Ranges])
+    if (Ends <= Starts).any() or (Starts[1:] < Ends[:-1]).any():
+        raise ValueError('time periods must be (name, start, end) with start < end and must not overlap')
+    return Names, Starts, Ends, np.array([Names.index(period[0]) for period in Ranges])
+
+def _Reduce(Keys, Sums):
+    '''Sums the values of equal keys, returns sorted unique keys and their sums'''
+    Keys, inverse = np.unique(Keys, return_inverse=True)
+    return Keys, np.bincount(inverse, weights=Sums)
+
+def AggregateDaySimTrips(daysimtripfiles, zoneIDs, matfn = None, periods = None, modes = None, sparse = False, chunkBytes = 16*1024*1024):
+    '''usage: -> trip tables for assignment without a db, e.g. AM and PM matrices for every mode
+       import LoadDaySimTrips
+       Mats = LoadDaySimTrips.AggregateDaySimTrips(daysimtripfilepath, zoneIDs, matfn, periods=[('AM', 360, 540), ('PM', 900, 1080)])
+
+       daysimtripfiles = trip file path, list of paths or glob pattern
+       zoneIDs = zone numbers of the matrix rows/columns, trips from or to other zones are dropped (and counted)
+       matfn (optional) = MatrixIO container the matrices are written to, with zoneIDs and the periods in the header attrs
+       periods (optional) = list of (name, start, end) departure times (deptm, minutes, end not included), a name can appear twice for a
+                            period that wraps midnight, default is [('DAY', 0, 1440)]; trips outside all periods are dropped (and counted)
+       modes (optional) = list of mode codes to build matrices for, default is every mode in the trips
+       sparse (optional) = accumulate and return scipy.sparse.csr_matrix, default is dense arrays; in matfn a sparse matrix is stored
+                           as name + '.data', '.indices' and '.indptr' arrays (csr)
+       chunkBytes (optional) = bytes of trip file text parsed per chunk, a current ReadDaySimTrips cache is read instead of the text
+       Mats = dictionary of 'mode<code>_<period>' (e.g. 'mode3_AM') --> matrix of summed trexpfac
+    '''
+    start = time.time()
+    if isinstance(daysimtripfiles, str):
+        daysimtripfiles = sorted(glob.glob(daysimtripfiles))
+    periods = periods or [('DAY', 0, 1440)]
+    Names, Starts, Ends, PeriodOfRange = _PeriodIndex(periods)
+    zoneIDs = np.asarray(zoneIDs, dtype=np.int64)
+    order = np.argsort(zoneIDs)
+    SortedZones = zoneIDs[order]
+    numZn = len(zoneIDs)
+    numCells = len(Names)*numZn*numZn  #cells of one mode, period major then origin, destination
+    ModeCodes = None if modes is None else np.unique(modes)
+    Acc = {}  #mode code --> dense (periods, zones, zones) array, or [keys, sums] of the sparse cells
+    dropped = 0
+    fields = [('otaz', 'i8'), ('dtaz', 'i8'), ('deptm', 'i8'), ('mode', 'i8'), ('trexpfac', 'f8')]
+    for daysimtripfilepath in daysimtripfiles:
+        for chunk in _IterTripColumns(daysimtripfilepath, fields, chunkBytes):
+            OrigIx = np.minimum(np.searchsorted(SortedZones, chunk['otaz']), max(numZn - 1, 0))
+            DestIx = np.minimum(np.searchsorted(SortedZones, chunk['dtaz']), max(numZn - 1, 0))
+            RangeIx = np.maximum(np.searchsorted(Starts, chunk['deptm'], side='right') - 1, 0)
+            use = (SortedZones[OrigIx] == chunk['otaz']) & (SortedZones[DestIx] == chunk['dtaz']) & \
+                  (chunk['deptm'] >= Starts[RangeIx]) & (chunk['deptm'] < Ends[RangeIx])
+            if ModeCodes is not None:
+                use &= np.in1d(chunk['mode'], ModeCodes)
+            dropped += len(use) - use.sum()
+            Cells = (PeriodOfRange[RangeIx[use]]*numZn + order[OrigIx[use]])*numZn + order[DestIx[use]]
+            ChunkModes, ModeIx = np.unique(chunk['mode'][use], return_inverse=True)
+            Keys, Sums = _Reduce(ModeIx*numCells + Cells, chunk['trexpfac'][use])  #one scatter add for all modes and periods
+            Bounds = np.searchsorted(Keys, np.arange(len(ChunkModes) + 1)*numCells)
+            for m, code in enumerate(ChunkModes):
+                ModeKeys = Keys[Bounds[m]:Bounds[m+1]] - m*numCells
+                ModeSums = Sums[Bounds[m]:Bounds[m+1]]
+                if not sparse:
+                    if code not in Acc:
+                        Acc[code] = np.zeros((len(Names), numZn, numZn))
+                    Acc[code].reshape(-1)[ModeKeys] += ModeSums  #keys are unique, so fancy index += adds every trip
+                elif code not in Acc:
+                    Acc[code] = [ModeKeys, ModeSums]
+                else:
+                    Acc[code] = list(_Reduce(np.concatenate([Acc[code][0], ModeKeys]), np.concatenate([Acc[code][1], ModeSums])))
+
+    Mats = []
+    for code in sorted(Acc.keys()):
+        for p, period in enumerate(Names):
+            name = 'mode' + str(code) + '_' + str(period)
+            if not sparse:
+                Mats.append((name, Acc[code][p]))
+                continue
+            import scipy.sparse
+            Keys, Sums = Acc[code]
+            use = slice(np.searchsorted(Keys, p*numZn*numZn), np.searchsorted(Keys, (p + 1)*numZn*numZn))
+            Cells = Keys[use] - p*numZn*numZn
+            Mats.append((name, scipy.sparse.csr_matrix((Sums[use], (Cells//numZn, Cells%numZn)), shape=(numZn, numZn))))
+    if matfn is not None:
+        Stored = Mats if not sparse else [(name + part, getattr(mat, part[1:])) for name, mat in Mats for part in ['.data', '.indices', '.indptr']]
+        MatrixIO.WriteMatrices(matfn, Stored, zoneIDs=zoneIDs, attrs={'periods':[list(period) for period in periods], 'sparse':bool(sparse),
+                               'dropped':int(dropped), 'sources':[[fn, MatrixIO.SourceStamp(fn)] for fn in daysimtripfiles]})
+    print('Aggregated daysim trips to ' + str(len(Mats)) + ' matrices in ' + str(time.time()-start) + ' secs, ' + str(dropped) +
+          ' trips outside the zones/periods/modes')
+    return dict(Mats)
+
 #--- usage | in general the first variant takes twice the time, but examines each row one at a time -------- #
-dsfile = r"C:\Projects\Tests\data\_trip_2.dat"
-##
-##cnxn, trip_dat = GetDaySimTripsDB1(dsfile)
-##
-##del cnxn, trip_dat
+if __name__ == '__main__':
+    dsfile = r"C:\Projects\Tests\data\_trip_2.dat"
+    ##
+    ##cnxn, trip_dat = GetDaySimTripsDB1(dsfile)
+    ##
+    ##del cnxn, trip_dat
 
-cnxn, trip_dat = GetDaySimTripsDB2(dsfile)
+    cnxn, trip_dat = GetDaySimTripsDB2(dsfile)
 
-del cnxn, trip_dat
+    del cnxn, trip_dat
 
 
 
@@ -4,9 +4,10 @@
 #              **All input vectors are expected to be numpy arrays, some data exchange steps use methods from Visum for which this 
 #              script was prototyped. User should replace that with appropriate functions to parse their own data - see sample data  
 #              for some hints on formatting, esp the flow matrix 
+#              This script is the Visum driver, the estimation engine itself is in ODME and runs without Visum
 #
 # Author:      Chetan Joshi, Portland OR
-# Dependencies:numpy [http://www.numpy.org], scipy [https://www.scipy.org/], time 
+# Dependencies:numpy [http://www.numpy.org], ODME, MatrixIO 
 # Created:     12/14/2017
 #              
 # Copyright:   (c) Chetan Joshi 2017
@@ -29,10 +30,10 @@
 #              SOFTWARE.
 #--------------------------------------------------------------------------------------------------------------------------------------------------------------------#
 import numpy as np
-import scipy.sparse
+import os
 import VisumPy.helpers as VPH
-import csv
-import time
+import MatrixIO
+from ODME import EstimateMatrix, ReEstimateMatrix, loadFlowMat, ExtendCounts
 #Least squares matrix estimation with gradient method - Chetan Joshi, Klaus Noekel 
 
 #------------User input -----------------------------------------------------------------#
@@ -41,93 +42,54 @@ countAttrID = "AddVal1"
 wtAttrID = "AddVal2"
 wtOD = 42
 flowmatfile = r"C:\Projects\KA_Work\LSODME\FlowMatrix.mtx"
+method = 'gradient'   # 'gradient', 'cg' or 'lbfgsb', see ODME.EstimateMatrix
+tol = 0.0             # relative objective change to stop at, 0.0 = run all iterations
+statefile = ""        # e.g. r"C:\Projects\KA_Work\LSODME\ODMEState.tdm" to save the result state and re-estimate from it with changed counts/weights, "" = always full run
 #----------------------------------------------------------------------------------------#
 
-#Matrix estimation function: takes flow prportion matrix, OD seed, Count and returns adjusted matrix: Chetan Joshi, updated by Klaus Noekel
-def EstimateMatrix(FlowProp, FlowPropT, OD_Flows, Ca, Wt, iter=25):
-    Va = FlowPropT.dot(OD_Flows)
-    Visum.WriteToTrace('Length of Va' + str(len(Va)))
-    Visum.WriteToTrace('Length of Ca' + str(len(Ca)))
-    Z = sum((Va-Ca)**2)
-    Visum.WriteToTrace('Starting Z =' + str(Z))
-    #print 'Starting Z =', Z
-
-    for i in range(1, iter):
-        t1 = time.time()
-        Grad = FlowProp.dot((Va - Ca)*Wt) 
-        Va_prime = FlowPropT.dot(-OD_Flows * Grad)
-        lambda_opt = sum((Ca - Va)*Va_prime)/sum(Va_prime*Va_prime) 
-        if Grad.max()> 0:
-            lambda_opt = min(lambda_opt, 1/Grad.max())
-        OD_Flows = OD_Flows*(1 - lambda_opt*Grad) #variant - 1.1
-        OD_Flows[OD_Flows<0]=0 #remove very small -0.0 values from matrix if any...
-        Va = FlowPropT.dot(OD_Flows)
-        Z = sum((Va-Ca)**2)
-        t2 = time.time()
-        if  Z < 1:
-            break;
-        else:
-            Visum.WriteToTrace(str(i) + ': Z =' + str(Z), True)
-
-    Visum.WriteToTrace('Final Z =' + str(Z), True)
-    return OD_Flows
-
-def readFlowMat(nODs, nLinks, filename):
-    t1 = time.time()
-    with open(filename, "rb") as f:
-        reader = csv.reader(f, delimiter='\t')
-        for i in xrange(0, 12):
-            reader.next()
-        i = []
-        j = []
-        data = []
-        for row in reader: #each row = CountIndex \t ODIndex \t proportion
-            if row[0] == "": continue
-            if row[0].startswith("*"): continue
-            if row[0].startswith("0"): continue
-            i.append(long(row[1])-1)
-            j.append(long(row[0])-1)
-            data.append(float(row[2]))        
-    
-    ix = j[-1] + 1
-    z = max(i)
-    for k in xrange(len(Sparse_OD)):
-        # j-> link
-        i.append(long(k)) #index of od pair
-        j.append(long(ix))#index of link
-        data.append(1.0)
-        ix+=1
-        
-    FlowProp = scipy.sparse.csr_matrix((data, (i,j)), shape=(len(Sparse_OD), nLinks+nODs), dtype='d')
-    #Visum.WriteToTrace([[k, z, i[-1],j[-1]], [len(i), len(j)]])
-    t2 = time.time()
-    Visum.WriteToTrace("read flow mat: " + str(t2-t1) , True)
-
-    return FlowProp
+def WriteToTrace(msg):
+    Visum.WriteToTrace(msg, True)
 
 #--------------------------------------------------------------------------------------------------------
 Ca = np.array(VPH.GetMulti(Visum.Net.Links, countAttrID, True))
 Wt = np.array(VPH.GetMulti(Visum.Net.Links, wtAttrID, True))
 AssignedOD = VPH.GetMatrixRaw(Visum, matno).flatten() #Get the flattened seed matrix
-WeightOD = VPH.GetMatrixRaw(Visum, wtOD).flatten()   #Get the flattened weight matrix
-SparseWeightOD = WeightOD.compress(AssignedOD > 0).copy()
-Sparse_OD = AssignedOD.compress(AssignedOD > 0).copy() #Get only cells > 0 to reduce array size
 nLinks = Visum.Net.Links.CountActive # Get the number of active links based on filter - will be extended to turns if turns are used
-#OD_constraint_block = numpy.identity(len(Sparse_OD)) 
-Ca = np.append(Ca, Sparse_OD) #Extend the count array  to include delta with the existing OD matrix on the least squares formulation             
-#Wt = np.append(Wt, np.ones(len(Sparse_OD))) #Extend the weight array for weight matrix using default of 1.0, should be changed to
-Wt = np.append(Wt, SparseWeightOD) #Extend the weight array for weight matrix using default of 1.0, weight matrix values should be varied for testing 
 
-FlowProp = readFlowMat(len(Sparse_OD), nLinks, flowmatfile)
-FlowPropT = scipy.sparse.csc_matrix(FlowProp.T)
+NewODFlows = None
+if statefile and os.path.exists(statefile):
+    #matno holds the last result now, the seed OD block and its cells come from the saved state
+    if not os.path.exists(statefile + '.cells'):
+        WriteToTrace(statefile + '.cells not found, running a full estimation')
+    else:
+        try:
+            Cells = MatrixIO.ReadMatrix(statefile + '.cells', 'cells')
+            if not np.allclose(AssignedOD[Cells], MatrixIO.ReadMatrix(statefile, 'OD'), rtol=1e-6):
+                raise ValueError('matrix ' + str(matno) + ' is not the last result (new seed?)')
+            FlowProp, FlowPropT = loadFlowMat(len(Cells), nLinks, flowmatfile, log=WriteToTrace)
+            NewODFlows = ReEstimateMatrix(FlowProp, FlowPropT, statefile, Ca, Wt, iter=25, log=WriteToTrace, method=method, tol=tol)
+        except (ValueError, IndexError) as err:  #new seed, new zones, new assignment (flow matrix) or not a state file
+            WriteToTrace('state ' + statefile + ' can not be used (' + str(err) + '), running a full estimation')
+if NewODFlows is None:
+    WeightOD = VPH.GetMatrixRaw(Visum, wtOD).flatten()   #Get the flattened weight matrix
+    Cells = np.flatnonzero(AssignedOD > 0) #Get only cells > 0 to reduce array size
+    SparseWeightOD = WeightOD[Cells]
+    Sparse_OD = AssignedOD[Cells]
+    #OD_constraint_block = numpy.identity(len(Sparse_OD)) 
+    Ca, Wt = ExtendCounts(Ca, Wt, Sparse_OD, SparseWeightOD) #Extend the count and weight arrays to include delta with the existing OD matrix on the least squares formulation
+
+    FlowProp, FlowPropT = loadFlowMat(len(Sparse_OD), nLinks, flowmatfile, log=WriteToTrace)
 
-Visum.WriteToTrace(FlowPropT.shape)
-Visum.WriteToTrace(FlowProp.shape)
+    Visum.WriteToTrace(FlowPropT.shape)
+    Visum.WriteToTrace(FlowProp.shape)
 
-NewODFlows = EstimateMatrix(FlowProp, FlowPropT, Sparse_OD, Ca, Wt, iter=25)
+    NewODFlows = EstimateMatrix(FlowProp, FlowPropT, Sparse_OD, Ca, Wt, iter=25, log=WriteToTrace, method=method, tol=tol,
+                                statefile=statefile or None)
+    if statefile:
+        MatrixIO.WriteMatrices(statefile + '.cells', {'cells':Cells})
 
 #Set back result to Visum...
-AssignedOD[AssignedOD>0] = NewODFlows
+AssignedOD[Cells] = NewODFlows
 nZones = Visum.Net.Zones.Count
 VPH.SetMatrixRaw(Visum, matno, AssignedOD.reshape((nZones,nZones)))
 Visum.WriteToTrace("results stored" , True)
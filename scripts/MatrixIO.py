@@ -0,0 +1,335 @@
+#----------------------------------------------------------------------------------------------------------------------------------------------------------------------#
+# Name:        MatrixIO
+# Purpose:     Reading and writing of matrices for the demand model steps.
+#               a) WriteMatrices : Writes many named matrices to one self-describing container file (shape, dtype, zone ids, names)
+#                  with optional per-matrix zlib compression
+#               b) ReadHeader : Reads only the header of a container file
+#               c) ReadMatrix : Reads one matrix from a container file, uncompressed matrices are zero-copy numpy.memmap views
+#               d) ReadMatrices : Reads several/all matrices of a container file into a dictionary
+#               e) ZoneIndex : Zone id --> matrix index lookup for a container file
+#               f) ReadVisumOD / WriteVisumOD : Bulk reader and writer for the Visum $O;D3 list format (header, then from to value rows)
+#               g) IterNumericRows : Chunked bulk parser for whitespace/tab separated numeric text, no per-line python work
+#               h) SourceStamp / ReadCacheHeader : Binary sidecar caches of text inputs, keyed on the source file size and mtime
+#
+#              Container layout: 8 byte magic, 8 byte header length, JSON header, then each matrix at a 64 byte aligned offset, so
+#              loading one core out of a large skim file only touches the bytes of that core.
+#
+# Author:      python-tdm contributors
+# Dependencies:numpy [www.numpy.org], json, os, struct, zlib, scipy [https://www.scipy.org/] (optional, sparse output)
+# Created:     10/18/2026
+#
+# Copyright:   (c) python-tdm contributors 2026
+# Licence:     Permission is hereby granted, free of charge, to any person obtaining a copy
+#              of this software and associated documentation files (the "Software"), to deal
+#              in the Software without restriction, including without limitation the rights
+#              to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#              copies of the Software, and to permit persons to whom the Software is
+#              furnished to do so, subject to the following conditions:
+#
+#              The above copyright notice and this permission notice shall be included in all
+#              copies or substantial portions of the Software.
+#
+#              THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#              IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#              FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#              AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#              LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#              OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#              SOFTWARE.
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------#
+import numpy as np
+import json
+import os
+import struct
+import zlib
+
+MAGIC = b'TDMMTX01'
+ALIGN = 64
+
+def _Aligned(offset):
+    return (offset + ALIGN - 1)//ALIGN*ALIGN
+
+def _JsonValue(obj):
+    '''Lets numpy scalars and arrays go into the JSON header'''
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return obj.item()
+
+def WriteMatrices(fn, Mats, zoneIDs = None, compress = None, attrs = None):
+    '''Writes named matrices to one container file
+       fn = file name
+       Mats = dictionary of name --> numpy array, or list of (name, array) pairs to keep the order
+       ex. Mats = {'time':mat1, 'dist':mat2, 'toll':mat3}
+       zoneIDs (optional) = zone numbers corresponding to the matrix rows/columns
+       compress (optional) = None (no compression), True (all matrices) or list of matrix names to zlib compress
+       attrs (optional) = dictionary of extra JSON serializable information stored in the header
+       Returns header dictionary
+    '''
+    if isinstance(Mats, dict):
+        Mats = [(name, Mats[name]) for name in sorted(Mats.keys())]
+    Entries = []
+    Blocks = []
+    for name, mat in Mats:
+        mat = np.ascontiguousarray(mat)
+        entry = {'name':name, 'dtype':mat.dtype.str, 'shape':list(mat.shape), 'nbytes':mat.nbytes, 'compression':None}
+        if compress is True or (compress and name in compress):
+            mat = zlib.compress(mat.tobytes(), 6)  #compressed matrices are held in memory until written
+            entry['compression'] = 'zlib'
+            entry['nbytes'] = len(mat)
+        Entries.append(entry)
+        Blocks.append(mat)
+
+    header = {'zones':None if zoneIDs is None else [int(z) for z in zoneIDs], 'attrs':attrs or {}, 'matrices':Entries}
+    #offsets depend on the header length and the header holds the offsets, so size the header with placeholders first --->
+    for entry in Entries:
+        entry['offset'] = 0
+    headerLen = len(json.dumps(header, default=_JsonValue).encode('utf-8')) + 24*len(Entries) + 16
+    offset = _Aligned(16 + headerLen)
+    for entry in Entries:
+        entry['offset'] = offset
+        offset = _Aligned(offset + entry['nbytes'])
+    text = json.dumps(header, default=_JsonValue).encode('utf-8')
+    text = text + b' '*(headerLen - len(text))
+
+    f = open(fn, 'wb')
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', headerLen))
+    f.write(text)
+    for entry, block in zip(Entries, Blocks):
+        f.seek(entry['offset'])
+        if isinstance(block, bytes):
+            f.write(block)
+        else:
+            block.tofile(f)
+    f.truncate(offset)
+    f.close()
+    return header
+
+def ReadHeader(fn):
+    '''Reads the header of a container file without touching the matrix data
+       Returns header dictionary --> {'zones':[...], 'attrs':{...}, 'matrices':[{'name', 'dtype', 'shape', 'offset', 'nbytes', 'compression'}, ...]}
+    '''
+    f = open(fn, 'rb')
+    if f.read(8) != MAGIC:
+        f.close()
+        raise ValueError(fn + ' is not a matrix container file')
+    headerLen = struct.unpack('<Q', f.read(8))[0]
+    header = json.loads(f.read(headerLen).decode('utf-8'))
+    f.close()
+    return header
+
+def _Entry(header, name):
+    for entry in header['matrices']:
+        if entry['name'] == name:
+            return entry
+    raise KeyError(name)
+
+def ReadMatrix(fn, name, mode = 'r', header = None):
+    '''Reads one matrix of a container file
+       fn = file name
+       name = matrix name
+       mode (optional) = numpy.memmap mode for uncompressed matrices, 'r' (default), 'r+' to update in place or 'c' copy on write
+       header (optional) = header from ReadHeader, avoids re-reading it when pulling several matrices
+       Returns numpy.memmap view (uncompressed) or numpy array (compressed) with the stored shape and dtype
+    '''
+    if header is None:
+        header = ReadHeader(fn)
+    entry = _Entry(header, name)
+    shape = tuple(entry['shape'])
+    if entry['compression'] is None:
+        if entry['nbytes'] == 0:
+            return np.zeros(shape, dtype=entry['dtype'])
+        return np.memmap(fn, dtype=entry['dtype'], mode=mode, offset=entry['offset'], shape=shape)
+    f = open(fn, 'rb')
+    f.seek(entry['offset'])
+    data = zlib.decompress(f.read(entry['nbytes']))
+    f.close()
+    return np.frombuffer(data, dtype=entry['dtype']).reshape(shape).copy()
+
+def ReadMatrices(fn, names = None, mode = 'r'):
+    '''Reads several matrices of a container file
+       fn = file name
+       names (optional) = list of matrix names, default is all matrices in the file
+       mode (optional) = numpy.memmap mode for uncompressed matrices, default is 'r'
+       Returns dictionary of name --> matrix
+    '''
+    header = ReadHeader(fn)
+    if names is None:
+        names = [entry['name'] for entry in header['matrices']]
+    return dict((name, ReadMatrix(fn, name, mode, header)) for name in names)
+
+def ZoneIndex(fn):
+    '''Returns dictionary of zone number --> row/column index for a container file written with zoneIDs'''
+    zones = ReadHeader(fn)['zones'] or []
+    return dict((z, i) for i, z in enumerate(zones))
+
+_SPACE = np.zeros(256, dtype=bool)
+_SPACE[[9, 10, 11, 12, 13, 32]] = True  #bytes np.fromstring(sep=' ') treats as separators
+
+def _BadRow(data, ncols):
+    '''Index and text of the first line of data that is not blank and does not hold ncols numbers'''
+    for i, line in enumerate(data.split(b'\n')):
+        tokens = line.split()
+        if not tokens:
+            continue
+        try:
+            [float(token) for token in tokens]
+        except ValueError:
+            return i, line
+        if len(tokens) != ncols:
+            return i, line
+    return None, b''
+
+def _ParseRows(data, ncols, comment, firstRow = 1):
+    '''Parses a chunk of whole lines, np.fromstring stops without an error at the first token that is not a number, so the
+       parsed values are checked against the tokens of every line and a ValueError names the first bad row
+       firstRow = row number of the first line of data (counted from the first data row), for the error message
+    '''
+    if comment is not None and comment in data:
+        data = b'\n'.join([b'' if line.lstrip().startswith(comment) else line for line in data.split(b'\n')]) #keeps the row numbers
+    try:
+        values = np.fromstring(data, sep=' ')  #whitespace in sep matches any run of spaces, tabs and newlines
+    except ValueError:  #newer numpy raises instead of stopping
+        values = np.zeros(0)
+    chars = np.frombuffer(data, dtype=np.uint8)
+    space = _SPACE[chars]
+    starts = np.flatnonzero(space[:-1] & ~space[1:]) + 1  #first byte of every token
+    if len(space) and not space[0]:
+        starts = np.concatenate([[0], starts])
+    lineTokens = np.diff(np.searchsorted(starts, np.concatenate([[0], np.flatnonzero(chars == 10), [len(chars)]])))
+    if values.size != len(starts) or ((lineTokens != 0) & (lineTokens != ncols)).any():
+        i, line = _BadRow(data, ncols)
+        raise ValueError('numeric text row ' + str(firstRow + (i or 0)) + ' does not have ' + str(ncols) + ' numbers: ' +
+                         repr(line.strip()))
+    return values.reshape(-1, ncols)
+
+def IterNumericRows(f, ncols, chunkBytes = 16*1024*1024, comment = b'*', stop = b'$'):
+    '''Bulk parses whitespace/tab separated numeric rows from a file opened in binary mode, one chunk of text at a time
+       f = open file (binary mode) positioned at the first data row
+       ncols = number of values on every row
+       chunkBytes (optional) = bytes of text parsed per chunk, default is 16 MB
+       comment (optional) = lines starting with this are skipped, default is '*'
+       stop (optional) = a line starting with this ends the data (f is left positioned on it), default is '$'
+       Yields float arrays of shape (rows, ncols), raises ValueError naming the row if a row does not hold ncols numbers
+    '''
+    tail = b''
+    firstRow = 1
+    while True:
+        chunkStart = f.tell() - len(tail)
+        data = f.read(chunkBytes)
+        if not data:
+            break
+        data = tail + data
+        if stop is not None:
+            at = (b'\n' + data).find(b'\n' + stop)
+            if at >= 0:
+                f.seek(chunkStart + at)
+                tail = data[:at]
+                break
+        cut = data.rfind(b'\n') + 1
+        tail = data[cut:]
+        if cut > 0:
+            rows = _ParseRows(data[:cut], ncols, comment, firstRow)
+            firstRow += data.count(b'\n', 0, cut)
+            if len(rows):
+                yield rows
+    if tail.strip():
+        yield _ParseRows(tail, ncols, comment, firstRow)
+
+def _ReadHeaderLine(f):
+    '''Next line of a Visum text file that is not blank or a comment'''
+    for line in iter(f.readline, b''):
+        if line.strip() and not line.startswith(b'*'):
+            return line
+    return b''
+
+def ReadVisumOD(fn, zoneIDs = None, sparse = False, chunkBytes = 16*1024*1024):
+    '''Reads a Visum $O;D3 list format matrix
+       fn = file name
+       zoneIDs (optional) = zone numbers for the rows/columns, default is the $NAMES section of the file, else all zones found in the data
+       sparse (optional) = return a scipy.sparse.csr_matrix instead of a dense array, default is False
+       chunkBytes (optional) = bytes of text parsed per chunk, default is 16 MB
+       Returns matrix (values multiplied by the file factor, duplicate cells are summed) and array of zone numbers
+    '''
+    f = open(fn, 'rb')
+    if not _ReadHeaderLine(f).startswith(b'$O'):
+        f.close()
+        raise ValueError(fn + ' is not a Visum $O matrix file')
+    _ReadHeaderLine(f)  #time interval
+    factor = float(_ReadHeaderLine(f).split()[0])
+    Rows = list(IterNumericRows(f, 3, chunkBytes))
+    Rows = np.concatenate(Rows) if Rows else np.zeros((0, 3))
+    #Optional sections after the data, $NAMES lists every zone number --->
+    NameZones = []
+    section = None
+    for line in iter(f.readline, b''):
+        if line.startswith(b'$'):
+            section = line.strip()
+        elif section == b'$NAMES' and line.strip() and not line.startswith(b'*'):
+            NameZones.append(int(line.split()[0]))
+    f.close()
+
+    Orig = Rows[:, 0].astype(np.int64)
+    Dest = Rows[:, 1].astype(np.int64)
+    if zoneIDs is None:
+        zoneIDs = np.array(NameZones) if NameZones else np.unique(np.concatenate([Orig, Dest]))
+    zoneIDs = np.asarray(zoneIDs, dtype=np.int64)
+    order = np.argsort(zoneIDs)
+    SortedZones = zoneIDs[order]
+    numZn = len(zoneIDs)
+    OrigIx = np.minimum(np.searchsorted(SortedZones, Orig), max(numZn - 1, 0))
+    DestIx = np.minimum(np.searchsorted(SortedZones, Dest), max(numZn - 1, 0))
+    if len(Rows) and ((SortedZones[OrigIx] != Orig).any() or (SortedZones[DestIx] != Dest).any()):
+        raise ValueError(fn + ' has zones that are not in zoneIDs')
+    OrigIx = order[OrigIx]
+    DestIx = order[DestIx]
+    values = Rows[:, 2]*factor
+    if sparse:
+        import scipy.sparse
+        return scipy.sparse.csr_matrix((values, (OrigIx, DestIx)), shape=(numZn, numZn)), zoneIDs
+    return np.bincount(OrigIx*numZn + DestIx, weights=values, minlength=numZn*numZn).reshape(numZn, numZn), zoneIDs
+
+def WriteVisumOD(fn, mat, zoneIDs, factor = 1.0, title = '', chunkRows = 1000000, fmt = '%.10g'):
+    '''Writes a matrix in the Visum $O;D3 list format, only non-zero cells are written
+       fn = file name
+       mat = dense array or scipy.sparse matrix
+       zoneIDs = zone numbers for the rows/columns
+       factor (optional) = factor written to the header (at full precision), values are divided by it, default is 1.0
+       title (optional) = comment written in the header
+       chunkRows (optional) = rows formatted per chunk, default is 1000000
+       fmt (optional) = printf format of the values, default is '%.10g' (10 significant digits, small values are not rounded to 0)
+    '''
+    zoneIDs = np.asarray(zoneIDs)
+    if hasattr(mat, 'tocoo'):
+        coo = mat.tocoo()
+        use = coo.data != 0
+        Orig, Dest, values = coo.row[use], coo.col[use], coo.data[use]
+        order = np.lexsort((Dest, Orig))
+        Orig, Dest, values = Orig[order], Dest[order], values[order]
+    else:
+        Orig, Dest = np.nonzero(mat)
+        values = mat[Orig, Dest]
+    f = open(fn, 'wb')
+    f.write(('$O;D3\n* From  to\n0.00 0.00\n* Factor\n%s\n*  \n* %s\n' % (repr(float(factor)), title)).encode('utf-8'))
+    for r in range(0, len(values), chunkRows):
+        rows = np.column_stack([zoneIDs[Orig[r:r + chunkRows]], zoneIDs[Dest[r:r + chunkRows]], values[r:r + chunkRows]/factor])
+        np.savetxt(f, rows, fmt='%10d %10d ' + fmt + ' ')
+    f.write(b'* Network object names\n$NAMES\n')
+    np.savetxt(f, zoneIDs[:, np.newaxis], fmt='%d ""')
+    f.close()
+
+def SourceStamp(fn):
+    '''Size and modification time of a source file, stored in the attrs of the cache built from it'''
+    return {'size':os.path.getsize(fn), 'mtime':os.path.getmtime(fn)}
+
+def ReadCacheHeader(cachefn, sourcefn):
+    '''Header of a cache container if it exists and was built from the current version of sourcefn (attrs['source']), else None'''
+    if not os.path.exists(cachefn):
+        return None
+    try:
+        header = ReadHeader(cachefn)
+    except ValueError:
+        return None
+    if header['attrs'].get('source') != SourceStamp(sourcefn):
+        return None
+    return header
@@ -0,0 +1,457 @@
+#----------------------------------------------------------------------------------------------------------------------------------------------------------------------#
+# Name:        ODME
+# Purpose:     Headless OD-matrix estimation with least squares formulation, solution method is with gradient method. See Spiess 1990
+#              Pure numpy/scipy engine with no Visum session, inputs come from files or arrays:
+#               a) EstimateMatrix : adjusts a (sparse) seed OD vector to counts given the flow proportion matrix,
+#                  solvers: gradient method (default), projected conjugate gradient or L-BFGS-B
+#               b) readFlowMat / loadFlowMat : path flow proportion file --> FlowProp, with a binary sidecar cache
+#                  BuildFlowMat : FlowProp from flow proportion arrays
+#               c) ReadLinkCounts : counts (and weights) from a Visum .att style tab separated link attribute file
+#               d) ReadSeed : seed matrix from a Visum $O;D3 file as the non-zero OD vector
+#               e) ExtendCounts : appends the seed OD block to the count and weight vectors of the least squares formulation
+#               f) EstimateFromFiles : runs a full estimation from count, seed and flow proportion files (or arrays)
+#               g) EstimateMatrixBatch / ExtendCountsBatch : several classes or periods at once with sparse matrix-matrix products
+#               h) SaveState / LoadState / ReEstimateMatrix : warm started re-estimation after a few counts or weights changed
+#              MatEstimateGradient is the Visum driver for this module, BenchmarkODME times it on test_data/least_squares
+#
+# Author:      Chetan Joshi, Portland OR
+# Dependencies:numpy [http://www.numpy.org], scipy [https://www.scipy.org/], time, MatrixIO 
+# Created:     12/14/2017
+#              
+# Copyright:   (c) Chetan Joshi 2017
+# Licence:     Permission is hereby granted, free of charge, to any person obtaining a copy
+#              of this software and associated documentation files (the "Software"), to deal
+#              in the Software without restriction, including without limitation the rights
+#              to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#              copies of the Software, and to permit persons to whom the Software is
+#              furnished to do so, subject to the following conditions:
+#
+#              The above copyright notice and this permission notice shall be included in all
+#              copies or substantial portions of the Software.
+#
+#              THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#              IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#              FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#              AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#              LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#              OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#              SOFTWARE.
+#--------------------------------------------------------------------------------------------------------------------------------------------------------------------#
+import numpy as np
+import scipy.sparse
+import time
+import MatrixIO
+#Least squares matrix estimation with gradient method - Chetan Joshi, Klaus Noekel
+
+def _Print(msg):
+    print(msg)
+
+def _Objective(Va, Ca, Wt):
+    '''Weighted least squares objective 0.5*sum(Wt*(Va-Ca)^2) minimized by the cg and lbfgsb solvers'''
+    return 0.5*(Wt*(Va-Ca)**2).sum()
+
+def _Record(Diag, i, Z, step, start):
+    Diag['iterations'] = i
+    Diag['Z'].append(float(Z))
+    Diag['step'].append(float(step))
+    Diag['elapsed'].append(time.time() - start)
+
+def _RelChange(Fprev, F):
+    return (Fprev - F)/max(abs(Fprev), abs(F), 1e-12)
+
+def _StartState(FlowProp, FlowPropT, OD_Flows, Ca, Wt, Diag, Start):
+    '''Va and Grad at the starting OD vector, from Start (warm start, see ReEstimateMatrix) or Va from one flow matrix product'''
+    if Start is not None:
+        return Start['Va'], Start.get('Grad')
+    Diag['products'] += 1
+    return FlowPropT.dot(OD_Flows), None
+
+#Matrix estimation function: takes flow prportion matrix, OD seed, Count and returns adjusted matrix: Chetan Joshi, updated by Klaus Noekel
+def _EstimateGradient(FlowProp, FlowPropT, OD_Flows, Ca, Wt, iter, tol, log, Diag, Start):
+    start = time.time()
+    Va, Grad = _StartState(FlowProp, FlowPropT, OD_Flows, Ca, Wt, Diag, Start)
+    Z = ((Va-Ca)**2).sum()
+    _Record(Diag, 0, Z, 0.0, start)
+    log('Starting Z =' + str(Z))
+
+    for i in range(1, iter):
+        if Grad is None:
+            Grad = FlowProp.dot((Va - Ca)*Wt)
+            Diag['products'] += 1
+        Va_prime = FlowPropT.dot(-OD_Flows * Grad)
+        lambda_opt = ((Ca - Va)*Va_prime).sum()/(Va_prime*Va_prime).sum()
+        if Grad.max()> 0:
+            lambda_opt = min(lambda_opt, 1/Grad.max())
+        OD_Flows = OD_Flows*(1 - lambda_opt*Grad) #variant - 1.1
+        OD_Flows[OD_Flows<0]=0 #remove very small -0.0 values from matrix if any...
+        Va = FlowPropT.dot(OD_Flows)
+        Grad = None
+        Diag['products'] += 2
+        Zprev, Z = Z, ((Va-Ca)**2).sum()
+        _Record(Diag, i, Z, lambda_opt, start)
+        if  Z < 1:
+            break;
+        else:
+            log(str(i) + ': Z =' + str(Z))
+            if tol > 0 and _RelChange(Zprev, Z) < tol:
+                break
+    return OD_Flows, Va
+
+def _EstimateCG(FlowProp, FlowPropT, OD_Flows, Ca, Wt, iter, tol, log, Diag, Start):
+    '''Conjugate gradient (Polak-Ribiere+) preconditioned with diag(OD), so the first step is the gradient method step and
+    cells approach 0 slowly; exact line search on the quadratic, step clipped where the first cell reaches 0 and restart
+    from the scaled gradient after a bound hit. Two flow matrix products per iteration.
+    '''
+    start = time.time()
+    OD_Flows = OD_Flows.copy()
+    Va, Grad = _StartState(FlowProp, FlowPropT, OD_Flows, Ca, Wt, Diag, Start)
+    Va = Va.copy()
+    if Grad is None:
+        Grad = FlowProp.dot((Va - Ca)*Wt)
+        Diag['products'] += 1
+    Z = ((Va-Ca)**2).sum()
+    F = _Objective(Va, Ca, Wt)
+    _Record(Diag, 0, Z, 0.0, start)
+    log('Starting Z =' + str(Z))
+
+    Dir = None
+    for i in range(1, iter):
+        SGrad = OD_Flows*Grad
+        gg = (Grad*SGrad).sum()
+        if gg <= 0:
+            break
+        if Dir is None:
+            Dir = -SGrad #restart
+        else:
+            beta = max(0.0, (SGrad*(Grad - GradPrev)).sum()/ggPrev) #Polak-Ribiere+
+            Dir = -SGrad + beta*Dir
+            if (Dir*Grad).sum() >= 0:
+                Dir = -SGrad
+        GradPrev, ggPrev = Grad, gg
+
+        AD = FlowPropT.dot(Dir)
+        curv = (Wt*AD*AD).sum()
+        if curv <= 0:
+            break
+        step = -(Grad*Dir).sum()/curv #exact minimizer along Dir
+        Neg = Dir < 0
+        maxStep = (OD_Flows[Neg]/-Dir[Neg]).min() if Neg.any() else step
+        if maxStep < step: #bound hit: project the full step onto OD >= 0, keep it if it beats stopping at the first bound
+            Proj = np.maximum(OD_Flows + step*Dir, 0)
+            VaProj = FlowPropT.dot(Proj)
+            Diag['products'] += 1
+            if _Objective(VaProj, Ca, Wt) < _Objective(Va + maxStep*AD, Ca, Wt):
+                OD_Flows, Va = Proj, VaProj
+            else:
+                step = maxStep
+                OD_Flows += step*Dir
+                Va += step*AD
+            Dir = None #restart from the scaled gradient
+        else:
+            OD_Flows += step*Dir
+            Va += step*AD
+        OD_Flows[OD_Flows<0]=0 #remove very small -0.0 values from matrix if any...
+        Grad = FlowProp.dot((Va - Ca)*Wt)
+        Diag['products'] += 2
+
+        Fprev, F = F, _Objective(Va, Ca, Wt)
+        Z = ((Va-Ca)**2).sum()
+        _Record(Diag, i, Z, step, start)
+        if Z < 1:
+            break
+        log(str(i) + ': Z =' + str(Z))
+        if tol > 0 and _RelChange(Fprev, F) < tol:
+            break
+    return OD_Flows, Va
+
+def _EstimateLBFGSB(FlowProp, FlowPropT, OD_Flows, Ca, Wt, iter, tol, log, Diag, Start):
+    '''L-BFGS-B (scipy.optimize.fmin_l_bfgs_b) with bounds OD >= 0, two flow matrix products per function evaluation'''
+    import scipy.optimize
+    start = time.time()
+    Last = {}
+
+    def Func(x):
+        Va = FlowPropT.dot(x)
+        Res = Va - Ca
+        Diag['products'] += 2
+        Last['x'], Last['Z'] = x.copy(), (Res**2).sum()
+        return 0.5*(Wt*Res**2).sum(), FlowProp.dot(Res*Wt)
+
+    def Callback(x):
+        if np.array_equal(x, Last['x']):
+            Z = Last['Z']
+        else:
+            Z = ((FlowPropT.dot(x) - Ca)**2).sum()
+            Diag['products'] += 1
+        _Record(Diag, len(Diag['Z']), Z, np.sqrt(((x - Last['prev'])**2).sum()), start)
+        log(str(Diag['iterations']) + ': Z =' + str(Z))
+        Last['prev'] = x.copy()
+
+    Last['prev'] = OD_Flows.copy()
+    Va, Grad = _StartState(FlowProp, FlowPropT, OD_Flows, Ca, Wt, Diag, Start)
+    _Record(Diag, 0, ((Va - Ca)**2).sum(), 0.0, start)
+    log('Starting Z =' + str(Diag['Z'][0]))
+    factr = tol/np.finfo(float).eps if tol > 0 else 10.0
+    x, F, Info = scipy.optimize.fmin_l_bfgs_b(Func, OD_Flows.astype('d'), bounds=[(0, None)]*len(OD_Flows),
+                                              maxiter=max(iter - 1, 1), factr=factr, callback=Callback)
+    x[x<0]=0
+    Diag['products'] += 1
+    return x, FlowPropT.dot(x)
+
+def EstimateMatrix(FlowProp, FlowPropT, OD_Flows, Ca, Wt, iter=25, log = None, method = 'gradient', tol = 0.0, getDiagnostics = 0,
+                   statefile = None, start = None):
+    '''FlowProp = flow proportion matrix (nODs, nLinks+nODs), see loadFlowMat
+    FlowPropT = transpose of FlowProp
+    OD_Flows = seed OD vector (non-zero cells of the seed matrix)
+    Ca = count vector extended with the seed OD vector, see ExtendCounts
+    Wt = weight vector extended with the OD weights, see ExtendCounts
+    iter (optional) = maximum iterations, default is 25
+    log (optional) = function taking a message string, default is print
+    method (optional) = 'gradient' (multiplicative gradient method, Spiess 1990) or, for the weighted least squares objective
+                        0.5*sum(Wt*(Va-Ca)^2) with OD >= 0, 'cg' (projected conjugate gradient) or 'lbfgsb' (scipy L-BFGS-B)
+    tol (optional) = stop when the relative decrease of the objective in an iteration is below tol, default 0.0 = run to iter (or Z < 1)
+    getDiagnostics (optional) 0=no, <>0=yes --> also return dict {'method':m, 'iterations':n, 'Z':[...], 'step':[...], 'elapsed':[...], 'products':n},
+                     the lists start with the starting Z (step 0) followed by one entry per iteration
+    statefile (optional) = save the result, Va, the gradient, Ca and Wt to this MatrixIO container for ReEstimateMatrix
+    start (optional) = dict {'Va':..., 'Grad':...} at OD_Flows for a warm start, used by ReEstimateMatrix
+    Returns adjusted OD vector
+    '''
+    log = log or _Print
+    Solvers = {'gradient':_EstimateGradient, 'cg':_EstimateCG, 'lbfgsb':_EstimateLBFGSB}
+    if method not in Solvers:
+        raise ValueError("method must be one of 'gradient', 'cg', 'lbfgsb'")
+    log('Length of Va' + str(FlowPropT.shape[0]))
+    log('Length of Ca' + str(len(Ca)))
+    Diag = {'method':method, 'iterations':0, 'Z':[], 'step':[], 'elapsed':[], 'products':0}
+    OD_Flows, Va = Solvers[method](FlowProp, FlowPropT, OD_Flows, Ca, Wt, iter, tol, log, Diag, start)
+    if statefile is not None:
+        SaveState(statefile, FlowProp, OD_Flows, Va, Ca, Wt)
+        Diag['products'] += 1
+
+    log('Final Z =' + str(((Va-Ca)**2).sum()))
+    if getDiagnostics == 0:
+        return OD_Flows
+    else:
+        return OD_Flows, Diag
+
+def SaveState(statefile, FlowProp, OD_Flows, Va, Ca, Wt):
+    '''Saves an estimation state (OD, Va, Grad, Ca, Wt) to a MatrixIO container, Grad costs one flow matrix product'''
+    Grad = FlowProp.dot((Va - Ca)*Wt)
+    MatrixIO.WriteMatrices(statefile, [('OD', OD_Flows), ('Va', Va), ('Grad', Grad), ('Ca', Ca), ('Wt', Wt)],
+                           attrs={'flowmat':[FlowProp.shape[0], FlowProp.shape[1], int(FlowProp.nnz)]})
+
+def LoadState(statefile, FlowProp):
+    '''Reads a state saved by SaveState into memory, checks it was made with a flow matrix of the same shape and size'''
+    header = MatrixIO.ReadHeader(statefile)
+    if header['attrs'].get('flowmat') != [FlowProp.shape[0], FlowProp.shape[1], int(FlowProp.nnz)]:
+        raise ValueError(statefile + ' was saved with a different flow proportion matrix')
+    return dict((name, np.array(mat)) for name, mat in MatrixIO.ReadMatrices(statefile).items())
+
+def ReEstimateMatrix(FlowProp, FlowPropT, statefile, Ca, Wt, iter=25, log = None, method = 'gradient', tol = 0.0, getDiagnostics = 0):
+    '''Incremental re-estimation after counts or weights changed, warm starts from the state saved by a previous run
+    (EstimateMatrix with statefile) and saves the new state to the same file
+    The gradient at the previous result is updated with only the FlowPropT rows of the changed counts.
+    statefile = state saved by EstimateMatrix / ReEstimateMatrix
+    Ca, Wt = new extended count and weight vectors (see ExtendCounts) or only the link counts and weights, then the
+             seed OD block of the previous run is kept
+    other arguments, see EstimateMatrix
+    Returns adjusted OD vector
+    '''
+    log = log or _Print
+    State = LoadState(statefile, FlowProp)
+    Ca = np.asarray(Ca, dtype='d')
+    Wt = np.asarray(Wt, dtype='d')
+    if len(Ca) < len(State['Ca']):
+        Ca = np.append(Ca, State['Ca'][len(Ca):])
+        Wt = np.append(Wt, State['Wt'][len(Wt):])
+    Changed = np.flatnonzero((Ca != State['Ca']) | (Wt != State['Wt']))
+    log('Changed counts/weights: ' + str(len(Changed)))
+    Va = State['Va']
+    Delta = (Va[Changed] - Ca[Changed])*Wt[Changed] - (Va[Changed] - State['Ca'][Changed])*State['Wt'][Changed]
+    Grad = State['Grad'] + FlowPropT[Changed].T.dot(Delta)
+    return EstimateMatrix(FlowProp, FlowPropT, State['OD'], Ca, Wt, iter, log, method, tol, getDiagnostics,
+                          statefile=statefile, start={'Va':Va, 'Grad':Grad})
+
+def EstimateMatrixBatch(FlowProp, FlowPropT, OD_Flows, Ca, Wt, iter=25, log = None, tol = 0.0, getDiagnostics = 0):
+    '''Gradient method for several classes/periods against the same flow proportions, one sparse matrix-matrix product
+    per step for all of them instead of one matrix-vector product per class
+    FlowProp = flow proportion matrix (nODs, nLinks+nODs), see loadFlowMat
+    FlowPropT = transpose of FlowProp
+    OD_Flows = seed OD vectors as columns (nODs, K), on a common OD index set (e.g. cells > 0 in any class, zero cells stay zero)
+    Ca = extended count vector shared by all classes (nLinks+nODs) or one per class (nLinks+nODs, K), see ExtendCountsBatch
+    Wt = extended weight vector, shared (nLinks+nODs) or one per class (nLinks+nODs, K)
+    iter (optional) = maximum iterations, default is 25
+    log (optional) = function taking a message string, default is print
+    tol (optional) = a class stops when the relative decrease of its Z in an iteration is below tol, default 0.0 = run to iter (or Z < 1)
+    getDiagnostics (optional) 0=no, <>0=yes --> also return dict {'iterations':[per class], 'Z':[...], 'step':[...], 'elapsed':[...], 'products':n}
+    Returns adjusted OD vectors (nODs, K), each column has its own step size
+    '''
+    log = log or _Print
+    start = time.time()
+    OD_Flows = np.array(OD_Flows, dtype='d').reshape((len(OD_Flows), -1))
+    K = OD_Flows.shape[1]
+    C = np.asarray(Ca, dtype='d').reshape((len(Ca), -1))
+    W = np.asarray(Wt, dtype='d').reshape((len(Wt), -1))
+    Va = FlowPropT.dot(OD_Flows)
+    Z = ((Va-C)**2).sum(axis=0)
+    log('Starting Z =' + str(Z))
+    Diag = {'iterations':np.zeros(K, dtype=int), 'Z':[], 'step':[], 'elapsed':[], 'products':1}
+
+    Active = np.arange(K) #working arrays X, Va, C, W only keep the columns still iterating
+    X = OD_Flows.copy()
+    for i in range(1, iter):
+        Res = Va - C
+        Grad = FlowProp.dot(Res*W)
+        Va_prime = FlowPropT.dot(-X * Grad)
+        num = -(Res*Va_prime).sum(axis=0)
+        den = (Va_prime*Va_prime).sum(axis=0)
+        lambda_opt = num/np.where(den > 0, den, 1.0)
+        GradMax = Grad.max(axis=0)
+        lambda_opt = np.where(GradMax > 0, np.minimum(lambda_opt, 1/np.where(GradMax > 0, GradMax, 1.0)), lambda_opt)
+        Grad *= lambda_opt
+        X -= X*Grad #variant - 1.1
+        X[X<0]=0 #remove very small -0.0 values from matrix if any...
+        Va = FlowPropT.dot(X)
+        Diag['products'] += 3
+        Zprev, Z[Active] = Z[Active], ((Va-C)**2).sum(axis=0)
+
+        Step = np.zeros(K)
+        Step[Active] = lambda_opt
+        Diag['iterations'][Active] = i
+        Diag['Z'].append(Z.copy())
+        Diag['step'].append(Step)
+        Diag['elapsed'].append(time.time() - start)
+        log(str(i) + ': Z =' + str(Z))
+        Done = Z[Active] < 1
+        if tol > 0:
+            Done |= (Zprev - Z[Active])/np.maximum(np.maximum(abs(Zprev), abs(Z[Active])), 1e-12) < tol
+        if Done.any():
+            OD_Flows[:, Active[Done]] = X[:, Done]
+            Keep = ~Done
+            Active, X, Va = Active[Keep], X[:, Keep], Va[:, Keep]
+            C = C if C.shape[1] == 1 else C[:, Keep]
+            W = W if W.shape[1] == 1 else W[:, Keep]
+            if len(Active) == 0:
+                break
+    OD_Flows[:, Active] = X
+
+    log('Final Z =' + str(Z))
+    if getDiagnostics == 0:
+        return OD_Flows
+    else:
+        return OD_Flows, Diag
+
+def readFlowMat(nODs, nLinks, filename, log = None):
+    '''Reads the path flow proportion file (12 header lines, then CountIndex \t ODIndex \t proportion rows) with bulk numpy parsing
+    and appends the identity block for the OD constraint rows. Returns FlowProp as csr_matrix (nODs, nLinks+nODs)
+    '''
+    t1 = time.time()
+    with open(filename, "rb") as f:
+        for i in range(0, 12):
+            f.readline()
+        Rows = list(MatrixIO.IterNumericRows(f, 3, stop=None))
+    Rows = np.concatenate(Rows) if Rows else np.zeros((0, 3))
+    FlowProp = BuildFlowMat(nODs, nLinks, Rows[:, 0], Rows[:, 1], Rows[:, 2])
+    t2 = time.time()
+    (log or _Print)("read flow mat: " + str(t2-t1))
+    return FlowProp
+
+def BuildFlowMat(nODs, nLinks, CountIndex, ODIndex, Prop):
+    '''Builds FlowProp from flow proportion arrays, same numbering as the flow proportion file
+    CountIndex = 1 based count index of each proportion (0 = not a count location, dropped)
+    ODIndex = 1 based index of the od pair in the non-zero seed OD vector
+    Prop = flow proportion
+    Returns FlowProp as csr_matrix (nODs, nLinks+nODs) including the identity block for the OD constraint rows
+    '''
+    CountIndex = np.asarray(CountIndex).astype(np.int64)
+    keep = CountIndex > 0
+    i = np.concatenate([np.asarray(ODIndex).astype(np.int64)[keep] - 1, np.arange(nODs)]) #index of od pair
+    j = np.concatenate([CountIndex[keep] - 1, nLinks + np.arange(nODs)]) #index of link, then of the od constraint
+    data = np.concatenate([np.asarray(Prop, dtype='d')[keep], np.ones(nODs)])
+    return scipy.sparse.csr_matrix((data, (i, j)), shape=(nODs, nLinks+nODs), dtype='d')
+
+def loadFlowMat(nODs, nLinks, filename, cache = True, log = None):
+    '''Returns FlowProp (csr, od major) and FlowPropT (csr of the transpose, link major) for the path flow proportion file
+    cache (optional) = keep a binary sidecar (filename + '.cache') keyed on the file size and mtime, reruns memory-map it
+    log (optional) = function taking a message string, default is print
+    '''
+    t1 = time.time()
+    cachefn = filename + '.cache'
+    header = MatrixIO.ReadCacheHeader(cachefn, filename) if cache else None
+    if header is not None and header['attrs'].get('shape') == [nODs, nLinks+nODs]:
+        Mats = MatrixIO.ReadMatrices(cachefn)
+        shape = (nODs, nLinks+nODs)
+        FlowProp = scipy.sparse.csr_matrix((Mats['data'], Mats['indices'], Mats['indptr']), shape=shape, copy=False)
+        FlowPropT = scipy.sparse.csr_matrix((Mats['dataT'], Mats['indicesT'], Mats['indptrT']), shape=shape[::-1], copy=False)
+        (log or _Print)("flow mat from cache: " + str(time.time()-t1))
+        return FlowProp, FlowPropT
+
+    FlowProp = readFlowMat(nODs, nLinks, filename, log)
+    FlowPropT = FlowProp.transpose().tocsr()
+    if cache:
+        MatrixIO.WriteMatrices(cachefn, [('data', FlowProp.data), ('indices', FlowProp.indices), ('indptr', FlowProp.indptr),
+                                         ('dataT', FlowPropT.data), ('indicesT', FlowPropT.indices), ('indptrT', FlowPropT.indptr)],
+                               attrs={'source':MatrixIO.SourceStamp(filename), 'shape':[nODs, nLinks+nODs]})
+    return FlowProp, FlowPropT
+
+def ReadLinkCounts(filename, countAttr = 'COUNT', weightAttr = None):
+    '''Reads counts from a tab separated link attribute file with one header row (see test_data/least_squares/Link_Counts.att)
+    countAttr (optional) = column with the counts, default is 'COUNT'
+    weightAttr (optional) = column with the count weights, default is a weight of 1.0 for every count
+    Returns count and weight arrays in file order (= count index order of the flow proportion file)
+    '''
+    with open(filename, "rb") as f:
+        columns = f.readline().decode('utf-8').split()
+        Rows = list(MatrixIO.IterNumericRows(f, len(columns)))
+    Rows = np.concatenate(Rows) if Rows else np.zeros((0, len(columns)))
+    Ca = Rows[:, columns.index(countAttr)]
+    Wt = Rows[:, columns.index(weightAttr)] if weightAttr is not None else np.ones(len(Ca))
+    return Ca, Wt
+
+def ReadSeed(filename, zoneIDs = None):
+    '''Reads a seed matrix from a Visum $O;D3 file
+    Returns the full flattened seed matrix, the non-zero OD vector estimated by EstimateMatrix and the zone numbers
+    '''
+    Seed, zoneIDs = MatrixIO.ReadVisumOD(filename, zoneIDs)
+    AssignedOD = Seed.flatten()
+    return AssignedOD, AssignedOD.compress(AssignedOD > 0), zoneIDs
+
+def ExtendCounts(Ca, Wt, Sparse_OD, SparseWeightOD = None):
+    '''Extends the count and weight arrays with the seed OD vector, so the least squares formulation also keeps the result close to the seed
+    SparseWeightOD (optional) = weights of the OD cells, default is 1.0
+    '''
+    if SparseWeightOD is None:
+        SparseWeightOD = np.ones(len(Sparse_OD))
+    return np.append(Ca, Sparse_OD), np.append(Wt, SparseWeightOD)
+
+def ExtendCountsBatch(Ca, Wt, OD_Flows, WeightOD = None):
+    '''ExtendCounts for EstimateMatrixBatch, OD_Flows = seed OD vectors as columns (nODs, K)
+    Ca, Wt = link counts and weights shared by all classes (nLinks) or one column per class (nLinks, K)
+    WeightOD (optional) = weights of the OD cells (nODs) or (nODs, K), default is 1.0
+    Returns extended count and weight arrays (nLinks+nODs, K)
+    '''
+    OD_Flows = np.asarray(OD_Flows, dtype='d').reshape((len(OD_Flows), -1))
+    nODs, K = OD_Flows.shape
+    if WeightOD is None:
+        WeightOD = np.ones(nODs)
+    Block = lambda a, n: np.broadcast_to(np.asarray(a, dtype='d').reshape((n, -1)), (n, K))
+    return np.vstack([Block(Ca, len(Ca)), OD_Flows]), np.vstack([Block(Wt, len(Wt)), Block(WeightOD, nODs)])
+
+def EstimateFromFiles(countfile, seedfile, flowmatfile, countAttr = 'COUNT', weightAttr = None, iter = 25, log = None, method = 'gradient', tol = 0.0):
+    '''Runs a full estimation from files, no Visum session needed
+    countfile = link count file, see ReadLinkCounts
+    seedfile = seed matrix in Visum $O;D3 format
+    flowmatfile = path flow proportion file (see readFlowMat) or a tuple of (CountIndex, ODIndex, Prop) arrays (see BuildFlowMat)
+    method, tol (optional) = solver and stopping rule, see EstimateMatrix
+    Returns estimated OD matrix (numZn, numZn) and the zone numbers
+    '''
+    Ca, Wt = ReadLinkCounts(countfile, countAttr, weightAttr)
+    AssignedOD, Sparse_OD, zoneIDs = ReadSeed(seedfile)
+    CaExt, WtExt = ExtendCounts(Ca, Wt, Sparse_OD)
+    if isinstance(flowmatfile, tuple):
+        FlowProp = BuildFlowMat(len(Sparse_OD), len(Ca), *flowmatfile)
+        FlowPropT = FlowProp.transpose().tocsr()
+    else:
+        FlowProp, FlowPropT = loadFlowMat(len(Sparse_OD), len(Ca), flowmatfile, log=log)
+    AssignedOD[AssignedOD>0] = EstimateMatrix(FlowProp, FlowPropT, Sparse_OD, CaExt, WtExt, iter, log, method, tol)
+    return AssignedOD.reshape((len(zoneIDs), len(zoneIDs))), zoneIDs
@@ -0,0 +1,240 @@
+'''Tests for scripts/CalcDistribution.py (Python 2 module), run from the repository root with: python -m unittest discover -s tests'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('CalcDistribution is a Python 2 module')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import CalcLogitChoice
+import CalcDistribution
+
+class Quiet(object):
+    '''Silences the balancing reports the distribution functions print'''
+    def __enter__(self):
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def Problem(numZn, seed = 0, sparse = False):
+    '''Productions, attractions (not balanced to the productions) and a friction matrix'''
+    rand = np.random.RandomState(seed)
+    F = rand.rand(numZn, numZn)
+    if sparse:
+        F *= rand.rand(numZn, numZn) < 0.3
+        F[np.arange(numZn), np.arange(numZn)] += 0.01
+    return rand.rand(numZn)*100, rand.rand(numZn)*80, F
+
+#Reference versions of the original loops the engines replace --->
+def FratarLoop(ProdA, AttrA, Trips1, maxIter):
+    AttrA = AttrA*(ProdA.sum()/AttrA.sum())
+    for balIter in range(0, maxIter):
+        ComputedProductions = Trips1.sum(1)
+        ComputedProductions[ComputedProductions==0]=1
+        Trips1 = Trips1*(ProdA/ComputedProductions)[:, np.newaxis]
+        ComputedAttractions = Trips1.sum(0)
+        ComputedAttractions[ComputedAttractions==0]=1
+        Trips1 = Trips1*(AttrA/ComputedAttractions)
+    return Trips1
+
+def DoublyConstrainedLoop(ProdA, AttrA, F, maxIter):
+    Trips1 = np.zeros((len(ProdA),len(ProdA)))
+    AttrA = AttrA*(ProdA.sum()/AttrA.sum())
+    AttrT, ProdT = AttrA.copy(), ProdA.copy()
+    for balIter in range(0, maxIter):
+        for i in range(0, len(ProdA)):
+            Trips1[i,:] = ProdA[i]*AttrA*F[i,:]/max(0.000001, np.sum(AttrA * F[i,:]))
+        ComputedAttractions = Trips1.sum(0)
+        ComputedAttractions[ComputedAttractions==0]=1
+        AttrA = AttrA*(AttrT/ComputedAttractions)
+        ComputedProductions = Trips1.sum(1)
+        ComputedProductions[ComputedProductions==0]=1
+        ProdA = ProdA*(ProdT/ComputedProductions)
+    for i in range(0,len(ProdA)):
+        Trips1[i,:] = ProdA[i]*AttrA*F[i,:]/max(0.000001, sum(AttrA * F[i,:]))
+    return Trips1
+
+def GravityShadowLoop(ProdA, AttrA, F, maxIter):
+    T = np.zeros(F.shape)
+    AttrA = AttrA*ProdA.sum() / AttrA.sum()
+    AttrA[AttrA<0.000001] = 0.0001
+    Attr = AttrA.copy()
+    F = F.copy()
+    F[F<0.000001] = 0.0001
+    for k in range(maxIter):
+        if k > 0:
+            Attr = Attr * AttrA / T.sum(0)
+        for i in range(ProdA.shape[0]):
+            T[i,:] = ProdA[i] * Attr * F[i, :] / (Attr * F[i, :]).sum()
+    return T
+
+def GravityLoop(P, A, F, maxIter):
+    T = A*F*P[:, np.newaxis]/np.maximum(np.sum(A*F, axis=1), 0.00001)[:, np.newaxis]
+    for i in range(maxIter):
+        F = np.where(A > 0, A/T.sum(0), 0)*F
+        T = A*F*P[:, np.newaxis]/np.maximum(np.sum(A*F, axis=1), 0.00001)[:, np.newaxis]
+    return T
+
+def MultiDistributeLoop(Prods, Attr, FricMatrices, maxIter):
+    numZones = len(Attr)
+    TripMatrices = np.zeros(FricMatrices.shape)
+    AttrOp = Attr.copy()
+    for Iter in range(-1, maxIter):
+        if Iter >= 0:
+            ComputedAttractions = TripMatrices.sum(1).sum(0)
+            ComputedAttractions[ComputedAttractions==0]=1
+            AttrOp = AttrOp*(Attr/ComputedAttractions)
+        for k in range(0, len(FricMatrices)):
+            for i in range(0, numZones):
+                if Prods[i, k] > 0:
+                    TripMatrices[k, i, :] = Prods[i, k]*AttrOp*FricMatrices[k, i, :]/max(0.000001, np.sum(AttrOp*FricMatrices[k, i, :]))
+    return TripMatrices
+
+class TestFratar(unittest.TestCase):
+    def test_original_loop(self):
+        ProdA, AttrA, Seed = Problem(40)
+        with Quiet():
+            T = CalcDistribution.CalcFratar(ProdA, AttrA, Seed.copy(), 10)
+        np.testing.assert_allclose(T, FratarLoop(ProdA, AttrA, Seed.copy(), 10), rtol=1e-10)
+
+    def test_convergence(self):
+        ProdA, AttrA, Seed = Problem(40, sparse=True)
+        AttrA *= ProdA.sum()/AttrA.sum()
+        out = np.empty(Seed.shape)
+        SeedCopy = Seed.copy()
+        T, Diag = CalcDistribution.BalanceFratar(ProdA, AttrA, Seed, 500, 1e-8, out=out)
+        self.assertTrue(T is out)
+        np.testing.assert_array_equal(Seed, SeedCopy)
+        self.assertLess(Diag['maxError'][-1], 1e-8)
+        np.testing.assert_allclose(T.sum(1), ProdA, rtol=1e-7)
+        np.testing.assert_allclose(T.sum(0), AttrA, rtol=1e-7)
+        TA, DiagA = CalcDistribution.BalanceFratar(ProdA, AttrA, Seed.copy(), 500, 1e-8, accel=3)
+        self.assertLessEqual(DiagA['iterations'], Diag['iterations'])
+        np.testing.assert_allclose(TA, T, rtol=1e-6, atol=1e-9)
+
+class TestMultiDistribute(unittest.TestCase):
+    def test_original_loop(self):
+        rand = np.random.RandomState(2)
+        F = rand.rand(4, 30, 30)
+        Prods = rand.rand(30, 4)*10
+        Prods[4, 2] = 0
+        Attr = rand.rand(30)*10
+        Expected = MultiDistributeLoop(Prods, Attr, F, 10)
+        np.testing.assert_allclose(CalcDistribution.CalcMultiDistribute(Prods, Attr, F), Expected, rtol=1e-10, atol=1e-12)
+        T, Diag = CalcDistribution.CalcMultiDistributeBatch(Prods, Attr, F, chunkSize=3, out=np.empty(F.shape))
+        np.testing.assert_allclose(T, Expected, rtol=1e-10, atol=1e-12)
+        self.assertEqual(Diag['iterations'], 10)
+
+class TestGravity(unittest.TestCase):
+    def setUp(self):
+        self.ProdA, self.AttrA, self.F = Problem(50)
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_original_loops(self):
+        with Quiet():
+            T = CalcDistribution.CalcDoublyConstrained(self.ProdA, self.AttrA, self.F)
+            TS = CalcDistribution.CalcGravityShadow(self.ProdA, self.AttrA, self.F.copy())
+            TG = CalcDistribution.CalcGravity(self.ProdA, self.AttrA, self.F)
+        np.testing.assert_allclose(T, DoublyConstrainedLoop(self.ProdA, self.AttrA, self.F, 10), rtol=1e-10)
+        np.testing.assert_allclose(TS, GravityShadowLoop(self.ProdA, self.AttrA, self.F, 10), rtol=1e-10)
+        np.testing.assert_allclose(TG, GravityLoop(self.ProdA, self.AttrA, self.F, 10), rtol=1e-10)
+
+    def test_blocked(self):
+        with Quiet():
+            Expected = CalcDistribution.CalcDoublyConstrained(self.ProdA, self.AttrA, self.F)
+        fn = os.path.join(self.tempdir, 'F.np')
+        outfn = os.path.join(self.tempdir, 'T.np')
+        self.F.tofile(fn)
+        T, Diag = CalcDistribution.CalcGravityBlocked(self.ProdA, self.AttrA, fn, blockSize=7, out=outfn)
+        self.assertTrue(isinstance(T, np.memmap))
+        np.testing.assert_allclose(T, Expected, rtol=1e-10)
+        np.testing.assert_allclose(np.fromfile(outfn).reshape(self.F.shape), Expected, rtol=1e-10)
+        self.assertEqual(Diag['iterations'], 10)
+
+    def test_workers(self):
+        fn = os.path.join(self.tempdir, 'F.np')
+        self.F.tofile(fn)
+        with Quiet():
+            T = CalcDistribution.CalcDoublyConstrained(self.ProdA, self.AttrA, self.F)
+            TS = CalcDistribution.CalcGravityShadow(self.ProdA, self.AttrA, self.F.copy())
+            for numWorkers, useProcesses in [(3, False), (2, True)]:
+                np.testing.assert_array_equal(CalcDistribution.CalcDoublyConstrained(self.ProdA, self.AttrA, self.F, numWorkers=numWorkers,
+                                                                                     useProcesses=useProcesses), T)
+                np.testing.assert_array_equal(CalcDistribution.CalcGravityShadow(self.ProdA, self.AttrA, self.F.copy(), numWorkers=numWorkers,
+                                                                                 useProcesses=useProcesses), TS)
+        TB = CalcDistribution.CalcGravityBlocked(self.ProdA, self.AttrA, fn, blockSize=8)[0]
+        for F in [fn, self.F]:
+            np.testing.assert_array_equal(CalcDistribution.CalcGravityBlocked(self.ProdA, self.AttrA, F, blockSize=8, numWorkers=2,
+                                                                              useProcesses=True)[0], TB)
+
+    def test_accel(self):
+        ProdA, AttrA, F = Problem(50, 1, sparse=True)
+        AttrA *= ProdA.sum()/AttrA.sum()
+        with Quiet():
+            for accel in [0, 5]:
+                T, Diag = CalcDistribution.CalcGravity(ProdA, AttrA, F, 500, accel, 1e-6, 1)
+                self.assertLess(Diag['maxError'][-1], 1e-6)
+                np.testing.assert_allclose(T.sum(0), AttrA, rtol=1e-5)
+                T, Diag = CalcDistribution.CalcDoublyConstrained(ProdA, AttrA, F, 500, accel=accel, tol=1e-6, getDiagnostics=1)
+                self.assertLess(Diag['maxError'][-1], 1e-6)
+                T, Diag = CalcDistribution.CalcGravityBlocked(ProdA, AttrA, F, 500, tol=1e-6, accel=accel)
+                self.assertLess(Diag['maxError'][-1], 1e-6)
+                T, Diag = CalcDistribution.BalanceFratar(ProdA, AttrA, F.copy(), 500, 1e-6, accel=accel)
+                self.assertLess(Diag['maxError'][-1], 1e-6)
+
+class TestModeDestinationBlocked(unittest.TestCase):
+    def setUp(self):
+        rand = np.random.RandomState(1)
+        self.numZn = numZn = 60
+        self.Tree = {(0,'ROOT'):[1.0,['A','T']], (1,'T'):[0.5,['B','R']]}
+        self.MatRefs = {'ROOT':1.0, 'T':0, 'A':-rand.rand(numZn,numZn)*3, 'B':-rand.rand(numZn,numZn)*4, 'R':-rand.rand(numZn,numZn)*4}
+        self.MatRefs['R'][:5,:] = -1e6
+        self.ProdA = rand.rand(numZn)*100
+        self.AttrA = rand.rand(numZn)*100
+        self.DestU = -rand.rand(numZn,numZn)
+        self.tempdir = tempfile.mkdtemp()
+        self.savedTempdir, tempfile.tempdir = tempfile.tempdir, self.tempdir
+
+    def tearDown(self):
+        tempfile.tempdir = self.savedTempdir
+        shutil.rmtree(self.tempdir)
+
+    def Separate(self):
+        '''Mode choice for all zones, friction from the log sum, gravity model and mode split as separate steps'''
+        Probs, lnSum = CalcLogitChoice.CalcNestedChoice(self.Tree, self.MatRefs, self.numZn, 1)
+        T, Diag = CalcDistribution.CalcGravityBlocked(self.ProdA, self.AttrA, np.exp(0.7*lnSum + self.DestU), maxIter=8, blockSize=16)
+        return dict((code, T*Probs[code]) for code in ['A', 'B', 'R']), Diag
+
+    def test_separate_steps(self):
+        Expected, ExpectedDiag = self.Separate()
+        for recompute in [0, 1]:
+            Trips, Diag = CalcDistribution.CalcModeDestinationBlocked(self.ProdA, self.AttrA, self.Tree, self.MatRefs, 0.7, self.DestU,
+                                                                      maxIter=8, blockSize=16, recompute=recompute)
+            self.assertEqual(sorted(Trips.keys()), ['A', 'B', 'R'])
+            for code in Trips.keys():
+                np.testing.assert_allclose(Trips[code], Expected[code], rtol=1e-9, atol=1e-12)
+            np.testing.assert_allclose(Diag['maxError'], ExpectedDiag['maxError'], rtol=1e-9)
+            self.assertEqual(Diag['choicePasses'], 9 if recompute else 2)
+            self.assertEqual(os.listdir(self.tempdir), [])  #temporary friction removed
+
+    def test_files(self):
+        Expected, ExpectedDiag = self.Separate()
+        fricfn = os.path.join(self.tempdir, 'fric')
+        outfn = os.path.join(self.tempdir, 'B')
+        Trips, Diag = CalcDistribution.CalcModeDestinationBlocked(self.ProdA, self.AttrA, self.Tree, self.MatRefs, 0.7, self.DestU,
+                                                                  maxIter=8, blockSize=16, out={'B':outfn}, frictionOut=fricfn)
+        self.assertEqual(Diag['choicePasses'], 2)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ['B', 'fric'])
+        np.testing.assert_allclose(np.fromfile(outfn).reshape(self.numZn, self.numZn), Expected['B'], rtol=1e-9, atol=1e-12)
+        Probs, lnSum = CalcLogitChoice.CalcNestedChoice(self.Tree, self.MatRefs, self.numZn, 1)
+        np.testing.assert_allclose(np.fromfile(fricfn).reshape(self.numZn, self.numZn), np.exp(0.7*lnSum + self.DestU), rtol=1e-12)
+
+if __name__ == '__main__':
+    unittest.main()
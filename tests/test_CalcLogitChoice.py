@@ -0,0 +1,257 @@
+'''Tests for scripts/CalcLogitChoice.py (Python 2 module), run from the repository root with: python -m unittest discover -s tests'''
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import warnings
+import numpy as np
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('CalcLogitChoice is a Python 2 module')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import CalcLogitChoice
+
+MODES = ['auto', 'transit', 'bike', 'walk']
+TREE = {(0,'ROOT'):[1.0,['AU','TR','AC']], (1,'AU'):[0.8,['CD','CP']], (1,'TR'):[0.7,['TB','TP']], (2,'TP'):[0.5,['PW','PD']],
+        (1,'AC'):[0.9,['BK','WK']]}
+LEAVES = ['CD', 'CP', 'TB', 'PW', 'PD', 'BK', 'WK']
+
+def Utilities(shape, seed = 0, dtype = np.float64):
+    '''MatRefs for TREE, nests enter as 0 and ROOT as 1.0 like in the CalcNestedChoice docstring'''
+    rand = np.random.RandomState(seed)
+    MatRefs = {'ROOT':1.0, 'AU':0, 'TR':0, 'AC':0, 'TP':0}
+    for code in LEAVES:
+        MatRefs[code] = rand.normal(0, 2, shape).astype(dtype)
+    return MatRefs
+
+def NestedReference(TreeDefn, MatRefs):
+    '''Nested logit written out nest by nest: log sums going up, probabilities going down'''
+    V = dict(MatRefs)
+    for key in sorted(TreeDefn.keys(), reverse=True):
+        theta, codes = TreeDefn[key]
+        V[key[1]] = theta*np.log(sum([np.exp(np.asarray(V[code], 'd')/theta) for code in codes]))
+    Probs = {'ROOT':1.0}
+    for key in sorted(TreeDefn.keys()):
+        theta, codes = TreeDefn[key]
+        for code in codes:
+            Probs[code] = Probs[key[1]]*np.exp((V[code] - V[key[1]])/theta)
+    return Probs, V['ROOT']
+
+def Baseline(U, getLogSumAccess = 0):
+    '''CalcMultinomialChoice segment by segment, stacked like CalcMultinomialChoiceBatch'''
+    Probs, LnSums = [], []
+    for Us in U:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            res = CalcLogitChoice.CalcMultinomialChoice(dict(zip(MODES, Us)), 1)
+        Probs.append([res[0][mode] for mode in MODES])
+        LnSums.append(res[1])
+    return np.array(Probs), np.array(LnSums)
+
+class TestMultinomialChoiceBatch(unittest.TestCase):
+    def setUp(self):
+        rand = np.random.RandomState(0)
+        self.U = rand.uniform(-3, 3, (3, len(MODES), 6, 6))
+
+    def test_baseline(self):
+        P, lnSum = CalcLogitChoice.CalcMultinomialChoiceBatch(self.U, 1, numWorkers=2)
+        Po, lnSumo = Baseline(self.U)
+        np.testing.assert_allclose(P, Po, rtol=1e-6)
+        np.testing.assert_allclose(lnSum, lnSumo, rtol=1e-6)
+
+    def test_dead_cells(self):
+        U = self.U.copy()
+        U[:, :, 0, 0] = -np.inf #no available mode
+        U[1, :, 2, 3] = -1000.0 #exp underflows for every mode
+        U[2, 0, 4, 4] = -np.inf #one mode unavailable
+        U[0, :, 5, :] = 800.0 #exp overflows
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            P, lnSum = CalcLogitChoice.CalcMultinomialChoiceBatch(U, 1)
+        U[0, :, 5, :] = 0.0 #same probabilities, the baseline overflows
+        Po, lnSumo = Baseline(U)
+        lnSumo[0, 5, :] += 800.0
+        self.assertFalse(np.isnan(P).any())
+        np.testing.assert_allclose(P, Po, rtol=1e-6)
+        np.testing.assert_array_equal(P[:, :, 0, 0], 0)
+        np.testing.assert_array_equal(P[1, :, 2, 3], 0)
+        np.testing.assert_array_equal(lnSum[:, 0, 0], -np.inf)
+        np.testing.assert_allclose(lnSum, lnSumo, rtol=1e-6)
+
+    def test_out_float32(self):
+        out = np.empty(self.U.shape, np.float32)
+        P = CalcLogitChoice.CalcMultinomialChoiceBatch(self.U.astype(np.float32), out=out)
+        self.assertTrue(P is out)
+        np.testing.assert_allclose(P, Baseline(self.U)[0], rtol=1e-5, atol=1e-7)
+
+class TestCompileTree(unittest.TestCase):
+    def test_plan_cache(self):
+        Tree = {(0,'ROOT'):[1.0,['AU','TR']], (1,'TR'):[0.5,['TB','TP']]}
+        Plan = CalcLogitChoice.CompileTree(Tree)
+        self.assertTrue(CalcLogitChoice.CompileTree(Tree) is Plan)
+        self.assertTrue(CalcLogitChoice.CompileTree(dict(Tree)) is Plan)
+        Tree[(1,'TR')][0] = 0.7 #changed in place
+        self.assertEqual(CalcLogitChoice.CompileTree(Tree)['nests'][0][2], 0.7)
+
+    def test_threads(self):
+        Trees = [{(0,'ROOT'):[1.0,['AU','TR']], (1,'TR'):[0.1*(i + 1),['TB','TP']]} for i in range(4)]
+        Plans = [CalcLogitChoice.CompileTree(Tree) for Tree in Trees]
+        Errors = []
+        def Run(i):
+            for n in range(5000):
+                if CalcLogitChoice.CompileTree(Trees[i]) is not Plans[i]:
+                    Errors.append((i, n))
+        Threads = [threading.Thread(target=Run, args=(i,)) for i in range(4)]
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1) #switch threads as often as possible
+        try:
+            for thread in Threads:
+                thread.start()
+            for thread in Threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(Errors, [])
+
+class TestNestedChoice(unittest.TestCase):
+    def test_reference(self):
+        MatRefs = Utilities((20, 20))
+        Saved = copy.deepcopy(MatRefs)
+        Probs, lnSum = CalcLogitChoice.CalcNestedChoice(TREE, MatRefs, 20, 1)
+        Expected, ExpectedLnSum = NestedReference(TREE, MatRefs)
+        for code in LEAVES + ['AU', 'TR', 'AC', 'TP']:
+            np.testing.assert_allclose(Probs[code], Expected[code], rtol=1e-10, atol=1e-15)
+        np.testing.assert_allclose(lnSum, ExpectedLnSum, rtol=1e-10)
+        for code in MatRefs.keys(): #utilities are not scaled in place
+            np.testing.assert_array_equal(MatRefs[code], Saved[code])
+
+    def test_no_alternative(self):
+        MatRefs = Utilities((20, 20))
+        MatRefs['PW'][:5] = -np.inf
+        MatRefs['PD'][:5] = -1e6
+        for code in LEAVES:
+            MatRefs[code][10:12] = -2000
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            Probs, lnSum = CalcLogitChoice.CalcNestedChoice(TREE, MatRefs, 20, 1)
+        np.testing.assert_array_equal(Probs['TP'][:5], 0)
+        self.assertFalse(any([np.isnan(Probs[code]).any() for code in LEAVES]))
+        Total = sum([Probs[code] for code in LEAVES])
+        np.testing.assert_allclose(Total[:10], 1.0, rtol=1e-12)
+        np.testing.assert_allclose(Total[12:], 1.0, rtol=1e-12)
+
+    def test_float32_out(self):
+        MatRefs = Utilities((20, 20), dtype=np.float32)
+        out = {'CD':np.zeros((20, 20), np.float32), 'TP':np.zeros((20, 20), np.float32)}
+        Probs, lnSum = CalcLogitChoice.CalcNestedChoice(TREE, MatRefs, 20, 1, out=out)
+        self.assertTrue(Probs['CD'] is out['CD'] and Probs['TP'] is out['TP'])
+        self.assertEqual(Probs['WK'].dtype, np.float32)
+        Expected, ExpectedLnSum = NestedReference(TREE, MatRefs)
+        for code in LEAVES:
+            np.testing.assert_allclose(Probs[code], Expected[code], rtol=1e-4, atol=1e-7)
+        Probs = CalcLogitChoice.CalcNestedChoice(TREE, MatRefs, 20, dtype=np.float64)
+        self.assertEqual(Probs['WK'].dtype, np.float64)
+
+    def test_flat_plan_2d(self):
+        MatRefs = Utilities(50, 1)
+        Expected, ExpectedLnSum = NestedReference(TREE, MatRefs)
+        Plan = CalcLogitChoice.CompileTree(TREE)
+        for tree in [TREE, Plan]:
+            Probs, lnSum = CalcLogitChoice.CalcNestedChoiceFlat(tree, MatRefs, 50, 1)
+            for code in LEAVES:
+                np.testing.assert_allclose(Probs[code], Expected[code], rtol=1e-10, atol=1e-15)
+            np.testing.assert_allclose(lnSum, ExpectedLnSum, rtol=1e-10)
+        U = np.column_stack([MatRefs[code] for code in Plan['alternatives']])
+        P, lnSum = CalcLogitChoice.CalcNestedChoice2D(Plan, U, 1)
+        self.assertEqual(P.shape, (50, len(LEAVES)))
+        for j, code in enumerate(Plan['alternatives']):
+            np.testing.assert_allclose(P[:, j], Expected[code], rtol=1e-10, atol=1e-15)
+        np.testing.assert_allclose(lnSum, ExpectedLnSum, rtol=1e-10)
+
+class TestBlockedChoice(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_nested(self):
+        numZn = 23
+        MatRefs = Utilities((numZn, numZn))
+        Probs, lnSum = CalcLogitChoice.CalcNestedChoice(TREE, MatRefs, numZn, 1)
+        Files = dict(MatRefs)
+        for code in LEAVES:
+            Files[code] = os.path.join(self.tempdir, code + '.np')
+            CalcLogitChoice.PushMatrix(Files[code], MatRefs[code])
+        Blocks = []
+        out, lnSumOut = CalcLogitChoice.CalcNestedChoiceBlocked(TREE, Files, numZn, 5,
+                                                                out={'CD':os.path.join(self.tempdir, 'pCD.np'), 'TP':np.zeros((numZn, numZn))},
+                                                                lnSumOut=os.path.join(self.tempdir, 'ls.np'),
+                                                                callback=lambda r0, r1, ProbMats, lnSum: Blocks.append((r0, r1)))
+        self.assertEqual(Blocks, [(r, min(r + 5, numZn)) for r in range(0, numZn, 5)])
+        np.testing.assert_allclose(CalcLogitChoice.GetMatrix(os.path.join(self.tempdir, 'pCD.np'), numZn), Probs['CD'], rtol=1e-12)
+        np.testing.assert_allclose(out['TP'], Probs['TP'], rtol=1e-12)
+        np.testing.assert_allclose(CalcLogitChoice.GetMatrix(os.path.join(self.tempdir, 'ls.np'), numZn), lnSum, rtol=1e-12)
+
+    def test_multinomial(self):
+        numZn = 23
+        MatRefs = Utilities((numZn, numZn))
+        Utils = dict((code, MatRefs[code]) for code in ['CD', 'TB', 'WK'])
+        Probs, lnSum = CalcLogitChoice.CalcMultinomialChoice(dict(Utils), 1)
+        out = dict((code, np.zeros((numZn, numZn))) for code in Utils.keys())
+        out, lnSumOut = CalcLogitChoice.CalcMultinomialChoiceBlocked(Utils, numZn, 6, out=out, lnSumOut=np.zeros((numZn, numZn)))
+        for code in Utils.keys():
+            np.testing.assert_allclose(out[code], Probs[code], rtol=1e-12)
+        np.testing.assert_allclose(lnSumOut, lnSum, rtol=1e-12)
+
+class TestSimulateChoice(unittest.TestCase):
+    def test_reproducible(self):
+        rand = np.random.RandomState(0)
+        P = rand.dirichlet(np.ones(5), 50000)
+        P[:, 2] = 0
+        P[7] = 0
+        Choice = CalcLogitChoice.SimulateChoice(P, seed=42, chunkSize=10000)
+        np.testing.assert_array_equal(CalcLogitChoice.SimulateChoice(P, seed=42, chunkSize=10000, numWorkers=3), Choice)
+        self.assertTrue((CalcLogitChoice.SimulateChoice(P, seed=43, chunkSize=10000) != Choice).any())
+        self.assertEqual(Choice[7], -1)
+        self.assertFalse((Choice == 2).any())
+        Valid = Choice >= 0
+        Share = np.bincount(Choice[Valid], minlength=5)/float(Valid.sum())
+        np.testing.assert_allclose(Share, (P[Valid]/P[Valid].sum(1)[:, np.newaxis]).mean(0), atol=0.01)
+
+    def test_utilities(self):
+        rand = np.random.RandomState(1)
+        Plan = CalcLogitChoice.CompileTree(TREE)
+        U = rand.normal(size=(50000, len(Plan['alternatives'])))
+        for tree, P in [(None, np.exp(U)/np.exp(U).sum(1)[:, np.newaxis]), (Plan, CalcLogitChoice.CalcNestedChoice2D(Plan, U))]:
+            Choice = CalcLogitChoice.SimulateChoice(U, seed=1, isUtility=1, TreeDefn=tree, numWorkers=2)
+            np.testing.assert_allclose(np.bincount(Choice, minlength=U.shape[1])/float(len(U)), P.mean(0), atol=0.01)
+
+class TestPivotPoint(unittest.TestCase):
+    def test_sparse_deltas(self):
+        import scipy.sparse
+        rand = np.random.RandomState(0)
+        numZn = 30
+        Po = dict((key, rand.random_sample((numZn, numZn))) for key in ['auto', 'transit', 'walk'])
+        for key in Po.keys():
+            Po[key][:3] = 0
+        Base = CalcLogitChoice.PivotBase(Po)
+        for scenario in range(3):
+            Transit = scipy.sparse.csr_matrix((rand.normal(size=40), (rand.randint(0, numZn, 40), rand.randint(0, numZn, 40))),
+                                              shape=(numZn, numZn))
+            cells = rand.randint(0, numZn*numZn, 20)
+            cells[:3] = np.arange(3)
+            Walk = (cells, rand.normal(size=20))
+            Cells, Probs, Full = CalcLogitChoice.CalcPivotPointSparse(Base, {'transit':Transit, 'walk':Walk}, 1)
+            Utils = {'auto':np.zeros((numZn, numZn)), 'transit':Transit.toarray(), 'walk':np.zeros(numZn*numZn)}
+            np.add.at(Utils['walk'], Walk[0], Walk[1])
+            Utils['walk'] = Utils['walk'].reshape(numZn, numZn)
+            Expected = CalcLogitChoice.CalcPivotPoint(Utils, Po)
+            for key in Po.keys():
+                np.testing.assert_allclose(Full[key], Expected[key], rtol=1e-12, atol=1e-15)
+                np.testing.assert_allclose(Probs[key], Expected[key].ravel()[Cells], rtol=1e-12, atol=1e-15)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+'''Tests for scripts/CalibrateGravity.py, run from the repository root with: python -m unittest discover -s tests'''
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import CalibrateGravity
+
+class Quiet(object):
+    '''Silences the calibration reports'''
+    def __enter__(self):
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def Problem(numZn = 80, seed = 5):
+    '''Productions, attractions and a distance skim between random points'''
+    rand = np.random.RandomState(seed)
+    xy = rand.rand(numZn, 2)*50
+    skim = np.sqrt(((xy[:, np.newaxis, :] - xy[np.newaxis, :, :])**2).sum(2)) + 1
+    return rand.rand(numZn)*100, rand.rand(numZn)*100, skim
+
+def AvgTripLength(trips, skim):
+    return (trips*skim).sum()/trips.sum()
+
+class TestCalibrate(unittest.TestCase):
+    def setUp(self):
+        self.P, self.A, self.skim = Problem()
+
+    def test_singly_constrained(self):
+        with Quiet():
+            trips, c = CalibrateGravity.CalibrateSinglyConstrainedNewton(self.P, self.A, 12.0, self.skim)
+        self.assertLess(abs(AvgTripLength(trips, self.skim)/12.0 - 1), 0.001)
+        np.testing.assert_allclose(trips.sum(1), self.P, rtol=1e-10)
+        self.assertLess(c, 0)
+
+    def test_doubly_constrained(self):
+        with Quiet():
+            trips, c, passes = CalibrateGravity.CalibrateDoublyConstrained(self.P, self.A, 12.0, self.skim, bal_tol=1e-6, bal_iter=500)
+        self.assertLess(abs(AvgTripLength(trips, self.skim)/12.0 - 1), 0.001)
+        np.testing.assert_allclose(trips.sum(1), self.P, rtol=1e-10)
+        np.testing.assert_allclose(trips.sum(0), self.A*self.P.sum()/self.A.sum(), rtol=1e-5)
+        self.assertGreater(passes, 0)
+
+    def test_max_iter(self):
+        with Quiet():
+            trips, c, passes = CalibrateGravity.CalibrateDoublyConstrained(self.P, self.A, 12.0, self.skim, max_iter=1)
+            trips, c = CalibrateGravity.CalibrateSinglyConstrainedNewton(self.P, self.A, 12.0, self.skim, max_iter=1)
+        np.testing.assert_allclose(trips.sum(1), self.P, rtol=1e-10)
+
+class TestSkimBins(unittest.TestCase):
+    def setUp(self):
+        self.P, self.A, self.skim = Problem()
+        self.trips = self.Trips(2*self.skim**-0.7*np.exp(-0.08*self.skim))
+
+    def Trips(self, F):
+        trips = F*self.A
+        trips *= (self.P/trips.sum(1))[:, np.newaxis]
+        return trips
+
+    def test_tlfd(self):
+        Bins = CalibrateGravity.BuildSkimBins(self.skim, 2.0, max_bin=40.0)
+        self.assertEqual(Bins['num_bins'], 20)
+        tlfd = CalibrateGravity.CalcTLFD(self.trips, Bins, normalize=False)
+        edges = list(Bins['edges'][:-1]) + [np.inf]
+        Expected = np.histogram(np.minimum(self.skim, 39.9).ravel(), edges, weights=self.trips.ravel())[0]
+        np.testing.assert_allclose(tlfd, Expected, rtol=1e-10)
+        np.testing.assert_allclose(CalibrateGravity.CalcTLFD(self.trips, Bins).sum(), 1.0)
+
+    def test_fit(self):
+        Bins = CalibrateGravity.BuildSkimBins(self.skim, 2.0)
+        obs = CalibrateGravity.CalcTLFD(self.trips, Bins)
+        params, Diag = CalibrateGravity.FitFrictionCurve(self.P, self.A, obs, Bins, 'gamma', tol=0.001)
+        self.assertGreater(max(Diag['coincidence']), 0.99)
+        self.assertAlmostEqual(params['b'], -0.7, delta=0.05)
+        self.assertAlmostEqual(params['c'], -0.08, delta=0.005)
+        params, Diag = CalibrateGravity.FitFrictionCurve(self.P, self.A, obs, Bins, 'lookup')
+        self.assertEqual(len(params['table']), Bins['num_bins'])
+        self.assertGreater(max(Diag['coincidence']), 0.99)
+        obs = CalibrateGravity.CalcTLFD(self.Trips(np.exp(-0.12*self.skim)), Bins)
+        params, Diag = CalibrateGravity.FitFrictionCurve(self.P, self.A, obs, Bins, 'exponential')
+        self.assertAlmostEqual(params['c'], -0.12, delta=0.005)
+        with Quiet():
+            Curves = CalibrateGravity.FitFrictionCurves({'hbw':(self.P, self.A, obs), 'hbo':(self.P, self.A*2, obs*3)}, Bins, 'exponential')
+        self.assertEqual(sorted(Curves.keys()), ['hbo', 'hbw'])
+        self.assertAlmostEqual(Curves['hbo'][0]['c'], -0.12, delta=0.005)
+
+if __name__ == '__main__':
+    unittest.main()
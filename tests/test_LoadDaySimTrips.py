@@ -0,0 +1,146 @@
+'''Tests for scripts/LoadDaySimTrips.py (Python 2 module), run from the repository root with: python -m unittest discover -s tests'''
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('LoadDaySimTrips is a Python 2 module')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import LoadDaySimTrips
+
+class Quiet(object):
+    '''Silences the timing reports the loaders print'''
+    def __enter__(self):
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+COLUMNS = ['hhno', 'otaz', 'dtaz', 'deptm', 'arrtm', 'mode', 'half', 'trexpfac']
+
+def WriteTrips(filename, Rows):
+    with open(filename, 'wb') as f:
+        f.write('\t'.join(COLUMNS) + '\n')
+        for row in Rows:
+            f.write('\t'.join([str(value) for value in row]) + '\n')
+
+def MakeTrips(numTrips, seed = 0):
+    rand = np.random.RandomState(seed)
+    return [[i, rand.randint(1, 6), rand.randint(1, 6), rand.randint(0, 1440), rand.randint(0, 1440), rand.randint(1, 4),
+             rand.randint(1, 3), rand.choice([0.5, 1.0, 2.0])] for i in range(numTrips)]
+
+class TestReadDaySimTrips(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.tripfile = os.path.join(self.tempdir, '_trip.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_columns(self):
+        Rows = MakeTrips(50)
+        WriteTrips(self.tripfile, Rows)
+        with Quiet():
+            trips = LoadDaySimTrips.ReadDaySimTrips(self.tripfile, cache=False)
+        for name, dtype in LoadDaySimTrips.TRIP_FIELDS:
+            self.assertEqual(trips[name].tolist(), [row[COLUMNS.index(name)] for row in Rows])
+
+    def test_malformed_row(self):
+        Rows = MakeTrips(10)
+        Rows[6][5] = 'NA'
+        WriteTrips(self.tripfile, Rows)
+        with self.assertRaises(ValueError) as error:
+            LoadDaySimTrips.ReadDaySimTrips(self.tripfile, cache=False)
+        self.assertIn('row 7 ', str(error.exception))
+        self.assertFalse(os.path.exists(self.tripfile + '.cache'))
+
+    def test_cache(self):
+        WriteTrips(self.tripfile, MakeTrips(50))
+        with Quiet():
+            trips = LoadDaySimTrips.ReadDaySimTrips(self.tripfile)
+            cached = LoadDaySimTrips.ReadDaySimTrips(self.tripfile)
+        self.assertTrue(isinstance(cached['otaz'], np.memmap))
+        for name, dtype in LoadDaySimTrips.TRIP_FIELDS:
+            np.testing.assert_array_equal(cached[name], trips[name])
+        del cached
+        Rows = MakeTrips(60, 1)
+        WriteTrips(self.tripfile, Rows)
+        with Quiet():
+            trips = LoadDaySimTrips.ReadDaySimTrips(self.tripfile)
+        self.assertEqual(trips['dtaz'].tolist(), [row[2] for row in Rows])
+
+class TestTripFiles(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.tripfiles = [os.path.join(self.tempdir, '_trip_' + str(i) + '.dat') for i in range(3)]
+        self.Rows = [MakeTrips(40 + 10*i, i) for i in range(3)]
+        for fn, Rows in zip(self.tripfiles, self.Rows):
+            WriteTrips(fn, Rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_db(self):
+        dbfile = os.path.join(self.tempdir, 'trips.db')
+        with Quiet():
+            conn, trip_data = LoadDaySimTrips.GetDaySimTripsDB3(self.tripfiles[0], dbfile, chunkBytes=256)
+        trip_data.execute("SELECT otaz, dtaz, deptm, arrtm, mode, half, etrps FROM trips")
+        self.assertEqual(trip_data.fetchall(), [tuple(row[1:]) for row in self.Rows[0]])
+        conn.close()
+        os.utime(dbfile, (1, 1))
+        with Quiet():
+            conn, trip_data = LoadDaySimTrips.GetDaySimTripsDB3(self.tripfiles[0], dbfile)
+        self.assertEqual(trip_data.execute("SELECT count(*) FROM trips").fetchone()[0], 40)
+        conn.close()
+        self.assertEqual(os.stat(dbfile).st_mtime, 1)  #opened, not loaded again
+        WriteTrips(self.tripfiles[0], self.Rows[1])
+        with Quiet():
+            conn, trip_data = LoadDaySimTrips.GetDaySimTripsDB3(self.tripfiles[0], dbfile)
+        self.assertEqual(trip_data.execute("SELECT sum(otaz) FROM trips").fetchone()[0], sum([row[1] for row in self.Rows[1]]))
+        conn.close()
+
+    def test_merged(self):
+        cachefn = os.path.join(self.tempdir, 'trips.cache')
+        with Quiet():
+            trips = LoadDaySimTrips.ReadDaySimTripFiles(os.path.join(self.tempdir, '_trip_*.dat'), cachefn, numWorkers=2, sourceColumn=True)
+            cached = LoadDaySimTrips.ReadDaySimTripFiles(self.tripfiles, cachefn, numWorkers=1, sourceColumn=True)
+        self.assertTrue(isinstance(cached['source'], np.memmap))
+        self.assertEqual(sorted(glob.glob(os.path.join(self.tempdir, '_trip_*.dat.cache'))), [fn + '.cache' for fn in self.tripfiles])
+        Rows = self.Rows[0] + self.Rows[1] + self.Rows[2]
+        for name, dtype in LoadDaySimTrips.TRIP_FIELDS:
+            self.assertEqual(trips[name].tolist(), [row[COLUMNS.index(name)] for row in Rows])
+            np.testing.assert_array_equal(cached[name], trips[name])
+        self.assertEqual(trips['source'].tolist(), [0]*40 + [1]*50 + [2]*60)
+
+    def test_aggregate(self):
+        import MatrixIO
+        zoneIDs = [5, 3, 1, 2]
+        periods = [('AM', 360, 540), ('PM', 900, 1080), ('NT', 0, 300), ('NT', 1200, 1440)]
+        Expected = {}
+        for Rows in self.Rows:
+            for hhno, otaz, dtaz, deptm, arrtm, mode, half, trexpfac in Rows:
+                Names = [name for name, t0, t1 in periods if t0 <= deptm < t1]
+                if otaz in zoneIDs and dtaz in zoneIDs and mode in [1, 3] and Names:
+                    name = 'mode' + str(mode) + '_' + Names[0]
+                    Expected.setdefault(name, np.zeros((4, 4)))[zoneIDs.index(otaz), zoneIDs.index(dtaz)] += trexpfac
+        matfn = os.path.join(self.tempdir, 'mats.bin')
+        with Quiet():
+            LoadDaySimTrips.ReadDaySimTrips(self.tripfiles[1])  #read from the column cache, the others from the text
+            Dense = LoadDaySimTrips.AggregateDaySimTrips(self.tripfiles, zoneIDs, matfn, periods, modes=[1, 3], chunkBytes=256)
+            Sparse = LoadDaySimTrips.AggregateDaySimTrips(self.tripfiles, zoneIDs, None, periods, modes=[1, 3], sparse=True)
+        self.assertEqual(sorted(Dense.keys()), ['mode' + str(mode) + '_' + name for mode in [1, 3] for name in ['AM', 'NT', 'PM']])
+        Stored = MatrixIO.ReadMatrices(matfn)
+        for name in Dense.keys():
+            np.testing.assert_allclose(Dense[name], Expected.get(name, np.zeros((4, 4))))
+            np.testing.assert_allclose(Sparse[name].toarray(), Dense[name])
+            np.testing.assert_array_equal(Stored[name], Dense[name])
+        numUsed = sum([1 for Rows in self.Rows for row in Rows if row[1] in zoneIDs and row[2] in zoneIDs and row[5] in [1, 3] and
+                       any([t0 <= row[3] < t1 for name, t0, t1 in periods])])
+        self.assertEqual(MatrixIO.ReadHeader(matfn)['attrs']['dropped'], 150 - numUsed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+'''Tests for scripts/MatrixIO.py, run from the repository root with: python -m unittest discover -s tests'''
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import MatrixIO
+
+SEED = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'least_squares', 'Seed_OD.mtx')
+
+def ReadRows(text, ncols, **kw):
+    return np.concatenate(list(MatrixIO.IterNumericRows(io.BytesIO(text), ncols, **kw)))
+
+class TestNumericRows(unittest.TestCase):
+    def test_comments_blank_lines_and_stop(self):
+        Rows = ReadRows(b"* comment\n1\t2 3\n\n  4 5 6  \r\n*x\n7 8 9\n$NAMES\nfoo bar", 3)
+        self.assertEqual(Rows.tolist(), [[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+
+    def test_chunks(self):
+        text = b"".join([b"%d %d\n" % (i, 2 * i) for i in range(100)])
+        Rows = ReadRows(text, 2, chunkBytes=16)
+        self.assertEqual(Rows[:, 0].tolist(), list(range(100)))
+        self.assertEqual(Rows[:, 1].tolist(), list(range(0, 200, 2)))
+
+    def test_malformed_rows(self):
+        for text, row in [(b"1 2 3\n4 5 6 NA\n7 8 9\n", 2), (b"1 2 3\nNA 5 6\n7 8 9\n", 2), (b"1 2 3\n4 5\n6 7 8 9\n", 2),
+                          (b"1 2 3\n" * 5 + b"1 x 3\n", 6)]:
+            for chunkBytes in [8, 1024]:
+                with self.assertRaises(ValueError) as error:
+                    ReadRows(text, 3, chunkBytes=chunkBytes)
+                self.assertIn('row ' + str(row) + ' ', str(error.exception))
+
+class TestContainer(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tempdir, 'skims.mtx')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_round_trip(self):
+        rand = np.random.RandomState(8)
+        Mats = [('time', rand.rand(30, 30)), ('dist', np.arange(900, dtype='f4').reshape(30, 30)), ('empty', np.zeros(0)),
+                ('ids', np.arange(5))]
+        MatrixIO.WriteMatrices(self.fn, Mats, zoneIDs=np.arange(101, 131), compress=['dist'], attrs={'factor':np.float64(2.5)})
+        header = MatrixIO.ReadHeader(self.fn)
+        self.assertEqual([entry['name'] for entry in header['matrices']], ['time', 'dist', 'empty', 'ids'])
+        self.assertEqual(header['attrs'], {'factor':2.5})
+        self.assertTrue(all(entry['offset'] % MatrixIO.ALIGN == 0 for entry in header['matrices']))
+        Read = MatrixIO.ReadMatrices(self.fn)
+        for name, mat in Mats:
+            self.assertEqual(Read[name].dtype, mat.dtype)
+            np.testing.assert_array_equal(Read[name], mat)
+        self.assertTrue(isinstance(Read['time'], np.memmap))
+        self.assertFalse(isinstance(Read['dist'], np.memmap))
+        self.assertEqual(MatrixIO.ZoneIndex(self.fn)[105], 4)
+
+    def test_update_in_place(self):
+        MatrixIO.WriteMatrices(self.fn, {'time':np.ones((4, 4))})
+        mat = MatrixIO.ReadMatrix(self.fn, 'time', 'r+')
+        mat[1, 2] = 7
+        mat.flush()
+        del mat
+        self.assertEqual(MatrixIO.ReadMatrix(self.fn, 'time')[1, 2], 7)
+        self.assertRaises(KeyError, MatrixIO.ReadMatrix, self.fn, 'dist')
+
+    def test_cache_header(self):
+        source = os.path.join(self.tempdir, 'source.txt')
+        with open(source, 'w') as f:
+            f.write('1 2 3')
+        MatrixIO.WriteMatrices(self.fn, {'x':np.ones(3)}, attrs={'source':MatrixIO.SourceStamp(source)})
+        self.assertTrue(MatrixIO.ReadCacheHeader(self.fn, source) is not None)
+        with open(source, 'w') as f:
+            f.write('1 2 3 4')
+        self.assertTrue(MatrixIO.ReadCacheHeader(self.fn, source) is None)
+        self.assertTrue(MatrixIO.ReadCacheHeader(self.fn + '.missing', source) is None)
+
+class TestVisumOD(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_seed(self):
+        mat, zoneIDs = MatrixIO.ReadVisumOD(SEED)
+        Cells = {}
+        with open(SEED) as f:
+            Lines = [line.split() for line in f.read().split('$NAMES')[0].split('\n')[7:]]
+        for line in Lines:
+            if len(line) == 3 and not line[0].startswith('*'):
+                Cells[int(line[0]), int(line[1])] = Cells.get((int(line[0]), int(line[1])), 0) + float(line[2])
+        self.assertEqual(mat.shape, (len(zoneIDs), len(zoneIDs)))
+        zoneIndex = dict((z, i) for i, z in enumerate(zoneIDs))
+        for (o, d), value in Cells.items():
+            self.assertAlmostEqual(mat[zoneIndex[o], zoneIndex[d]], value)
+        self.assertAlmostEqual(mat.sum(), sum(Cells.values()), places=6)
+        sparse, sparseZones = MatrixIO.ReadVisumOD(SEED, sparse=True, chunkBytes=1000)
+        np.testing.assert_array_equal(sparse.toarray(), mat)
+
+    def test_round_trip(self):
+        rand = np.random.RandomState(9)
+        mat = rand.rand(12, 12)*(rand.rand(12, 12) < 0.4)*1000
+        mat[3, 4] = 1.0/3
+        mat[5, 6] = 1e-9
+        zoneIDs = np.array([7, 3, 100, 42, 5, 6, 8, 9, 10, 11, 12, 13])
+        fn = os.path.join(self.tempdir, 'od.mtx')
+        for factor in [1.0, 0.1]:
+            MatrixIO.WriteVisumOD(fn, mat, zoneIDs, factor, title='test')
+            Read, ReadZones = MatrixIO.ReadVisumOD(fn)
+            np.testing.assert_array_equal(ReadZones, zoneIDs)
+            np.testing.assert_allclose(Read, mat, rtol=1e-9)
+        import scipy.sparse
+        MatrixIO.WriteVisumOD(fn, scipy.sparse.csr_matrix(mat), zoneIDs)
+        np.testing.assert_allclose(MatrixIO.ReadVisumOD(fn)[0], mat, rtol=1e-9)
+        self.assertRaises(ValueError, MatrixIO.ReadVisumOD, fn, zoneIDs[1:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+'''Tests for scripts/ODME.py, run from the repository root with: python -m unittest discover -s tests'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import BenchmarkODME
+import ODME
+
+TESTDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'least_squares')
+
+METHODS = ['gradient', 'cg', 'lbfgsb']
+
+class CountingMatrix(object):
+    '''Sparse matrix stand in that counts the flow matrix products'''
+    def __init__(self, mat, Counter):
+        self.mat, self.Counter, self.shape = mat, Counter, mat.shape
+
+    def dot(self, x):
+        self.Counter[0] += 1
+        return self.mat.dot(x)
+
+def MakeProblem(nODs = 40, nLinks = 25, seed = 0):
+    '''Random route choice, counts from a perturbed true matrix, returns FlowProp, FlowPropT, seed OD, Ca, Wt'''
+    rand = np.random.RandomState(seed)
+    ODIndex = np.repeat(np.arange(1, nODs + 1), 4)
+    CountIndex = rand.randint(0, nLinks + 1, len(ODIndex))
+    Prop = rand.uniform(0.1, 1.0, len(ODIndex))
+    FlowProp = ODME.BuildFlowMat(nODs, nLinks, CountIndex, ODIndex, Prop)
+    FlowPropT = FlowProp.T.tocsr()
+    Seed = rand.uniform(5, 50, nODs)
+    Ca = FlowPropT.dot(Seed*rand.uniform(0.7, 1.3, nODs))[:nLinks]
+    Ca, Wt = ODME.ExtendCounts(Ca, np.ones(nLinks), Seed, np.full(nODs, 0.01))
+    return FlowProp, FlowPropT, Seed, Ca, Wt
+
+class TestEstimateMatrix(unittest.TestCase):
+    def setUp(self):
+        self.FlowProp, self.FlowPropT, self.Seed, self.Ca, self.Wt = MakeProblem()
+        self.log = lambda msg: None
+
+    def test_products(self):
+        for method in METHODS:
+            Counter = [0]
+            OD, Diag = ODME.EstimateMatrix(CountingMatrix(self.FlowProp, Counter), CountingMatrix(self.FlowPropT, Counter), self.Seed,
+                                           self.Ca, self.Wt, 15, self.log, method, getDiagnostics=1)
+            self.assertEqual(Diag['products'], Counter[0], method)
+
+    def test_diagnostics(self):
+        Z0 = ((self.FlowPropT.dot(self.Seed) - self.Ca)**2).sum()
+        for method in METHODS:
+            OD, Diag = ODME.EstimateMatrix(self.FlowProp, self.FlowPropT, self.Seed, self.Ca, self.Wt, 15, self.log, method,
+                                           getDiagnostics=1)
+            self.assertAlmostEqual(Diag['Z'][0], Z0, delta=1e-9*Z0)
+            self.assertEqual(len(Diag['Z']), Diag['iterations'] + 1, method)
+            self.assertEqual(len(Diag['step']), len(Diag['Z']))
+            self.assertAlmostEqual(Diag['Z'][-1], ((self.FlowPropT.dot(OD) - self.Ca)**2).sum(), delta=1e-6*Z0)
+            self.assertLess(Diag['Z'][-1], Z0)
+            self.assertTrue((OD >= 0).all())
+
+    def test_start_at_optimum(self):
+        '''counts equal to the assigned seed, the gradient is 0 and the solvers stop before the first iteration'''
+        Ca = self.FlowPropT.dot(self.Seed)
+        for method in ['cg', 'lbfgsb']:
+            OD, Diag = ODME.EstimateMatrix(self.FlowProp, self.FlowPropT, self.Seed, Ca, self.Wt, 15, self.log, method,
+                                           getDiagnostics=1)
+            self.assertTrue(len(Diag['Z']) >= 1)
+            self.assertLess(Diag['Z'][-1], 1e-12)
+            np.testing.assert_allclose(OD, self.Seed, rtol=1e-9)
+        OD, Diag = ODME.EstimateMatrix(self.FlowProp, self.FlowPropT, self.Seed, self.Ca, self.Wt, 1, self.log, 'gradient',
+                                       getDiagnostics=1)
+        self.assertEqual((Diag['iterations'], len(Diag['Z'])), (0, 1))
+
+    def test_incremental(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            statefile = os.path.join(tempdir, 'state.mtx')
+            OD = ODME.EstimateMatrix(self.FlowProp, self.FlowPropT, self.Seed, self.Ca, self.Wt, 10, self.log, statefile=statefile)
+            nLinks = self.FlowProp.shape[1] - len(self.Seed)
+            Ca, Wt = self.Ca[:nLinks].copy(), self.Wt[:nLinks].copy()
+            Ca[[2, 7]] *= 1.2
+            Wt[11] = 3.0
+            for method in METHODS:
+                shutil.copy(statefile, statefile + '.' + method)
+                Re, Diag = ODME.ReEstimateMatrix(self.FlowProp, self.FlowPropT, statefile + '.' + method, Ca, Wt, 10, self.log, method,
+                                                 getDiagnostics=1)
+                CaExt, WtExt = np.append(Ca, self.Ca[nLinks:]), np.append(Wt, self.Wt[nLinks:])
+                Full, FullDiag = ODME.EstimateMatrix(self.FlowProp, self.FlowPropT, OD, CaExt, WtExt, 10, self.log, method, getDiagnostics=1)
+                np.testing.assert_allclose(Re, Full, rtol=1e-8, atol=1e-10, err_msg=method)
+                np.testing.assert_allclose(Diag['Z'], FullDiag['Z'], rtol=1e-8)
+                self.assertLess(Diag['products'], FullDiag['products'] + 1)
+                State = ODME.LoadState(statefile + '.' + method, self.FlowProp)
+                np.testing.assert_array_equal(State['OD'], Re)
+                np.testing.assert_array_equal(State['Ca'], CaExt)
+        finally:
+            shutil.rmtree(tempdir)
+
+class TestEstimateMatrixBatch(unittest.TestCase):
+    def test_single_class(self):
+        FlowProp, FlowPropT, Seed, Ca, Wt = MakeProblem()
+        nLinks = FlowProp.shape[1] - len(Seed)
+        rand = np.random.RandomState(3)
+        Seeds = np.column_stack([Seed, Seed*rand.uniform(0.5, 1.5, len(Seed)), Seed*2])
+        Counts = np.column_stack([Ca[:nLinks], Ca[:nLinks]*1.1, Ca[:nLinks]*2])
+        CaBatch, WtBatch = ODME.ExtendCountsBatch(Counts, Wt[:nLinks], Seeds, Wt[nLinks:])
+        for tol in [0.0, 1e-3]:
+            OD, Diag = ODME.EstimateMatrixBatch(FlowProp, FlowPropT, Seeds, CaBatch, WtBatch, 12, lambda msg: None, tol, 1)
+            for k in range(Seeds.shape[1]):
+                Single, SingleDiag = ODME.EstimateMatrix(FlowProp, FlowPropT, Seeds[:, k], CaBatch[:, k], WtBatch[:, k], 12,
+                                                         lambda msg: None, tol=tol, getDiagnostics=1)
+                np.testing.assert_allclose(OD[:, k], Single, rtol=1e-8, atol=1e-10)
+                self.assertEqual(Diag['iterations'][k], SingleDiag['iterations'])
+
+class TestFiles(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.Ca, self.Wt = ODME.ReadLinkCounts(os.path.join(TESTDIR, 'Link_Counts.att'))
+        self.AssignedOD, self.Sparse_OD, self.zoneIDs = ODME.ReadSeed(os.path.join(TESTDIR, 'Seed_OD.mtx'))
+        self.flowmatfile = os.path.join(self.tempdir, 'FlowMatrix.mtx')
+        BenchmarkODME.WriteSyntheticFlowMat(self.flowmatfile, len(self.Sparse_OD), len(self.Ca))
+        self.log = lambda msg: None
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_flow_mat_cache(self):
+        Rows = np.loadtxt(self.flowmatfile, skiprows=12)
+        Expected = ODME.BuildFlowMat(len(self.Sparse_OD), len(self.Ca), Rows[:, 0], Rows[:, 1], Rows[:, 2])
+        for i in range(2):
+            FlowProp, FlowPropT = ODME.loadFlowMat(len(self.Sparse_OD), len(self.Ca), self.flowmatfile, log=self.log)
+            self.assertEqual(abs(FlowProp - Expected).max(), 0)
+            self.assertEqual(abs(FlowPropT - Expected.T).max(), 0)
+            self.assertTrue(os.path.exists(self.flowmatfile + '.cache'))
+        for data in [FlowProp.data, FlowPropT.indices]: #mapped from the cache, not read into memory
+            while not isinstance(data, np.memmap) and isinstance(data.base, np.ndarray):
+                data = data.base
+            self.assertTrue(isinstance(data, np.memmap))
+        with open(self.flowmatfile, 'ab') as f:
+            f.write(b'1\t1\t0.5\n')
+        FlowProp, FlowPropT = ODME.loadFlowMat(len(self.Sparse_OD), len(self.Ca), self.flowmatfile, log=self.log)
+        self.assertAlmostEqual(FlowProp[0, 0], Expected[0, 0] + 0.5)
+
+    def test_estimate_from_files(self):
+        Result, zoneIDs = ODME.EstimateFromFiles(os.path.join(TESTDIR, 'Link_Counts.att'), os.path.join(TESTDIR, 'Seed_OD.mtx'),
+                                                 self.flowmatfile, iter=8, log=self.log, method='cg')
+        np.testing.assert_array_equal(zoneIDs, self.zoneIDs)
+        FlowProp, FlowPropT = ODME.loadFlowMat(len(self.Sparse_OD), len(self.Ca), self.flowmatfile, log=self.log)
+        CaExt, WtExt = ODME.ExtendCounts(self.Ca, self.Wt, self.Sparse_OD)
+        OD = ODME.EstimateMatrix(FlowProp, FlowPropT, self.Sparse_OD, CaExt, WtExt, 8, self.log, 'cg')
+        Expected = self.AssignedOD.copy()
+        Expected[Expected > 0] = OD
+        np.testing.assert_allclose(Result, Expected.reshape(Result.shape), rtol=1e-12)
+        Rows = np.loadtxt(self.flowmatfile, skiprows=12)
+        Result2, zoneIDs = ODME.EstimateFromFiles(os.path.join(TESTDIR, 'Link_Counts.att'), os.path.join(TESTDIR, 'Seed_OD.mtx'),
+                                                  (Rows[:, 0], Rows[:, 1], Rows[:, 2]), iter=8, log=self.log, method='cg')
+        np.testing.assert_allclose(Result2, Result, rtol=1e-12)
+
+    def test_benchmark(self):
+        Timings = BenchmarkODME.RunBenchmark(TESTDIR, 5, log=self.log)
+        for method in METHODS:
+            secs, iterations, products, Z = Timings[method + ' (secs, iterations, flow mat products, final Z)']
+            self.assertEqual(iterations, 4)
+            self.assertGreater(products, iterations)
+
+if __name__ == '__main__':
+    unittest.main()